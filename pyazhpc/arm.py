@@ -1,5 +1,8 @@
+import collections
+import hashlib
 import json
 import logging
+import re
 import sys
 import uuid
 
@@ -8,12 +11,116 @@ import azutil
 log = logging.getLogger(__name__)
 
 class ArmTemplate:
-    def __init__(self):
+    # copy_loops writes a VM with several instances as ARM copy loops rather
+    # than a set of resources for each instance, sshkey is the public key for
+    # the admin user (read from <admin_user>_id_rsa.pub when not given)
+    def __init__(self, copy_loops=False, sshkey=None):
+        self.copy_loops = copy_loops
+        self.sshkey = sshkey
         self.parameters = {}
         self.variables = {}
         self.resources = []
         self.outputs = {}
+        # the resources added for the network and for each resource and
+        # storage in the config, these are deployed separately when sharded
+        self.groups = collections.OrderedDict()
+        # lookups by type/name and type (lowercase as ARM is not case
+        # sensitive) and the dependsOn edges, kept up to date by _add_resource
+        self.index = {}
+        self.types = collections.defaultdict(list)
+        self.edges = collections.defaultdict(list)
+        self.reverse_edges = collections.defaultdict(list)
+
+    def _add_resource(self, res):
+        self.resources.append(res)
+        key = _resource_key(res["type"], res["name"]).lower()
+        self.index[key] = res
+        self.types[res["type"].lower()].append(res)
+        # subnets are inline in the vnet but can be found as if they were
+        # resources of their own
+        if res["type"] == "Microsoft.Network/virtualNetworks":
+            for subnet in res["properties"]["subnets"]:
+                self.index[_resource_key("Microsoft.Network/virtualNetworks/subnets", res["name"]+"/"+subnet["name"]).lower()] = subnet
+        for d in res.get("dependsOn", []):
+            dkey = _dep_key(d)
+            if dkey:
+                self.edges[key].append(dkey.lower())
+                self.reverse_edges[dkey.lower()].append(key)
+
+    def _reindex(self):
+        resources = self.resources
+        self.resources = []
+        self.index.clear()
+        self.types.clear()
+        self.edges.clear()
+        self.reverse_edges.clear()
+        for res in resources:
+            self._add_resource(res)
+
+    def find(self, rtype, name):
+        return self.index.get(_resource_key(rtype, name).lower(), None)
+
+    def find_type(self, rtype):
+        return self.types.get(rtype.lower(), [])
+
+    def dependencies(self, res):
+        # the resources in the template that res depends on
+        key = _resource_key(res["type"], res["name"]).lower()
+        return [ self.index[d] for d in self.edges.get(key, []) if d in self.index ]
+
+    def dependents(self, res):
+        # the resources in the template that depend on res
+        key = _resource_key(res["type"], res["name"]).lower()
+        return [ self.index[d] for d in self.reverse_edges.get(key, []) ]
+
+    def duplicates(self):
+        counts = collections.Counter([ _resource_key(res["type"], res["name"]).lower() for res in self.resources ])
+        return [
+            _resource_key(res["type"], res["name"]) for res in self.resources
+                if counts.pop(_resource_key(res["type"], res["name"]).lower(), 0) > 1
+        ]
+
+    def unresolved(self):
+        # The dependsOn and resourceId references (in this resource group)
+        # to resources that are not in the template.  Expressions, e.g. in
+        # copy loops, are not checked.
+        missing = []
+        for res in self.resources:
+            refs = [ _dep_key(d) for d in res.get("dependsOn", []) ]
+            refs += [ _dep_key(v) for v in _strings(dict(res, dependsOn=[])) if v.startswith("[resourceId(") ]
+            for ref in refs:
+                if ref and ref.lower() not in self.index and (res, ref) not in missing:
+                    missing.append((res, ref))
+        return missing
+
+    def cycles(self):
+        # each dependsOn cycle as a list of the resources in it
+        cycles = []
+        state = {}
+        def visit(key, path):
+            state[key] = "visiting"
+            path.append(key)
+            for d in self.edges.get(key, []):
+                if d not in self.index:
+                    continue
+                if state.get(d) == "visiting":
+                    cycles.append([ self.index[k] for k in path[path.index(d):] ])
+                elif d not in state:
+                    visit(d, path)
+            path.pop()
+            state[key] = "done"
+        for res in self.resources:
+            key = _resource_key(res["type"], res["name"]).lower()
+            if key not in state:
+                visit(key, [])
+        return cycles
     
+    def _public_key(self, adminuser):
+        if self.sshkey is None:
+            with open(adminuser+"_id_rsa.pub") as f:
+                self.sshkey = f.read().strip()
+        return self.sshkey
+
     def _add_network(self, cfg):
         location = cfg["location"]
         vnet_name = cfg["vnet"]["name"]
@@ -43,14 +150,14 @@ class ArmTemplate:
                 "subnets": subnets
             }
         }
-        self.resources.append(res)
+        self._add_resource(res)
         
         resource_group = cfg["resource_group"]
         for peer_name in cfg["vnet"].get("peer", {}).keys():
             peer_resource_group = cfg["vnet"]["peer"][peer_name]["resource_group"]
             peer_vnet_name = cfg["vnet"]["peer"][peer_name]["vnet_name"]
 
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Network/virtualNetworks/virtualNetworkPeerings",
                 "apiVersion": "2019-11-01",
                 "name": f"{vnet_name}/{peer_name}-{peer_resource_group}",
@@ -68,7 +175,7 @@ class ArmTemplate:
                 ]
             })
 
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Resources/deployments",
                 "apiVersion": "2017-05-10",
                 "name": f"{peer_resource_group}peer",
@@ -109,7 +216,7 @@ class ArmTemplate:
         dns_domain = cfg["vnet"].get("dns_domain", None)
         if dns_domain:
             log.info(f"add private dns ({dns_domain})")
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Network/privateDnsZones",
                 "apiVersion": "2018-09-01",
                 "name": dns_domain,
@@ -141,7 +248,7 @@ class ArmTemplate:
 
             route_table_map[route_subnet] = route_name
 
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Network/routeTables",
                 "apiVersion": "2019-11-01",
                 "name": route_name,
@@ -163,7 +270,7 @@ class ArmTemplate:
                     f"Microsoft.Network/networkInterfaces/{route_next_hop}nic"
                 ]
             })
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Network/routeTables/routes",
                 "apiVersion": "2019-11-01",
                 "name": f"{route_name}/{route_name}",
@@ -177,7 +284,7 @@ class ArmTemplate:
                 }
             })
             subnet_address_prefix = cfg["vnet"]["subnets"][route_subnet]
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Network/virtualNetworks/subnets",
                 "apiVersion": "2019-11-01",
                 "name": f"{vnet_name}/{route_subnet}",
@@ -203,8 +310,7 @@ class ArmTemplate:
         vnetrg = cfg["vnet"].get("resource_group", rg)
         if rg == vnetrg:
             log.debug("adding delegation to subnet")
-            rvnet = next((x for x in self.resources if x["name"] == vnet), [])
-            rsubnet = next((x for x in rvnet["properties"]["subnets"] if x["name"] == subnet), None)
+            rsubnet = self.find("Microsoft.Network/virtualNetworks/subnets", vnet+"/"+subnet)
             if not rsubnet:
                 log.error("subnet ({}) for netapp storage ({}) does not exist".format(subnet, name))
                 sys.exit(1)
@@ -239,7 +345,7 @@ class ArmTemplate:
                 }
             ]
 
-        self.resources.append({
+        self._add_resource({
             "name": name,
             "type": "Microsoft.NetApp/netAppAccounts",
             "apiVersion": "2019-07-01",
@@ -253,7 +359,7 @@ class ArmTemplate:
             pool = account["pools"][poolname]
             poolsize = pool["size"]
             servicelevel = pool["service_level"]
-            self.resources.append({
+            self._add_resource({
                 "name": name+"/"+poolname,
                 "type": "Microsoft.NetApp/netAppAccounts/capacityPools",
                 "apiVersion": "2019-07-01",
@@ -293,13 +399,13 @@ class ArmTemplate:
                     netapp_volume["properties"]["protocolTypes"] = [ 
                         "CIFS"
                     ]
-                self.resources.append(netapp_volume)
+                self._add_resource(netapp_volume)
 
     def _add_proximity_group(self, cfg):
         ppg = cfg.get("proximity_placement_group_name", None)
         if ppg:
             loc = cfg["location"]
-            self.resources.append({
+            self._add_resource({
                 "apiVersion": "2018-04-01",
                 "type": "Microsoft.Compute/proximityPlacementGroups",
                 "name": ppg,
@@ -376,7 +482,7 @@ class ArmTemplate:
         rdatadisks = res.get("data_disks", [])
         rstoragesku = res.get("storage_sku", "StandardSSD_LRS")
         rstoragecache = res.get("storage_cache", "ReadWrite")
-        rtags = res.get("resource_tags", {})
+        rtags = dict(res.get("resource_tags", {}))
         loc = cfg["location"]
         adminuser = cfg["admin_user"]
         rrg = cfg["resource_group"]
@@ -387,44 +493,59 @@ class ArmTemplate:
         else:
             rsubnetid = "[resourceId('{}', 'Microsoft.Network/virtualNetworks/subnets', '{}', '{}')]".format(vnetrg, vnetname, rsubnet)
         rpassword = res.get("password", "<no-password>")
-        with open(adminuser+"_id_rsa.pub") as f:
-            sshkey = f.read().strip()
+        sshkey = self._public_key(adminuser)
         
         rorig = r
-        for instance in range(1, rinstances+1):    
-            if rinstances > 1:
-                r = "{}{:04}".format(rorig, instance)
+        if self.copy_loops and rinstances > 1:
+            # one of each resource in a copy loop, named as when unrolled
+            instances = [ None ]
+        else:
+            instances = range(1, rinstances+1)
+
+        for instance in instances:
+            if instance is None:
+                index = "padLeft(copyIndex(1), 4, '0')"
+                name = lambda suffix: f"[concat('{rorig}', {index}, '{suffix}')]"
+                ref = lambda rt, suffix: f"[resourceId('{rt}', concat('{rorig}', {index}, '{suffix}'))]"
+                dep = ref
+                loop = lambda what: { "copy": { "name": f"{rorig}-{what}", "count": rinstances } }
+            else:
+                if rinstances > 1:
+                    r = "{}{:04}".format(rorig, instance)
+                name = lambda suffix: r+suffix
+                ref = lambda rt, suffix: f"[resourceId('{rt}', '{r}{suffix}')]"
+                dep = lambda rt, suffix: f"{rt}/{r}{suffix}"
+                loop = lambda what: {}
 
             nicdeps = []
             if vnetrg == rrg:
                 nicdeps.append("Microsoft.Network/virtualNetworks/"+vnetname)
 
             if rpip:
-                pipname = r+"pip"
-                dnsname = r+str(uuid.uuid4())[:6]
-                nsgname = r+"nsg"
+                dnssuffix = str(uuid.uuid4())[:6]
 
-                nicdeps.append("Microsoft.Network/publicIpAddresses/"+pipname)
-                nicdeps.append("Microsoft.Network/networkSecurityGroups/"+nsgname)
+                nicdeps.append(dep("Microsoft.Network/publicIpAddresses", "pip"))
+                nicdeps.append(dep("Microsoft.Network/networkSecurityGroups", "nsg"))
 
-                self.resources.append({
+                self._add_resource({
                     "type": "Microsoft.Network/publicIPAddresses",
                     "apiVersion": "2018-01-01",
-                    "name": pipname,
+                    "name": name("pip"),
                     "location": loc,
                     "dependsOn": [],
                     "tags": {},
                     "properties": {
                         "dnsSettings": {
-                            "domainNameLabel": dnsname
+                            "domainNameLabel": name(dnssuffix)
                         }
-                    }
+                    },
+                    **loop("pip")
                 })
 
-                self.resources.append({
+                self._add_resource({
                     "type": "Microsoft.Network/networkSecurityGroups",
                     "apiVersion": "2015-06-15",
-                    "name": nsgname,
+                    "name": name("nsg"),
                     "location": loc,
                     "dependsOn": [],
                     "tags": {},
@@ -444,15 +565,14 @@ class ArmTemplate:
                                 }
                             }
                         ]
-                    }
+                    },
+                    **loop("nsg")
                 })
 
-            nicname = r+"nic"
-            ipconfigname = r+"ipconfig"
             nicprops = {
                 "ipConfigurations": [
                     {
-                        "name": ipconfigname,
+                        "name": name("ipconfig"),
                         "properties": {
                             "privateIPAllocationMethod": "Dynamic",
                             "subnet": {
@@ -466,34 +586,35 @@ class ArmTemplate:
 
             if rpip:
                 nicprops["ipConfigurations"][0]["properties"]["publicIPAddress"] = {
-                    "id": "[resourceId('Microsoft.Network/publicIPAddresses', '{}')]".format(pipname)
+                    "id": ref("Microsoft.Network/publicIPAddresses", "pip")
                 }
                 nicprops["networkSecurityGroup"] = {
-                    "id": "[resourceId('Microsoft.Network/networkSecurityGroups', '{}')]".format(nsgname)
+                    "id": ref("Microsoft.Network/networkSecurityGroups", "nsg")
                 }
 
-            self.resources.append({
+            self._add_resource({
                 "type": "Microsoft.Network/networkInterfaces",
                 "apiVersion": "2016-09-01",
-                "name": nicname,
+                "name": name("nic"),
                 "location": loc,
                 "dependsOn": nicdeps,
                 "tags": {},
-                "properties": nicprops
+                "properties": nicprops,
+                **loop("nic")
             })
 
-            osprofile = self.__helper_arm_create_osprofile(r, rtype, adminuser, rpassword, sshkey)
+            osprofile = self.__helper_arm_create_osprofile(name(""), rtype, adminuser, rpassword, sshkey)
             datadisks = self.__helper_arm_create_datadisks(rdatadisks, rstoragesku, rstoragecache)
             imageref = self.__helper_arm_create_image_reference(rimage)
 
-            deps = [ "Microsoft.Network/networkInterfaces/"+nicname ]
+            deps = [ dep("Microsoft.Network/networkInterfaces", "nic") ]
             if rppg:
-                deps.append("Microsoft.Compute/proximityPlacementGroups/"+rppgname)
+                deps.append(f"Microsoft.Compute/proximityPlacementGroups/{rppgname}")
 
             vmres = {
                 "type": "Microsoft.Compute/virtualMachines",
                 "apiVersion": "2019-07-01",
-                "name": r,
+                "name": name(""),
                 "location": loc,
                 "dependsOn": deps,
                 "tags": rtags,
@@ -504,7 +625,7 @@ class ArmTemplate:
                     "networkProfile": {
                         "networkInterfaces": [
                             {
-                                "id": "[resourceId('Microsoft.Network/networkInterfaces', '{}')]".format(nicname)
+                                "id": ref("Microsoft.Network/networkInterfaces", "nic")
                             }
                         ]
                     },
@@ -521,7 +642,8 @@ class ArmTemplate:
                         "dataDisks": datadisks
                     },
                     "osProfile": osprofile
-                }
+                },
+                **loop("vm")
             }
 
             if rlowpri:
@@ -533,7 +655,7 @@ class ArmTemplate:
                     "id": "[resourceId('Microsoft.Compute/proximityPlacementGroups','{}')]".format(rppgname)
                 }
             
-            self.resources.append(vmres)
+            self._add_resource(vmres)
 
     def _add_vmss(self, cfg, r):
         res = cfg["resources"][r]
@@ -556,7 +678,7 @@ class ArmTemplate:
         loc = cfg["location"]
         adminuser = cfg["admin_user"]
         rrg = cfg["resource_group"]
-        rtags = res.get("resource_tags", {})
+        rtags = dict(res.get("resource_tags", {}))
         vnetname = cfg["vnet"]["name"]
         vnetrg = cfg["vnet"].get("resource_group", rrg)
         if vnetrg == rrg:
@@ -564,14 +686,13 @@ class ArmTemplate:
         else:
             rsubnetid = "[resourceId('{}', 'Microsoft.Network/virtualNetworks/subnets', '{}', '{}')]".format(vnetrg, vnetname, rsubnet)
         rpassword = res.get("password", "<no-password>")
-        with open(adminuser+"_id_rsa.pub") as f:
-            sshkey = f.read().strip()
+        sshkey = self._public_key(adminuser)
 
         deps = []
         if vnetrg == rrg:
             deps.append("Microsoft.Network/virtualNetworks/"+vnetname)
         if rppg:
-            deps.append("Microsoft.Compute/proximityPlacementGroups/"+rppgname)
+            deps.append(f"Microsoft.Compute/proximityPlacementGroups/{rppgname}")
 
         osprofile = self.__helper_arm_create_osprofile(r, rtype, adminuser, rpassword, sshkey)
         datadisks = self.__helper_arm_create_datadisks(rdatadisks, rstoragesku, rstoragecache)
@@ -647,20 +768,25 @@ class ArmTemplate:
             vmssres["properties"]["virtualMachineProfile"]["priority"] = "Spot"
             vmssres["properties"]["virtualMachineProfile"]["evictionPolicy"] = "Delete"
 
-        self.resources.append(vmssres)
+        self._add_resource(vmssres)
+
 
+    def _add_group(self, group, fn, *args):
+        start = len(self.resources)
+        fn(*args)
+        self.groups.setdefault(group, []).extend(self.resources[start:])
 
     def read(self, cfg):
-        self._add_network(cfg)
-        self._add_proximity_group(cfg)
+        self._add_group("network", self._add_network, cfg)
+        self._add_group("network", self._add_proximity_group, cfg)
 
         resources = cfg.get("resources", {})
         for r in resources.keys():
             rtype = cfg["resources"][r]["type"]
             if rtype == "vm":
-                self._add_vm(cfg, r)
+                self._add_group(r, self._add_vm, cfg, r)
             elif rtype == "vmss":
-                self._add_vmss(cfg, r)
+                self._add_group(r, self._add_vmss, cfg, r)
             else:
                 log.error("unrecognised resource type ({}) for {}".format(rtype, r))
 
@@ -668,16 +794,169 @@ class ArmTemplate:
         for s in storage.keys():
             stype = cfg["storage"][s]["type"]
             if stype == "anf":
-                self._add_netapp(cfg, s)
+                self._add_group(s, self._add_netapp, cfg, s)
             else:
                 log.error("unrecognised storage type ({}) for {}".format(stype, s))
-        
-    def to_json(self):
-        return json.dumps({
+
+    def resource_hashes(self):
+        return collections.OrderedDict([
+            (_resource_key(res["type"], res["name"]), resource_hash(res))
+            for res in self.resources
+        ])
+
+    def skip(self, keys):
+        # Leaves out resources that are already deployed, anything depending
+        # on them is deployed on its own.  Returns the names of the resources
+        # and of the groups that are left out completely.
+        keys = set([ k.lower() for k in keys ])
+        keep = lambda res: _resource_key(res["type"], res["name"]).lower() not in keys
+        for res in self.resources:
+            if "dependsOn" in res:
+                res["dependsOn"] = [ d for d in res["dependsOn"] if (_dep_key(d) or "").lower() not in keys ]
+        skipped = [ res["name"] for res in self.resources if not keep(res) ]
+        self.resources = [ res for res in self.resources if keep(res) ]
+        self._reindex()
+        for group in list(self.groups.keys()):
+            self.groups[group] = [ res for res in self.groups[group] if keep(res) ]
+            if not self.groups[group]:
+                del self.groups[group]
+                skipped.append(group)
+        return skipped
+
+    def shards(self, max_resources=800):
+        # Splits the resources into deployments of at most max_resources
+        # (counting copy loops), the network first and then one or more for
+        # each group.  A VM is kept in the same shard as its nic, pip and nsg
+        # and network resources that depend on a VM (e.g. a route table with
+        # it as the next hop) go with it.  dependsOn to resources in another
+        # shard are dropped as the deployments themselves are ordered.
+        network = list(self.groups.get("network", []))
+        owner = {}
+        for group, resources in self.groups.items():
+            if group != "network":
+                for res in resources:
+                    owner[id(res)] = group
+        anchors = []
+        moved = True
+        while moved:
+            moved = False
+            for res in list(network):
+                dep = next((d for d in self.dependencies(res) if id(d) in owner), None)
+                if dep is not None:
+                    network.remove(res)
+                    owner[id(res)] = owner[id(dep)]
+                    anchors.append((res, dep))
+                    moved = True
+
+        shards = collections.OrderedDict()
+        if "network" in self.groups:
+            shards["network"] = network
+        for group, resources in self.groups.items():
+            if group == "network":
+                continue
+            units = [ [] ]
+            for res in resources:
+                units[-1].append(res)
+                if res["type"] == "Microsoft.Compute/virtualMachines":
+                    units.append([])
+            units = [ u for u in units if u ]
+            for res, dep in anchors:
+                for unit in units:
+                    if any([ r is dep for r in unit ]):
+                        unit.append(res)
+            parts = [ [] ]
+            for unit in units:
+                if parts[-1] and _count(parts[-1] + unit) > max_resources:
+                    parts.append([])
+                parts[-1].extend(unit)
+            for n, part in enumerate(parts):
+                shards[group if len(parts) == 1 else f"{group}-{n+1}"] = part
+
+        location = {}
+        for shard, resources in shards.items():
+            for res in resources:
+                location[_resource_key(res["type"], res["name"]).lower()] = shard
+        for shard, resources in shards.items():
+            shards[shard] = [
+                dict(res, dependsOn=[
+                    d for d in res["dependsOn"]
+                        if location.get((_dep_key(d) or "").lower(), shard) == shard
+                ]) if "dependsOn" in res else res
+                for res in resources
+            ]
+        return shards
+
+    def _template(self, resources):
+        return {
             "$schema": "https://schema.management.azure.com/schemas/2015-01-01/deploymentTemplate.json#",
             "contentVersion": "1.0.0.0",
             "parameters": self.parameters,
             "variables": self.variables,
-            "resources": self.resources,
+            "resources": resources,
             "outputs": self.outputs
-        }, indent=4)
\ No newline at end of file
+        }
+
+    def to_json(self, shard_size=0):
+        if not shard_size:
+            return json.dumps(self._template(self.resources), indent=4)
+
+        # each shard is a nested deployment named after the top level
+        # deployment and everything waits for the network
+        deployments = []
+        shards = self.shards(shard_size)
+        for shard, resources in shards.items():
+            deployments.append({
+                "type": "Microsoft.Resources/deployments",
+                "apiVersion": "2019-10-01",
+                "name": f"[concat(deployment().name, '-{shard}')]",
+                "properties": {
+                    "mode": "Incremental",
+                    "expressionEvaluationOptions": {
+                        "scope": "inner"
+                    },
+                    "template": self._template(resources)
+                },
+                "dependsOn": [] if shard == "network" or "network" not in shards else [
+                    "[resourceId('Microsoft.Resources/deployments', concat(deployment().name, '-network'))]"
+                ]
+            })
+        return json.dumps(self._template(deployments), indent=4)
+
+def resource_hash(res):
+    # the dns label for a public ip is random each time the template is
+    # created so it is not counted as a change
+    if res["type"] == "Microsoft.Network/publicIPAddresses" and "dnsSettings" in res.get("properties", {}):
+        res = dict(res, properties=dict(res["properties"], dnsSettings={}))
+    return hashlib.sha256(json.dumps(res, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _strings(value):
+    if isinstance(value, dict):
+        for v in value.values():
+            yield from _strings(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from _strings(v)
+    elif isinstance(value, str):
+        yield value
+
+def _count(resources):
+    return sum([ r.get("copy", {}).get("count", 1) for r in resources ])
+
+# types and names are not case sensitive in ARM so compare these lowercase
+def _resource_key(rtype, name):
+    return f"{rtype}/{name}"
+
+__resource_id = re.compile(r"^\[resourceId\(((?:'[^']*',\s*)*'[^']*')\)\]$")
+
+def _dep_key(dep):
+    # the type and name for a dependsOn entry, None when it is an expression
+    # or in another resource group
+    if not dep.startswith("["):
+        return dep
+    match = __resource_id.match(dep)
+    if not match:
+        return None
+    parts = re.findall(r"'([^']*)'", match.group(1))
+    if "/" not in parts[0]:
+        return None
+    return _resource_key(parts[0], "/".join(parts[1:]))
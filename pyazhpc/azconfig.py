@@ -1,21 +1,123 @@
 import json
 import logging
+import os
 import re
 import sys
+import threading
+import time
 
 import azutil
 
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
 log = logging.getLogger(__name__)
 
+resolver_threads = 8
+
+class ResolverCache:
+    # the azutil function used for each kind of lookup
+    resolvers = {
+        "secret": "get_keyvault_secret",
+        "storage_url": "get_storage_url",
+        "saskey": "get_storage_saskey",
+        "fqdn": "get_fqdn",
+        "sakey": "get_storage_key",
+        "laworkspace": "get_log_analytics_workspace",
+        "lakey": "get_log_analytics_key",
+        "acrkey": "get_acr_key"
+    }
+    # only values that are not secret may be written to disk
+    persistent_kinds = [ "fqdn", "storage_url", "laworkspace" ]
+
+    def __init__(self, fname=None, ttl=0):
+        self.fname = fname
+        self.ttl = ttl
+        self.values = {}
+        self.lock = threading.Lock()
+        self.stored = {}
+        if self.fname and self.ttl > 0:
+            self.__load()
+
+    def __key(self, kind, args):
+        return ".".join([ kind ] + [ str(a) for a in args ])
+
+    def __load(self):
+        if not os.path.exists(self.fname):
+            return
+        try:
+            with open(self.fname) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            log.warning(f"ignoring unreadable resolver cache ({self.fname})")
+            return
+        now = time.time()
+        for k, entry in entries.items():
+            if now - entry["time"] < self.ttl:
+                self.stored[k] = entry
+                self.values[k] = entry["value"]
+        log.debug(f"loaded {len(self.stored)} values from resolver cache ({self.fname})")
+
+    def __save(self):
+        try:
+            with open(self.fname, "w") as f:
+                json.dump(self.stored, f, indent=4)
+        except OSError:
+            log.warning(f"unable to write resolver cache ({self.fname})")
+
+    def has(self, kind, *args):
+        with self.lock:
+            return self.__key(kind, args) in self.values
+
+    def get(self, kind, *args):
+        k = self.__key(kind, args)
+        with self.lock:
+            if k in self.values:
+                log.debug(f"resolver cache hit: {kind}")
+                return self.values[k]
+
+        res = getattr(azutil, self.resolvers[kind])(*args)
+
+        with self.lock:
+            self.values[k] = res
+            if self.fname and self.ttl > 0 and kind in self.persistent_kinds:
+                self.stored[k] = { "value": res, "time": time.time() }
+                self.__save()
+        return res
+
+    def resolve_all(self, lookups, threads=resolver_threads):
+        todo = [ l for l in lookups if not self.has(*l) ]
+        if not todo:
+            return
+        log.debug(f"resolving {len(todo)} lookups with {min(threads, len(todo))} threads")
+        with ThreadPoolExecutor(max_workers=min(threads, len(todo))) as executor:
+            futures = [ executor.submit(self.get, *l) for l in todo ]
+            for f in futures:
+                f.result()
+
 class ConfigFile:
-    def __init__(self):
+    def __init__(self, cache=None):
         self.data = {}
         self.regex = re.compile(r'({{([^{}]*)}})')
+        if cache is None:
+            cache = ResolverCache()
+        self.cache = cache
+        # set of lookups found while collecting (None when not collecting)
+        self.lookups = None
+        self.__reset()
+
+    def __reset(self):
+        # evaluated variables and strings, filled as they are first used
+        self.variables = {}
+        self.values = {}
+        self.compiled = False
+        self.evaluating = []
 
     def open(self, fname):
         log.debug("opening "+fname)
         with open(fname) as f:
             self.data = json.load(f)
+        self.__reset()
     
     def save(self, fname):
         with open(fname, "w") as f:
@@ -33,6 +135,71 @@ class ConfigFile:
             for v in vdict.keys():
                 if v in self.data["variables"]:
                     self.data["variables"][v] = vdict[v]
+        self.__reset()
+
+    def __variable_refs(self, input, refs):
+        if type(input) == dict:
+            for x in input.values():
+                self.__variable_refs(x, refs)
+        elif type(input) == list:
+            for x in input:
+                self.__variable_refs(x, refs)
+        elif type(input) == str:
+            for x in [ input ] + [ m[1] for m in self.regex.findall(input) ]:
+                parts = x.split(".")
+                if parts[0] == "variables" and len(parts) > 1:
+                    refs.add(parts[1])
+
+    def __compile(self):
+        # build the dependency graph between variables and check for cycles
+        # before anything is evaluated
+        variables = self.data.get("variables", {})
+        graph = {}
+        for name in variables.keys():
+            refs = set()
+            self.__variable_refs(variables[name], refs)
+            graph[name] = sorted([ r for r in refs if r in variables ])
+
+        done = set()
+        for start in graph.keys():
+            if start in done:
+                continue
+            path = [ start ]
+            stack = [ iter(graph[start]) ]
+            while stack:
+                nxt = next(stack[-1], None)
+                if nxt is None:
+                    done.add(path.pop())
+                    stack.pop()
+                elif nxt in path:
+                    cycle = path[path.index(nxt):] + [ nxt ]
+                    log.error("circular reference in variables: " + " -> ".join(cycle))
+                    sys.exit(1)
+                elif nxt not in done:
+                    path.append(nxt)
+                    stack.append(iter(graph[nxt]))
+        self.compiled = True
+
+    def __read_variable(self, name):
+        if not self.compiled:
+            self.__compile()
+        if name in self.variables:
+            return self.variables[name]
+        if name in self.evaluating:
+            # only possible with references built from other values
+            cycle = self.evaluating[self.evaluating.index(name):] + [ name ]
+            log.error("circular reference in variables: " + " -> ".join(cycle))
+            sys.exit(1)
+
+        self.evaluating.append(name)
+        try:
+            it = self.data["variables"][name]
+            if type(it) is str:
+                it = self.__process_value(it)
+        finally:
+            self.evaluating.pop()
+        self.variables[name] = it
+        return it
 
     def __evaluate_dict(self, x):
         ret = {}
@@ -53,10 +220,47 @@ class ConfigFile:
         else:
             return input
 
+    # stands in for lookups while they are being collected, lookups that use
+    # it (i.e. depend on another lookup) are left to be resolved when the
+    # value is evaluated
+    pending = "<azhpc-pending-lookup>"
+
+    def __lookup(self, kind, *args):
+        if self.lookups is not None:
+            if not any([ self.pending in str(a) for a in args ]):
+                self.lookups.add((kind,) + args)
+            return self.pending
+        return self.cache.get(kind, *args)
+
+    def prefetch(self, input=None):
+        if input is None:
+            input = self.data
+        # values evaluated while collecting contain placeholders so keep
+        # them apart from the real ones
+        saved = self.variables, self.values
+        self.variables, self.values = {}, {}
+        self.lookups = set()
+        try:
+            self.__evaluate(input)
+            lookups = self.lookups
+        finally:
+            self.lookups = None
+            self.variables, self.values = saved
+        self.cache.resolve_all(sorted(lookups))
+
     def preprocess(self):
+        self.prefetch()
         res = self.__evaluate(self.data)
         return res
 
+    def lazy(self):
+        return LazyConfig(self, self.data)
+
+    def evaluate_value(self, v):
+        if type(v) is str:
+            return self.__process_value(v)
+        return v
+
     def read_keys(self, v):
         log.debug("read_keys (enter): " + v)
 
@@ -79,6 +283,12 @@ class ConfigFile:
         log.debug("read_value (enter): " + v)
 
         try:
+            parts = v.split('.')
+            if len(parts) == 2 and parts[0] == "variables":
+                res = self.__read_variable(parts[1])
+                log.debug("read_value (exit): "+v+"="+str(res))
+                return res
+
             it = self.data
             for x in v.split('.'):
                 it = it[x]
@@ -100,11 +310,11 @@ class ConfigFile:
         return res
 
     def __process_value(self, v):
+        if v in self.values:
+            return self.values[v]
+        orig = v
         log.debug("process_value (enter): "+str(v))
 
-        def repl(match):
-            return str(self.__process_value(match.group()[2:-2]))
-    
         v = self.regex.sub(lambda m: str(self.__process_value(m.group()[2:-2])), v)
         
         parts = v.split('.')
@@ -113,37 +323,111 @@ class ConfigFile:
         if prefix == "variables":
             res = self.read_value(v)
         elif prefix == "secret":
-            res = azutil.get_keyvault_secret(parts[1], parts[2])
+            res = self.__lookup("secret", parts[1], parts[2])
         elif prefix == "sasurl":
             log.debug(parts)
-            url = azutil.get_storage_url(parts[1])
+            url = self.__lookup("storage_url", parts[1])
             x = parts[-1].split(",")
             if len(x) == 1:
                 perm = "r"
             else:
                 perm = x[1]
                 parts[-1] = x[0]
-            saskey = azutil.get_storage_saskey(parts[1], parts[2], perm)
+            saskey = self.__lookup("saskey", parts[1], parts[2], perm)
             log.debug(parts)
             path = ".".join(parts[2:])
             res = f"{url}{path}?{saskey}"
         elif prefix == "fqdn":
-            res = azutil.get_fqdn(self.read_value("resource_group"), parts[1]+"pip")
+            res = self.__lookup("fqdn", self.read_value("resource_group"), parts[1]+"pip")
         elif prefix == "sakey":
-            res = azutil.get_storage_key(parts[1])
+            res = self.__lookup("sakey", parts[1])
         elif prefix == "saskey":
             x = parts[2].split(",")
             if len(x) == 1:
                 x.append("r")
-            res = azutil.get_storage_saskey(parts[1], x[0], x[1])
+            res = self.__lookup("saskey", parts[1], x[0], x[1])
         elif prefix == "laworkspace":
-            res = azutil.get_log_analytics_workspace(parts[1], parts[2])
+            res = self.__lookup("laworkspace", parts[1], parts[2])
         elif prefix == "lakey":
-            res = azutil.get_log_analytics_key(parts[1], parts[2])
+            res = self.__lookup("lakey", parts[1], parts[2])
         elif prefix == "acrkey":
-            res = azutil.get_acr_key(parts[1])
+            res = self.__lookup("acrkey", parts[1])
         else:
             res = v
         
         log.debug("process_value (exit): "+str(v)+"="+str(res))
+        self.values[orig] = res
         return res
+
+def _lazy_item(config, children, key, value):
+    if key not in children:
+        if type(value) == dict:
+            children[key] = LazyConfig(config, value)
+        elif type(value) == list:
+            children[key] = LazyList(config, value)
+        else:
+            children[key] = config.evaluate_value(value)
+    return children[key]
+
+def raw_value(value):
+    # a plain copy of a config value as written, without evaluating any
+    # macros (so it is the same each time, e.g. for hashing)
+    if isinstance(value, (LazyConfig, LazyList)):
+        return value.data
+    if isinstance(value, dict):
+        return { k: raw_value(v) for k, v in value.items() }
+    if isinstance(value, list):
+        return [ raw_value(v) for v in value ]
+    return value
+
+# A read-only view of the config where macros are only evaluated when a
+# value is accessed.
+class LazyConfig(Mapping):
+    def __init__(self, config, data):
+        self.config = config
+        self.data = data
+        self.children = {}
+
+    def __getitem__(self, key):
+        return _lazy_item(self.config, self.children, key, self.data[key])
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def prefetch(self, *keys):
+        # resolve all the lookups below keys in parallel (all if not given)
+        if not keys:
+            keys = self.data.keys()
+        self.config.prefetch([ self.data[k] for k in keys if k in self.data ])
+
+class LazyList(Sequence):
+    def __init__(self, config, data):
+        self.config = config
+        self.data = data
+        self.children = {}
+
+    def __getitem__(self, idx):
+        if type(idx) == slice:
+            return [ self[i] for i in range(len(self.data))[idx] ]
+        if idx < 0:
+            idx += len(self.data)
+        return _lazy_item(self.config, self.children, idx, self.data[idx])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
@@ -0,0 +1,152 @@
+import collections
+import json
+import logging
+import os
+import time
+
+import azutil
+
+log = logging.getLogger(__name__)
+
+# A resource in the deployment moving from one state to another (old is
+# None the first time the resource is seen)
+StatusChange = collections.namedtuple(
+    "StatusChange",
+    [ "resource_name", "resource_type", "old", "new", "status_code" ]
+)
+
+# nested is the names of the deployments started by this one (e.g. the
+# shards) and their resources are followed as well once they appear
+class DeploymentWatcher:
+    def __init__(self, resource_group, deployname, min_interval=2, max_interval=30, nested=()):
+        self.resource_group = resource_group
+        self.deployname = deployname
+        self.nested = nested
+        self.children = collections.OrderedDict()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.states = {}
+        self.operations = {}
+        self.finished = False
+        self.success = True
+
+    def poll(self):
+        changes = []
+        res = azutil.get_deployment_status(self.resource_group, self.deployname)
+        for op in res:
+            props = op["properties"]
+            if not props.get("targetResource", None):
+                # the deployment itself is only listed when it has completed
+                self.finished = True
+                if props["provisioningState"] != "Succeeded":
+                    self.success = False
+                continue
+
+            key = op.get("operationId", props["targetResource"]["id"])
+            self.operations[key] = op
+            state = props["provisioningState"]
+            status_code = props.get("statusCode", "")
+            old = self.states.get(key, None)
+            if old != state:
+                self.states[key] = state
+                changes.append(StatusChange(
+                    props["targetResource"]["resourceName"],
+                    props["targetResource"]["resourceType"],
+                    old, state, status_code
+                ))
+                if state == "Failed":
+                    self.success = False
+
+            name = props["targetResource"]["resourceName"]
+            if name in self.nested and name not in self.children:
+                self.children[name] = DeploymentWatcher(self.resource_group, name)
+
+        # the nested deployments finish before this one so their last
+        # changes are seen in the same poll
+        for child in self.children.values():
+            changes.extend(child.poll())
+            if not child.success:
+                self.success = False
+        return changes
+
+    def watch(self, callback=None):
+        # yields the changes as they are seen, polling more often while
+        # things are changing and backing off when they are not
+        while not self.finished:
+            time.sleep(self.interval)
+            changes = self.poll()
+            if changes:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 1.5, self.max_interval)
+            log.debug(f"{len(changes)} changes, next poll in {self.interval:0.1f}s")
+            for c in changes:
+                if callback:
+                    callback(c)
+                yield c
+
+    def resource_states(self):
+        states = {
+            op["properties"]["targetResource"]["resourceName"]: self.states[k]
+            for k, op in self.operations.items()
+        }
+        for child in self.children.values():
+            states.update(child.resource_states())
+        return states
+
+    def errors(self):
+        errors = []
+        for op in self.operations.values():
+            props = op["properties"]
+            error = props.get("statusMessage", None)
+            if isinstance(error, dict) and "error" in error:
+                errors.append({
+                    "resource_name": props["targetResource"]["resourceName"],
+                    "code": error["error"]["code"],
+                    "target": error["error"].get("target", None),
+                    "message": error["error"]["message"]
+                })
+        for child in self.children.values():
+            errors.extend(child.errors())
+        return errors
+
+# The resources (by type/name) that are new, changed, the same or no longer
+# in the template compared to the last deployment
+Plan = collections.namedtuple(
+    "Plan",
+    [ "added", "changed", "unchanged", "removed" ]
+)
+
+def plan(deployed, hashes):
+    # deployed and hashes map each resource to the hash of its definition
+    return Plan(
+        [ k for k in hashes.keys() if k not in deployed ],
+        [ k for k in hashes.keys() if k in deployed and deployed[k] != hashes[k] ],
+        [ k for k in hashes.keys() if deployed.get(k, None) == hashes[k] ],
+        [ k for k in deployed.keys() if k not in hashes ]
+    )
+
+def print_plan(p):
+    for k in p.added:
+        print(f"  + {k}")
+    for k in p.changed:
+        print(f"  ~ {k}")
+    for k in p.removed:
+        print(f"  - {k} (not in the config, left in place)")
+    print(f"{len(p.added)} to add, {len(p.changed)} to change, {len(p.unchanged)} unchanged")
+
+def deployed_file(tmpdir):
+    return f"{tmpdir}/deployed.json"
+
+def load_deployed(tmpdir):
+    fname = deployed_file(tmpdir)
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+def save_deployed(tmpdir, resource_group, hashes):
+    os.makedirs(tmpdir, exist_ok=True)
+    with open(deployed_file(tmpdir), "w") as f:
+        json.dump({ "resource_group": resource_group, "resources": hashes }, f, indent=4)
@@ -10,8 +10,13 @@ import time
 
 import arm
 import azconfig
+import azdeploy
 import azinstall
+import azinventory
+import azssh
+import aztelemetry
 import azutil
+import azvalidate
 
 from cryptography.hazmat.primitives import serialization as crypto_serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
@@ -19,15 +24,54 @@ from cryptography.hazmat.backends import default_backend as crypto_default_backe
 
 log = logging.getLogger(__name__)
 
-def do_preprocess(args):
-    log.debug("reading config file ({})".format(args.config_file))
-    config = azconfig.ConfigFile()
+def _open_config(args):
+    log.debug(f"reading config file ({args.config_file})")
+    if args.cache_ttl > 0:
+        cache = azconfig.ResolverCache(".azhpc_cache.json", args.cache_ttl)
+    else:
+        cache = azconfig.ResolverCache()
+    config = azconfig.ConfigFile(cache)
     config.open(args.config_file)
+    return config
+
+def _get_tmpdir(config_file):
+    return "azhpc_install_" + os.path.basename(config_file).strip(".json")
+
+def _get_inventory(args, resource_group, jumpbox, vmss=(), hosts=False):
+    # use the inventory written by build unless it is missing, out of date
+    # for the scale sets needed or a refresh is requested
+    tmpdir = _get_tmpdir(args.config_file)
+    fname = f"{tmpdir}/inventory.json"
+    old = None
+    if os.path.exists(fname):
+        old = azinventory.load(fname)
+        if old.resource_group != resource_group:
+            old = None
+        elif not args.refresh and all([ v in old.vmss for v in vmss ]):
+            return old
+
+    if vmss or hosts or os.path.isdir(tmpdir):
+        inventory = azinventory.query(resource_group)
+    else:
+        # only the install node is needed and there is nowhere to save it
+        inventory = azinventory.Inventory(resource_group)
+    inventory.fqdn = azutil.get_fqdn(resource_group, jumpbox+"pip")
+    if old:
+        inventory.tags = old.tags
+        inventory.resources = old.resources
+        for r in inventory.resources.keys():
+            if r in inventory.vmss:
+                inventory.resources[r] = inventory.vmss_instances(r)
+    if os.path.isdir(tmpdir):
+        inventory.save(fname)
+    return inventory
+
+def do_preprocess(args):
+    config = _open_config(args)
     print(json.dumps(config.preprocess(), indent=4))
 
 def do_get(args):
-    config = azconfig.ConfigFile()
-    config.open(args.config_file)
+    config = _open_config(args)
     val = config.read_value(args.path)
     print(f"{args.path} = {val}")
 
@@ -103,9 +147,7 @@ def do_init(args):
                         config.save(os.path.join(root, name))
 
 def do_scp(args):
-    log.debug("reading config file ({})".format(args.config_file))
-    c = azconfig.ConfigFile()
-    c.open(args.config_file)
+    c = _open_config(args)
     
     adminuser = c.read_value("admin_user")
     sshkey="{}_id_rsa".format(adminuser)
@@ -113,7 +155,7 @@ def do_scp(args):
 
     jumpbox = c.read_value("install_from")
     rg = c.read_value("resource_group")
-    fqdn = azutil.get_fqdn(rg, jumpbox+"pip")
+    fqdn = _get_inventory(args, rg, jumpbox).fqdn
 
     if args.args and args.args[0] == "--":
         scp_args = args.args[1:]
@@ -122,19 +164,15 @@ def do_scp(args):
 
     scp_exe = "scp"
     scp_cmd = [
-            scp_exe, "-q",
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null",
-            "-i", sshkey,
-            "-o", f"ProxyCommand=ssh -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i {sshkey} -W %h:%p {adminuser}@{fqdn}"
+            scp_exe, "-q"
+        ] + azssh.ssh_options(sshkey) + [
+            "-o", azssh.proxy_command(sshkey, f"{adminuser}@{fqdn}")
         ] + scp_args
     log.debug(" ".join([ f"'{a}'" for a in scp_cmd ]))
     os.execvp(scp_exe, scp_cmd)
 
 def do_connect(args):
-    log.debug("reading config file ({})".format(args.config_file))
-    c = azconfig.ConfigFile()
-    c.open(args.config_file)
+    c = _open_config(args)
     
     adminuser = c.read_value("admin_user")
     ssh_private_key="{}_id_rsa".format(adminuser)
@@ -147,15 +185,20 @@ def do_connect(args):
 
     jumpbox = c.read_value("install_from")
     resource_group = c.read_value("resource_group")
-    fqdn = azutil.get_fqdn(resource_group, jumpbox+"pip")
 
-    if fqdn == "":
-        log.warning(f"The install node does not have a public IP - trying hostname ({jumpbox})")
- 
     log.debug("Getting resource name")
 
     rtype = c.read_value(f"resources.{args.resource}.type", "hostname")
 
+    vmss = []
+    if rtype == "vmss":
+        vmss.append(args.resource)
+    inventory = _get_inventory(args, resource_group, jumpbox, vmss)
+    fqdn = inventory.fqdn
+
+    if fqdn == "":
+        log.warning(f"The install node does not have a public IP - trying hostname ({jumpbox})")
+
     target = args.resource
 
     if rtype == "vm":
@@ -166,7 +209,7 @@ def do_connect(args):
             log.info(f"Multiple instances of {args.resource}, connecting to {target}")
     
     elif rtype == "vmss":
-        vmssnodes = azutil.get_vmss_instances(resource_group, args.resource)
+        vmssnodes = inventory.vmss_instances(args.resource)
         if len(vmssnodes) == 0:
             log.error("There are no instances in the vmss")
             sys.exit(1)
@@ -189,10 +232,8 @@ def do_connect(args):
     if args.resource == jumpbox:
         log.info("logging directly into {}".format(fqdn))
         ssh_args = [
-            "ssh", "-t", "-q", 
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null",
-            "-i", ssh_private_key,
+            "ssh", "-t", "-q"
+        ] + azssh.ssh_options(ssh_private_key) + [
             f"{sshuser}@{fqdn}"
         ]
         log.debug(" ".join(ssh_args + cmdline))
@@ -200,51 +241,58 @@ def do_connect(args):
     else:
         log.info("logging in to {} (via {})".format(target, fqdn))
         ssh_args = [
-            ssh_exe, "-t", "-q",
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null",
-            "-i", ssh_private_key,
-            "-o", f"ProxyCommand=ssh -i {ssh_private_key} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -W %h:%p {sshuser}@{fqdn}",
+            ssh_exe, "-t", "-q"
+        ] + azssh.ssh_options(ssh_private_key) + [
+            "-o", azssh.proxy_command(ssh_private_key, f"{sshuser}@{fqdn}"),
             f"{sshuser}@{target}"
         ]
         log.debug(" ".join(ssh_args + cmdline))
         os.execvp(ssh_exe, ssh_args + cmdline)
 
-def _exec_command(fqdn, sshuser, sshkey, cmdline):
-    ssh_exe = "ssh"
-    ssh_args = [
-        ssh_exe, "-q", 
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/dev/null",
-        "-i", sshkey,
-        f"{sshuser}@{fqdn}"
-    ]
-    log.debug(" ".join(ssh_args + [ cmdline ]))
-    os.execvp(ssh_exe, ssh_args + [ cmdline ])
-
 def do_status(args):
-    log.debug("reading config file ({})".format(args.config_file))
-    c = azconfig.ConfigFile()
-    c.open(args.config_file)
+    c = _open_config(args)
     
     adminuser = c.read_value("admin_user")
     ssh_private_key="{}_id_rsa".format(adminuser)
 
     jumpbox = c.read_value("install_from")
     resource_group = c.read_value("resource_group")
-    fqdn = azutil.get_fqdn(resource_group, jumpbox+"pip")
+    inventory = _get_inventory(args, resource_group, jumpbox, hosts=True)
+    fqdn = inventory.fqdn
 
     if fqdn == "":
         log.warning("The install node does not have a public IP - trying hostname ({})".format(jumpbox))
 
-    tmpdir = "azhpc_install_" + os.path.basename(args.config_file).strip(".json")
-    _exec_command(fqdn, adminuser, ssh_private_key, f"pssh -h {tmpdir}/hostlists/linux -i -t 0 'printf \"%-20s%s\n\" \"$(hostname)\" \"$(uptime)\"' | grep -v SUCCESS")
+    stopped = inventory.not_running()
+    if stopped:
+        asof = datetime.datetime.fromtimestamp(inventory.timestamp).strftime("%Y-%m-%d %H:%M:%S")
+        log.warning(f"Resources not running (as of {asof}): " + ", ".join([ f"{h} ({inventory.power_state(h)})" for h in stopped ]))
 
+    tmpdir = _get_tmpdir(args.config_file)
+    hosts = azinstall._read_hostlist(f"{tmpdir}/hostlists/linux")
+    if not hosts:
+        log.error(f"no hosts found in {tmpdir}/hostlists/linux (has the install been run?)")
+        sys.exit(1)
+    pssh = azssh.ParallelSsh(azssh.SshTransport(adminuser, ssh_private_key, f"{adminuser}@{fqdn}"), args.fanout)
+    results = pssh.run(hosts, "uptime")
+    for h, r in results.items():
+        if r.returncode == 0:
+            print(f"{h:20}{r.stdout.strip()}")
+        else:
+            status = "timed out" if r.returncode is None else r.stderr.strip()
+            print(f"{h:20}unreachable ({status})")
+
+
+def do_install_report(args):
+    tmpdir = _get_tmpdir(args.config_file)
+    records = aztelemetry.load(tmpdir)
+    if not records:
+        log.error(f"no install telemetry found in {aztelemetry.telemetry_file(tmpdir)}")
+        sys.exit(1)
+    print(aztelemetry.report(records, args.top))
 
 def do_run(args):
-    log.debug("reading config file ({})".format(args.config_file))
-    c = azconfig.ConfigFile()
-    c.open(args.config_file)
+    c = _open_config(args)
     
     adminuser = c.read_value("admin_user")
     ssh_private_key="{}_id_rsa".format(adminuser)
@@ -257,47 +305,47 @@ def do_run(args):
 
     jumpbox = c.read_value("install_from")
     resource_group = c.read_value("resource_group")
-    fqdn = azutil.get_fqdn(resource_group, jumpbox+"pip")
-
-    if fqdn == "":
-        log.warning("The install node does not have a public IP - trying hostname ({})".format(jumpbox))
 
-    hosts = []
+    nodes = []
+    vmss = []
     if args.nodes:
-        for r in args.nodes.split(" "):
+        nodes = args.nodes.split(" ")
+        for r in nodes:
             rtype = c.read_value(f"resources.{r}.type", None)
             if not rtype:
                 log.error(f"resource {r} does not exist in config")
                 sys.exit(1)
-            if rtype == "vm":
-                instances = c.read_value(f"resources.{r}.instances", 1)
-                if instances == 1:
-                    hosts.append(r)
-                else:
-                    hosts += [ f"{r}{n:04}" for n in range(1, instances+1) ]            
-            elif rtype == "vmss":
-                hosts += azutil.get_vmss_instances(c.read_value("resource_group"), r)
-        
+            if rtype == "vmss":
+                vmss.append(r)
+    inventory = _get_inventory(args, resource_group, jumpbox, vmss)
+    fqdn = inventory.fqdn
+
+    if fqdn == "":
+        log.warning("The install node does not have a public IP - trying hostname ({})".format(jumpbox))
+
+    hosts = []
+    for r in nodes:
+        rtype = c.read_value(f"resources.{r}.type")
+        if rtype == "vm":
+            instances = c.read_value(f"resources.{r}.instances", 1)
+            if instances == 1:
+                hosts.append(r)
+            else:
+                hosts += [ f"{r}{n:04}" for n in range(1, instances+1) ]            
+        elif rtype == "vmss":
+            hosts += inventory.vmss_instances(r)
+
     if not hosts:
         hosts.append(jumpbox)
 
-    hostlist = " ".join(hosts)
     cmd = " ".join(args.args)
-    _exec_command(fqdn, sshuser, ssh_private_key, f"pssh -H '{hostlist}' -i -t 0 '{cmd}'")
-
-def do_build(args):
-    log.debug(f"reading config file ({args.config_file})")
-    tmpdir = "azhpc_install_" + os.path.basename(args.config_file).strip(".json")
-    log.debug(f"tmpdir = {tmpdir}")
-    if os.path.isdir(tmpdir):
-        log.debug("removing existing tmp directory")
-        shutil.rmtree(tmpdir)
-
-    c = azconfig.ConfigFile()
-    c.open(args.config_file)
-    config = c.preprocess()
+    pssh = azssh.ParallelSsh(azssh.SshTransport(sshuser, ssh_private_key, f"{sshuser}@{fqdn}"), args.fanout)
+    results = pssh.run(hosts, cmd)
+    azssh.print_results(results)
+    if azssh.failed(results):
+        sys.exit(1)
 
-    adminuser = config["admin_user"]
+def _create_keys(adminuser):
     private_key_file = adminuser+"_id_rsa"
     public_key_file = adminuser+"_id_rsa.pub"
     if not (os.path.exists(private_key_file) and os.path.exists(public_key_file)):
@@ -321,105 +369,165 @@ def do_build(args):
         with open(public_key_file, "wb") as f:
             os.chmod(public_key_file, 0o644)
             f.write(public_key+b'\n')
+    return private_key_file, public_key_file
 
-    tpl = arm.ArmTemplate()
+def do_build(args):
+    tmpdir = _get_tmpdir(args.config_file)
+    log.debug(f"tmpdir = {tmpdir}")
+    # keep the record of completed install steps so a rerun can resume
+    journal = None
+    if args.reinstall:
+        journal = {}
+    elif os.path.isdir(tmpdir):
+        journal = azinstall.load_journal(tmpdir)
+    # and the resources deployed last time, only changes are deployed
+    deployed = None
+    if not args.redeploy and os.path.isdir(tmpdir):
+        deployed = azdeploy.load_deployed(tmpdir)
+    if os.path.isdir(tmpdir) and not args.plan:
+        log.debug("removing existing tmp directory")
+        shutil.rmtree(tmpdir)
+
+    azinstall.executor = args.executor
+    azinstall.stream_output = args.stream_output
+    c = _open_config(args)
+    config = c.lazy()
+    # only resolve what is needed for the deployment now, the install
+    # steps are resolved when the install scripts are generated
+    config.prefetch(*[ k for k in config.keys() if k not in [ "install", "variables" ] ])
+
+    adminuser = config["admin_user"]
+    private_key_file, public_key_file = _create_keys(adminuser)
+
+    tpl = arm.ArmTemplate(args.copy_loops)
     tpl.read(config)
 
-    log.info("writing out arm template to " + args.output_template)
-    with open(args.output_template, "w") as f:
-        f.write(tpl.to_json())
-
-    log.info("creating resource group " + config["resource_group"])
-
-    resource_tags = config.get("resource_tags", {})
-    azutil.create_resource_group(
-        config["resource_group"],
-        config["location"],
-        [
-            {
-                "key": "CreatedBy",
-                "value": os.getenv("USER")
-            },
-            {
-                "key": "CreatedOn",
-                "value": datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-            }
-        ] + [ { "key": key, "value": resource_tags[key] } for key in resource_tags.keys() ]
-    )
-    log.info("deploying arm template")
-    deployname = azutil.deploy(
-        config["resource_group"],
-        args.output_template
-    )
-    log.debug(f"deployment name: {deployname}")
-
-    building = True
-    success = True
-    del_lines = 1
-    while building:
-        time.sleep(5)
-        res = azutil.get_deployment_status(config["resource_group"], deployname)
-        log.debug(res)
-        
-        print("\033[F"*del_lines)
-        del_lines = 1
-
-        for i in res:
-            props = i["properties"]
-            status_code = props["statusCode"]
-            if props.get("targetResource", None):
-                resource_name = props["targetResource"]["resourceName"]
-                resource_type = props["targetResource"]["resourceType"]
-                del_lines += 1
-                print(f"{resource_name:15} {resource_type:47} {status_code:15}")
-            else:
-                provisioning_state = props["provisioningState"]
-                del_lines += 1
-                building = False
-                if provisioning_state != "Succeeded":
-                    success = False
-
-    if success:
-        log.info("Provising succeeded")
+    hashes = tpl.resource_hashes()
+    last = {}
+    if deployed and deployed["resource_group"] == config["resource_group"]:
+        last = deployed["resources"]
+    plan = azdeploy.plan(last, hashes)
+    if args.plan:
+        azdeploy.print_plan(plan)
+        return
+    skipped = tpl.skip(plan.unchanged)
+
+    jumpbox = config.get("install_from", None)
+    if plan.added or plan.changed:
+        log.info("writing out arm template to " + args.output_template)
+        with open(args.output_template, "w") as f:
+            f.write(tpl.to_json(args.shard_size))
+
+        log.info("creating resource group " + config["resource_group"])
+
+        resource_tags = config.get("resource_tags", {})
+        azutil.create_resource_group(
+            config["resource_group"],
+            config["location"],
+            [
+                {
+                    "key": "CreatedBy",
+                    "value": os.getenv("USER")
+                },
+                {
+                    "key": "CreatedOn",
+                    "value": datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+                }
+            ] + [ { "key": key, "value": resource_tags[key] } for key in resource_tags.keys() ]
+        )
+        log.info("deploying arm template")
+        deployname = azutil.deploy(
+            config["resource_group"],
+            args.output_template
+        )
+        log.debug(f"deployment name: {deployname}")
+
+        def print_change(change):
+            log.debug(change)
+            print(f"{change.resource_name:15} {change.resource_type:47} {change.new:15}")
+
+        nested = []
+        if args.shard_size:
+            nested = [ f"{deployname}-{shard}" for shard in tpl.shards(args.shard_size).keys() ]
+            log.info(f"deploying in {len(nested)} shards")
+        watcher = azdeploy.DeploymentWatcher(config["resource_group"], deployname, nested=nested)
+        if args.pipeline and jumpbox:
+            log.info("running install scripts as resources are deployed")
+            config.prefetch("install")
+            inventory = azinstall.run_pipelined(config, tmpdir, adminuser, private_key_file, public_key_file, watcher, print_change, skipped, journal, args.reinstall)
+            if inventory:
+                azdeploy.save_deployed(tmpdir, config["resource_group"], dict(last, **hashes))
+                inventory.save(f"{tmpdir}/inventory.json")
+                return
+        else:
+            for change in watcher.watch(print_change):
+                pass
+
+        if watcher.success:
+            log.info("Provising succeeded")
+            azdeploy.save_deployed(tmpdir, config["resource_group"], dict(last, **hashes))
+        else:
+            log.error("Provisioning failed")
+            for error in watcher.errors():
+                error_message = textwrap.TextWrapper(width=60).wrap(text=error["message"])
+                error_target_str = ""
+                if error["target"]:
+                    error_target_str = f"({error['target']})"
+                print(f"  Resource : {error['resource_name']} - {error['code']} {error_target_str}")
+                print(f"  Message  : {error_message[0]}")
+                for line in error_message[1:]:
+                    print(f"             {line}")
+            if last:
+                azdeploy.save_deployed(tmpdir, config["resource_group"], last)
+            sys.exit(1)
     else:
-        log.error("Provisioning failed")
-        for i in res:
-            props = i["properties"]
-            status_code = props["statusCode"]
-            if props.get("targetResource", None):
-                resource_name = props["targetResource"]["resourceName"]
-                if props.get("statusMessage", None):
-                    if "error" in props["statusMessage"]:
-                        error_code = props["statusMessage"]["error"]["code"]
-                        error_message = textwrap.TextWrapper(width=60).wrap(text=props["statusMessage"]["error"]["message"])
-                        error_target = props["statusMessage"]["error"].get("target", None)
-                        error_target_str = ""
-                        if error_target:
-                            error_target_str = f"({error_target})"
-                        print(f"  Resource : {resource_name} - {error_code} {error_target_str}")
-                        print(f"  Message  : {error_message[0]}")
-                        for line in error_message[1:]:
-                            print(f"             {line}")
-        sys.exit(1)
-    
+        log.info(f"no changes to deploy, {len(plan.unchanged)} resources unchanged")
+        # the install directory was cleared so keep the record for next time
+        azdeploy.save_deployed(tmpdir, config["resource_group"], dict(last, **hashes))
+
     log.info("building host lists")
-    azinstall.generate_hostlists(config, tmpdir)
+    inventory = azinventory.query(config["resource_group"])
+    inventory.resources, inventory.tags = azinstall.generate_hostlists(config, tmpdir, inventory)
     log.info("building install scripts")
+    config.prefetch("install")
     azinstall.generate_install(config, tmpdir, adminuser, private_key_file, public_key_file)
     
-    jumpbox = config.get("install_from", None)
     fqdn = None
     if jumpbox:
         fqdn = azutil.get_fqdn(config["resource_group"], jumpbox+"pip")
+    inventory.fqdn = fqdn
+    inventory.save(f"{tmpdir}/inventory.json")
+
+    if jumpbox:
         log.info("running install scripts")
-        azinstall.run(config, tmpdir, adminuser, private_key_file, public_key_file, fqdn)
+        azinstall.run(config, tmpdir, adminuser, private_key_file, public_key_file, fqdn, args.install_concurrency, journal, args.reinstall)
     else:
         log.info("nothing to install ('install_from' is not set)")
 
+def do_validate(args):
+    # everything azure would be asked is answered with a placeholder
+    azutil.set_backend("offline")
+    c = azconfig.ConfigFile(azconfig.ResolverCache())
+    c.open(args.config_file)
+    config = c.lazy()
+
+    # build creates the keys if they are missing, don't write them here
+    sshkey = None
+    if not os.path.exists(config["admin_user"]+"_id_rsa.pub"):
+        sshkey = "ssh-rsa <placeholder> "+config["admin_user"]
+    tpl = arm.ArmTemplate(args.copy_loops, sshkey)
+    tpl.read(config)
+
+    errors = azvalidate.check(tpl)
+    print(azvalidate.report(*azvalidate.counts(tpl)))
+    if errors:
+        for error in errors:
+            log.error(error)
+        sys.exit(1)
+    log.info(f"template is valid ({len(tpl.resources)} resources)")
+
 def do_destroy(args):
-    log.info("reading config file ({})".format(args.config_file))
-    config = azconfig.ConfigFile()  
-    config.open(args.config_file)
+    config = _open_config(args)
 
     log.warning("deleting entire resource group ({})".format(config.read_value("resource_group")))
     if not args.force:
@@ -430,6 +538,10 @@ def do_destroy(args):
     azutil.delete_resource_group(
         config.read_value("resource_group"), args.no_wait
     )
+    # the next build deploys everything again
+    deployed = azdeploy.deployed_file(_get_tmpdir(args.config_file))
+    if os.path.exists(deployed):
+        os.remove(deployed)
 
 if __name__ == "__main__":
     azhpc_parser = argparse.ArgumentParser(prog="azhpc")
@@ -439,6 +551,36 @@ if __name__ == "__main__":
         "--config-file", "-c", type=str, 
         default="config.json", help="config file"
     )
+    gopt_parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=0,
+        help="seconds to keep non-secret lookups (e.g. fqdn) in .azhpc_cache.json (default: 0, disabled)"
+    )
+    gopt_parser.add_argument(
+        "--backend",
+        choices=[ "cli", "rest" ],
+        default="cli",
+        help="use the az cli or the ARM rest api for azure queries (default: cli)"
+    )
+    gopt_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        default=False,
+        help="query azure instead of using the inventory saved by build"
+    )
+    gopt_parser.add_argument(
+        "--fanout",
+        type=int,
+        default=azssh.ssh_threads,
+        help=f"number of hosts to run commands on at once (default: {azssh.ssh_threads})"
+    )
+    gopt_parser.add_argument(
+        "--ssh-persist",
+        type=int,
+        default=azssh.control_persist,
+        help=f"seconds to keep ssh connections open for reuse, 0 to disable (default: {azssh.control_persist})"
+    )
     gopt_parser.add_argument(
         "--debug", 
         help="increase output verbosity",
@@ -462,6 +604,59 @@ if __name__ == "__main__":
         default="deploy.json", 
         help="filename for the arm template",
     )
+    build_parser.add_argument(
+        "--copy-loops",
+        action="store_true",
+        default=False,
+        help="write VMs with several instances as ARM copy loops for a smaller template"
+    )
+    build_parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=0,
+        help="deploy the network first and then each resource and storage in parallel, in nested deployments of up to this many resources (default: one deployment)"
+    )
+    build_parser.add_argument(
+        "--plan",
+        action="store_true",
+        default=False,
+        help="show the resources that would be deployed and exit"
+    )
+    build_parser.add_argument(
+        "--redeploy",
+        action="store_true",
+        default=False,
+        help="deploy all the resources, even those unchanged since the last build"
+    )
+    build_parser.add_argument(
+        "--install-concurrency",
+        type=int,
+        help="number of independent install steps to run at once (default: install_concurrency in the config or 1)"
+    )
+    build_parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="start installing on resources as soon as they are deployed"
+    )
+    build_parser.add_argument(
+        "--executor",
+        choices=[ "pssh", "python" ],
+        default="pssh",
+        help="run install steps with pssh on the install node or from here through it (default: pssh)"
+    )
+    build_parser.add_argument(
+        "--stream-output",
+        action="store_true",
+        default=False,
+        help="show all the output from the hosts while install steps run, not just their status"
+    )
+    build_parser.add_argument(
+        "--reinstall",
+        action="store_true",
+        default=False,
+        help="run all install steps on all hosts, even where they succeeded in a previous build"
+    )
 
     connect_parser = subparsers.add_parser(
         "connect", 
@@ -609,6 +804,36 @@ if __name__ == "__main__":
     )
     status_parser.set_defaults(func=do_status)
 
+    validate_parser = subparsers.add_parser(
+        "validate", 
+        parents=[gopt_parser],
+        add_help=False,
+        description="check the arm template without deploying",
+        help="check the arm template for errors offline"
+    )
+    validate_parser.set_defaults(func=do_validate)
+    validate_parser.add_argument(
+        "--copy-loops",
+        action="store_true",
+        default=False,
+        help="write VMs with several instances as ARM copy loops, as in build"
+    )
+
+    install_report_parser = subparsers.add_parser(
+        "install-report", 
+        parents=[gopt_parser],
+        add_help=False,
+        description="summarise the timings of the last install",
+        help="show the slowest install steps and hosts"
+    )
+    install_report_parser.set_defaults(func=do_install_report)
+    install_report_parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="number of steps and hosts to show (default: 10)"
+    )
+
     args = azhpc_parser.parse_args()
     log.debug(args)
     
@@ -617,5 +842,10 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 
+    azutil.set_backend(args.backend)
+    azinstall.pssh_threads = args.fanout
+    if args.ssh_persist > 0:
+        azssh.control_dir = azssh.control_dir_for(os.path.abspath(args.config_file))
+        azssh.control_persist = args.ssh_persist
     args.func(args)
 
@@ -1,20 +1,144 @@
+import collections
+import hashlib
+import io
+import json
 import logging
 import os
 import re
+import shlex
 import shutil
+import stat
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 
+import azconfig
+import azinventory
+import azssh
+import aztelemetry
 import azutil
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 log = logging.getLogger(__name__)
 
 pssh_threads = 50
 
-def create_jumpbox_setup_script(tmpdir, sshprivkey, sshpubkey):
+# how jumpbox_script steps are run: "pssh" runs the generated script on the
+# install node, "python" runs the step on each host from here with azssh
+executor = "pssh"
+
+# show all the output from the hosts while a step runs rather than just
+# their status, and how many lines to keep to show when a step fails
+stream_output = False
+stream_lines = 50
+
+__pssh_status = re.compile(r"^\[\d+\] \d\d:\d\d:\d\d \[(SUCCESS|FAILURE)\] (\S+)(.*)$")
+# the messages from the generated scripts are indented
+__progress = re.compile(r"^ {4,}\S|^copied to ")
+
+# seconds to wait for hosts to come back after a reboot step and the range
+# of the backoff between probes
+reboot_timeout = 600
+reboot_probe_min = 2
+reboot_probe_max = 30
+
+# the sessions allowed on one ssh connection, the shared connection to the
+# install node carries one for each host being reached through it
+ssh_max_sessions = 128
+
+# directory in the admin user's home on each host for the completion markers
+marker_dir = ".azhpc"
+
+def _pending_hosts(hostlist, marker, pending):
+    # shell to set $hosts to the hosts in hostlist without the completion
+    # marker, exiting if there are none (AZHPC_FORCE=1 uses all the hosts)
+    return f"""hosts={hostlist}
+if [ "$AZHPC_FORCE" != "1" ]; then
+    mkdir -p hostlists/pending
+    hosts={pending}
+    pssh -p {pssh_threads} -t 0 -h {hostlist} "test -f ~/{marker_dir}/{marker}" | sed -n 's/.*\\[FAILURE\\] \\([^ ]*\\).*/\\1/p' > $hosts
+    if [ ! -s $hosts ]; then
+        echo "    All hosts have completed this step"
+        exit 0
+    fi
+    echo "    Running on $(wc -l < $hosts) of $(wc -l < {hostlist}) hosts"
+fi
+"""
+
+# the sas key fields that change every time a key is generated
+__volatile = re.compile(r"\b(st|se|sig)=[^&'\s]*")
+
+def _stable(text):
+    # text with the values that change between builds masked
+    return __volatile.sub(r"\1=*", text)
+
+def _marker_name(tmpdir, step, inst):
+    # changes when the step, its evaluated arguments or any of the scripts it
+    # runs change
+    h = hashlib.sha256()
+    h.update(_stable(json.dumps(azconfig.raw_value(inst), sort_keys=True)).encode("utf-8"))
+    h.update(_stable(_step_cmdline(inst)).encode("utf-8"))
+    for script in [ inst["script"] ] + inst.get("deps", []):
+        h.update(_read_if_exists(f"{tmpdir}/scripts/{script}"))
+    return f"{step:02}_{inst['script']}.{h.hexdigest()[:12]}"
+
+def create_tree_copy_script(tmpdir):
+    # copies to a first wave of hosts from the install node, then every host
+    # that has the files copies them on to the next ones, so the number of
+    # waves grows with the log of the number of hosts
+    scriptfile = f"{tmpdir}/install/tree_copy.sh"
+    with open(scriptfile, "w") as f:
+        f.write("""# usage: tree_copy <hostlist> <fanout> <dest> <src>...
+tree_copy() {
+    local hostlist=$1 fanout=$2 dest=$3
+    shift 3
+    local todo=($(<$hostlist))
+    local sources=("") failed=() i=0
+    while [ $i -lt ${#todo[@]} ]; do
+        local pids=() targets=() next=()
+        for s in "${sources[@]}"; do
+            for ((j = 0; j < fanout && i < ${#todo[@]}; j++)); do
+                t=${todo[$i]}
+                i=$((i + 1))
+                if [ -z "$s" ]; then
+                    rsync -a "$@" $t:$dest &
+                else
+                    ssh $s "rsync -a $* $t:$dest" &
+                fi
+                pids+=($!)
+                targets+=($t)
+            done
+        done
+        for k in ${!pids[@]}; do
+            if wait ${pids[$k]}; then
+                next+=(${targets[$k]})
+            else
+                failed+=(${targets[$k]})
+            fi
+        done
+        sources+=(${next[@]})
+        echo "copied to $i of ${#todo[@]} hosts"
+    done
+    if [ ${#failed[@]} -gt 0 ]; then
+        echo "copy failed on: ${failed[*]}"
+        return 1
+    fi
+}
+""")
+
+def create_jumpbox_setup_script(tmpdir, sshprivkey, sshpubkey, fanout=0):
     scriptfile = f"{tmpdir}/install/00_install_node_setup.sh"
     logfile = "install/00_install_node_setup.log"
+    pending = _pending_hosts("hostlists/$tag", "00_node_setup", "hostlists/pending/00_${tag//\\//_}")
+    if fanout:
+        copy = f"""source install/tree_copy.sh
+tree_copy hostlists/$tag {fanout} ~ ~/{tmpdir} ~/.ssh >> {logfile} 2>&1"""
+    else:
+        copy = f"""prsync -p {pssh_threads} -a -h hostlists/$tag ~/$tmp_dir ~ >> {logfile} 2>&1
+prsync -p {pssh_threads} -a -h hostlists/$tag ~/.ssh ~ >> {logfile} 2>&1"""
 
     with open(scriptfile, "w") as f:
         os.chmod(scriptfile, 0o755)
@@ -25,7 +149,9 @@ cd "$( dirname "${{BASH_SOURCE[0]}}" )/.."
 
 tag=linux
 
-if [ "$1" != "" ]; then
+if [ "$1" == "--resource" ]; then
+    tag=$2
+elif [ "$1" != "" ]; then
     tag=tags/$1
 else
     sudo yum install -y epel-release > {logfile} 2>&1
@@ -46,15 +172,24 @@ EOF
 
 fi
 
-prsync -p {pssh_threads} -a -h hostlists/$tag ~/$tmp_dir ~ >> {logfile} 2>&1
-prsync -p {pssh_threads} -a -h hostlists/$tag ~/.ssh ~ >> {logfile} 2>&1
+echo "{aztelemetry.start_marker} $(date '+%s %H:%M:%S')" >> {logfile}
+
+{copy}
 
-pssh -p {pssh_threads} -t 0 -i -h hostlists/$tag 'echo "AcceptEnv PSSH_NODENUM PSSH_HOST" | sudo tee -a /etc/ssh/sshd_config' >> {logfile} 2>&1
-pssh -p {pssh_threads} -t 0 -i -h hostlists/$tag 'sudo systemctl restart sshd' >> {logfile} 2>&1
-pssh -p {pssh_threads} -t 0 -i -h hostlists/$tag "echo 'Defaults env_keep += \\"PSSH_NODENUM PSSH_HOST\\"' | sudo tee -a /etc/sudoers" >> {logfile} 2>&1
+{pending}
+pssh -p {pssh_threads} -t 0 -i -h $hosts 'printf "AcceptEnv PSSH_NODENUM PSSH_HOST\\nMaxSessions {ssh_max_sessions}\\n" | sudo tee -a /etc/ssh/sshd_config' >> {logfile} 2>&1
+pssh -p {pssh_threads} -t 0 -i -h $hosts 'sudo systemctl restart sshd' >> {logfile} 2>&1
+pssh -p {pssh_threads} -t 0 -i -h $hosts "echo 'Defaults env_keep += \\"PSSH_NODENUM PSSH_HOST\\"' | sudo tee -a /etc/sudoers && mkdir -p ~/{marker_dir} && touch ~/{marker_dir}/00_node_setup" >> {logfile} 2>&1
 """)
 
-def create_jumpbox_script(inst, tmpdir, step):
+def _step_cmdline(inst):
+    args = inst.get("args", [])
+    cmdline = " ".join([ "scripts/"+inst["script"] ] + [ f"'{arg}'" for arg in args ])
+    if inst.get("sudo", False):
+        cmdline = "sudo " + cmdline
+    return cmdline
+
+def create_jumpbox_script(inst, tmpdir, step, fanout=0):
     targetscript = inst["script"]
     scriptfile = f"{tmpdir}/install/{step:02}_{targetscript}"
     logfile = f"install/{step:02}_{targetscript[:targetscript.rfind('.')]}.log"
@@ -66,35 +201,71 @@ cd "$( dirname "${{BASH_SOURCE[0]}}" )/.."
 
 tag=${{1:-{tag}}}
 
+echo "{aztelemetry.start_marker} $(date '+%s %H:%M:%S')" >> {logfile}
+
 if [ ! -f "hostlists/tags/$tag" ]; then
     echo "    Tag is not assigned to any resource (not running)"
 fi
 
 """
     reboot = inst.get("reboot", False)
-    sudo = inst.get("sudo", False)
     files = inst.get("copy", [])
-    args = inst.get("args", [])
 
-    for f in files:
-        content += f"pscp.pssh -p {pssh_threads} -h hostlists/tags/$tag {f} $(pwd) >> {logfile} 2>&1\n"
+    marker = _marker_name(tmpdir, step, inst)
+    content += _pending_hosts("hostlists/tags/$tag", marker, f"hostlists/pending/{step:02}_$tag") + "\n"
 
-    cmdline = " ".join([ "scripts/"+targetscript ] + [ f"'{arg}'" for arg in args ])
-    if sudo:
-        cmdline = "sudo " + cmdline
+    if files and fanout:
+        content += "source install/tree_copy.sh\n"
+    for f in files:
+        if fanout:
+            content += f"tree_copy $hosts {fanout} $(pwd) $(pwd)/{f} >> {logfile} 2>&1\n"
+        else:
+            content += f"pscp.pssh -p {pssh_threads} -h $hosts {f} $(pwd) >> {logfile} 2>&1\n"
 
-    content += f"pssh -p {pssh_threads} -t 0 -i -h hostlists/tags/$tag \"cd {tmpdir}; {cmdline}\" >> {logfile} 2>&1\n"
+    cmdline = _step_cmdline(inst)
+    content += f"pssh -p {pssh_threads} -t 0 -i -h $hosts \"cd {tmpdir}; {cmdline} && mkdir -p ~/{marker_dir} && touch ~/{marker_dir}/{marker}\" >> {logfile} 2>&1\n"
 
     if reboot:
+        timeout = inst.get("reboot_timeout", reboot_timeout)
         content += f"""
-pssh -p {pssh_threads} -t 0 -i -h hostlists/tags/$tag "sudo reboot" >> {logfile} 2>&1
-echo "    Waiting for nodes to come back"
-sleep 10
-for h in $(<hostlists/tags/$tag); do
-    nc -z $h 22
-    echo "        $h rebooted"
+# a host is back when it answers with a new boot id (or, if that could not
+# be read, after it has gone down), each host is probed with a backoff until
+# the timeout
+reboot_host() {{
+    local h=$1 old new start delay={reboot_probe_min}
+    old=$(ssh -o ConnectTimeout=10 $h cat /proc/sys/kernel/random/boot_id 2>/dev/null)
+    timeout 30 ssh -o ConnectTimeout=10 $h "sudo reboot" > /dev/null 2>&1
+    start=$SECONDS
+    while [ $((SECONDS - start)) -lt {timeout} ]; do
+        sleep $delay
+        new=$(ssh -o ConnectTimeout=10 -o BatchMode=yes $h cat /proc/sys/kernel/random/boot_id 2>/dev/null)
+        if [ -z "$new" ]; then
+            # without the boot id from before the host has to go down first
+            old=${{old:-down}}
+        elif [ -n "$old" ] && [ "$new" != "$old" ]; then
+            echo "        $h rebooted ($((SECONDS - start))s)"
+            return 0
+        fi
+        delay=$((delay * 2 > {reboot_probe_max} ? {reboot_probe_max} : delay * 2))
+    done
+    echo "        $h did not come back within {timeout}s"
+    return 1
+}}
+
+echo "    Rebooting and waiting for nodes to come back"
+pids=()
+for h in $(<$hosts); do
+    reboot_host $h >> {logfile} 2>&1 &
+    pids+=($!)
 done
-sleep 10
+failed=0
+for pid in ${{pids[@]}}; do
+    wait $pid || failed=$((failed + 1))
+done
+if [ $failed -gt 0 ]; then
+    echo "    $failed hosts did not come back after the reboot (see {logfile})"
+    exit 1
+fi
 """
 
     with open(scriptfile, "w") as f:
@@ -121,15 +292,21 @@ cd "$( dirname "${{BASH_SOURCE[0]}}" )/.."
 
 """)
 
-def generate_hostlists(cfg, tmpdir):
+def generate_hostlists(cfg, tmpdir, inventory=None, ready=None):
+    # only the resources in ready are included when it is set
+    if os.path.isdir(tmpdir+"/hostlists"):
+        shutil.rmtree(tmpdir+"/hostlists")
     os.makedirs(tmpdir+"/hostlists/tags")
+    resources = [ r for r in cfg.get("resources", {}).keys() if ready is None or r in ready ]
+    if inventory is None and any([ cfg["resources"][r]["type"] == "vmss" for r in resources ]):
+        inventory = azinventory.query(cfg["resource_group"])
     dns_domain = cfg["vnet"].get("dns_domain", None)
     dns_domain_end = ""
     if dns_domain:
         dns_domain_end = f".{dns_domain}"
     hosts = {}
     tags = {}
-    for rname in cfg.get("resources", {}).keys():
+    for rname in resources:
         rtype = cfg["resources"][rname]["type"]
         if rtype == "vm":
             instances = cfg["resources"][rname].get("instances", 1)
@@ -138,7 +315,7 @@ def generate_hostlists(cfg, tmpdir):
             else:
                 hosts[rname] = [ f"{rname}{n:04}" for n in range(1, instances+1) ]            
         elif rtype == "vmss":
-            hosts[rname] = azutil.get_vmss_instances(cfg["resource_group"], rname)
+            hosts[rname] = inventory.vmss_instances(rname)
 
         for tname in cfg["resources"][rname].get("tags", []):
             # handle partial VMSS for a tag with python [] notation
@@ -172,6 +349,8 @@ def generate_hostlists(cfg, tmpdir):
         with open(f"{tmpdir}/hostlists/tags/{n}", "w") as f:
             f.writelines(f"{h}{dns_domain_end}\n" for h in tags[n])
 
+    return hosts, tags
+
 def _create_anf_mount_scripts(cfg, scriptfile):
     script = """#!/bin/bash
 yum install -y nfs-utils
@@ -210,18 +389,13 @@ def generate_install(cfg, tmpdir, adminuser, sshprivkey, sshpubkey):
 
     if jb:
         inst = cfg.get("install", [])
-        create_jumpbox_setup_script(tmpdir, sshprivkey, sshpubkey)
+        # 0 copies to every host from the install node
+        fanout = cfg.get("install_tree_fanout", 0)
+        if fanout:
+            create_tree_copy_script(tmpdir)
+        create_jumpbox_setup_script(tmpdir, sshprivkey, sshpubkey, fanout)
 
         for n, step in enumerate(inst):
-            stype = step.get("type", "jumpbox_script")
-            if stype == "jumpbox_script":
-                create_jumpbox_script(step, tmpdir, n+1)
-            elif stype == "local_script":
-                create_local_script(step, tmpdir, n+1)
-            else:
-                error(f"unrecognised script type ({stype})")
-                sys.exit(1)
-            
             for script in [ step["script"] ] + step.get("deps", []):
                 if os.path.exists(f"scripts/{script}"):
                     log.debug(f"using script from this project ({script})")
@@ -233,13 +407,22 @@ def generate_install(cfg, tmpdir, adminuser, sshprivkey, sshpubkey):
                     log.error(f"cannot find script ({script})")
                     sys.exit(1)
 
+            stype = step.get("type", "jumpbox_script")
+            if stype == "jumpbox_script":
+                create_jumpbox_script(step, tmpdir, n+1, fanout)
+            elif stype == "local_script":
+                create_local_script(step, tmpdir, n+1)
+            else:
+                error(f"unrecognised script type ({stype})")
+                sys.exit(1)
+
 def _make_subprocess_error_string(res):
     return "\n    args={}\n    return code={}\n    stdout={}\n    stderr={}".format(res.args, res.returncode, res.stdout.decode("utf-8"), res.stderr.decode("utf-8"))
 
 def __rsync(sshkey, src, dst):
     cmd = [
         "rsync", "-a", "-e",
-            f"ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i {sshkey}",
+            " ".join([ "ssh" ] + [ shlex.quote(x) for x in azssh.ssh_options(sshkey) ]),
             src, dst
     ]
     res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -247,52 +430,584 @@ def __rsync(sshkey, src, dst):
         logging.error("invalid returncode"+_make_subprocess_error_string(res))
         sys.exit(1)
 
-def run(cfg, tmpdir, adminuser, sshprivkey, sshpubkey, fqdn):
+def _read_hostlist(fname):
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return f.read().split()
+
+def _append_remote(sshprivkey, adminuser, fqdn, fname, text):
+    cmd = [ "ssh" ] + azssh.ssh_options(sshprivkey) + [ f"{adminuser}@{fqdn}", f"cat >> {fname}" ]
+    res = subprocess.run(cmd, input=text.encode("utf-8"), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        log.warning(f"failed to add to {fname} on {fqdn}: {res.stderr.decode('utf-8', 'replace').strip()}")
+
+def _run_jumpbox_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, force=False):
+    # the same as the generated script but with the output of every host
+    # kept and the hosts that fail reported
+    script = step["script"]
+    logfile = f"{tmpdir}/install/{idx:02}_{script[:script.rfind('.')]}.log"
+    hosts = _read_hostlist(f"{tmpdir}/hostlists/tags/{step['tag']}")
+    if not hosts:
+        log.info("    Tag is not assigned to any resource (not running)")
+        return
+
+    pssh = azssh.ParallelSsh(azssh.SshTransport(adminuser, sshprivkey, f"{adminuser}@{fqdn}"), pssh_threads)
+
+    def check(results, action):
+        text = azssh.format_results(results)
+        with open(logfile, "a") as f:
+            f.write(text)
+        # the logs on the install node are brought back at the end
+        _append_remote(sshprivkey, adminuser, fqdn, logfile, text)
+        aztelemetry.record_results(tmpdir, idx, action, results)
+        bad = azssh.failed(results)
+        if bad:
+            log.error(f"{action} failed on {len(bad)} of {len(results)} hosts:")
+            for h in bad:
+                r = results[h]
+                status = "timed out" if r.returncode is None else f"exit code {r.returncode}"
+                log.error(f"    {h} ({status}) {r.stderr.strip()}")
+            __rsync(sshprivkey, f"{adminuser}@{fqdn}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
+            sys.exit(1)
+
+    marker = _marker_name(tmpdir, idx, step)
+    if not force:
+        hosts = azssh.failed(pssh.run(hosts, f"test -f ~/{marker_dir}/{marker}"))
+        if not hosts:
+            log.info("    All hosts have completed this step")
+            return
+    log.info(f"    Running on {len(hosts)} hosts")
+
+    def progress(r):
+        status = "success" if r.returncode == 0 else ("timed out" if r.returncode is None else f"exit code {r.returncode}")
+        log.info(f"    {r.host}: {status} ({r.duration:0.0f}s)")
+        if stream_output:
+            for line in (r.stdout + r.stderr).splitlines()[-stream_lines:]:
+                log.info(f"    {r.host}: {line}")
+
+    jb = cfg["install_from"]
+    for f in step.get("copy", []):
+        check(pssh.run(hosts, f"scp -q {jb}:{tmpdir}/{f} {tmpdir}/"), "copy")
+
+    cmdline = _step_cmdline(step)
+    check(pssh.run(hosts, f"cd {tmpdir}; {cmdline} && mkdir -p ~/{marker_dir} && touch ~/{marker_dir}/{marker}", progress), "run")
+
+    if step.get("reboot", False):
+        log.info("    Rebooting and waiting for nodes to come back")
+        starttime = time.time()
+        rebooted, stragglers = azssh.reboot(pssh, hosts, step.get("reboot_timeout", reboot_timeout), reboot_probe_min, reboot_probe_max)
+        for h in hosts:
+            end = starttime + rebooted[h] if h in rebooted else time.time()
+            aztelemetry.record(
+                tmpdir, "host", step=idx, action="reboot", host=h, start=starttime, end=end,
+                returncode=0 if h in rebooted else None, stdout_bytes=0, stderr_bytes=0
+            )
+        if rebooted:
+            log.info(f"    {len(rebooted)} hosts rebooted, slowest {max(rebooted.values()):0.0f}s")
+        if stragglers:
+            log.error(f"{len(stragglers)} hosts did not come back after the reboot: " + ", ".join(stragglers))
+            sys.exit(1)
+
+def _file_id(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    return f"{h.hexdigest()}-{mode:o}"
+
+def bundle_manifest(tmpdir):
+    # maps each file, relative to the parent of tmpdir, to an id from its
+    # content and mode (the logs and telemetry are left out so the remote
+    # logs are kept)
+    base = os.path.dirname(os.path.abspath(tmpdir))
+    manifest = {}
+    for root, dirs, files in os.walk(tmpdir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            rel = os.path.relpath(os.path.abspath(path), base)
+            if fname.endswith(".log") or fname == "telemetry.jsonl" or not os.path.isfile(path):
+                continue
+            manifest[rel] = (_file_id(path), path)
+    return manifest
+
+def push_bundle(sshprivkey, adminuser, fqdn, tmpdir):
+    # Each file is stored once on the install node under its id in
+    # ~/.azhpc/objects and only the ids not already there are sent.  The
+    # directory is then copied out of the store, keeping the object mtimes
+    # so unchanged files are skipped when they are copied on to the hosts.
+    manifest = bundle_manifest(tmpdir)
+    objects = f"{marker_dir}/objects"
+    ssh = [ "ssh" ] + azssh.ssh_options(sshprivkey) + [ f"{adminuser}@{fqdn}" ]
+    res = subprocess.run(ssh + [ f"mkdir -p {objects} && ls {objects}" ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        log.error("unable to list the install files on the install node"+_make_subprocess_error_string(res))
+        sys.exit(1)
+    existing = set(res.stdout.decode("utf-8").split())
+
+    missing = {}
+    for rel, (oid, path) in manifest.items():
+        if oid not in existing:
+            missing.setdefault(oid, path)
+    log.debug(f"install bundle has {len(manifest)} files, sending {len(missing)} new")
+
+    listing = "".join([ f"{oid} {rel}\n" for rel, (oid, path) in manifest.items() ]).encode("utf-8")
+    listname = f"manifest.{os.path.basename(os.path.abspath(tmpdir))}"
+    # the objects are extracted to a hidden directory and moved into the
+    # store once complete so an interrupted push never leaves a partial
+    # object to be trusted next time, and the objects no manifest refers to
+    # are removed afterwards
+    remote = (
+        f"incoming=$(mktemp -d {objects}/.incoming.XXXXXX) && trap 'rm -rf $incoming' EXIT && "
+        f"tar -xzf - -C $incoming && "
+        f"find $incoming -mindepth 1 -maxdepth 1 -exec mv -f -t {objects} {{}} + && "
+        f"while read id path; do mkdir -p \"$(dirname \"$path\")\" && cp -p {objects}/$id \"$path\" || exit 1; done < {objects}/{listname} && "
+        f"(cd {objects} && comm -23 <(ls | grep -v '^manifest\\.' | sort) <(cut -d' ' -f1 manifest.* | sort -u) | xargs -r rm -f)"
+    )
+    proc = subprocess.Popen(ssh + [ remote ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # the archive is streamed from a thread so the errors can be read at
+    # the same time
+    def write():
+        now = int(time.time())
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|gz") as tar:
+                for oid, path in missing.items():
+                    info = tar.gettarinfo(path, arcname=oid)
+                    info.mtime = now
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    with open(path, "rb") as f:
+                        tar.addfile(info, f)
+                info = tarfile.TarInfo(listname)
+                info.size = len(listing)
+                info.mtime = now
+                tar.addfile(info, io.BytesIO(listing))
+            proc.stdin.close()
+        except BrokenPipeError:
+            # the remote side failed, its error is reported below
+            pass
+    writer = threading.Thread(target=write)
+    writer.start()
+    stderr = proc.stderr.read()
+    writer.join()
+    proc.wait()
+    if proc.returncode != 0:
+        log.error(f"unable to push the install files (return code={proc.returncode}): {stderr.decode('utf-8')}")
+        sys.exit(1)
+    return len(missing)
+
+def _stream(cmd):
+    # Runs cmd and logs its output as it arrives, where a line after a pssh
+    # status line is from that host.  Only the progress lines are shown
+    # unless stream_output is set.  Returns the exit code and the last lines.
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    last = collections.deque(maxlen=stream_lines)
+    host = None
+    for raw in proc.stdout:
+        line = raw.decode("utf-8", "replace").rstrip("\n")
+        if not line or line.startswith(aztelemetry.start_marker):
+            continue
+        last.append(line)
+        status = __pssh_status.match(line)
+        if status:
+            host = status.group(2)
+            log.info(f"    {host}: {status.group(1).lower()}{status.group(3)}")
+        elif __progress.match(line):
+            log.info(line)
+        elif host:
+            log.log(logging.INFO if stream_output else logging.DEBUG, f"    {host}: {line}")
+        else:
+            log.log(logging.INFO if stream_output else logging.DEBUG, f"    {line}")
+    proc.wait()
+    return proc.returncode, list(last)
+
+def _record_step(tmpdir, idx, step, starttime, status, extra_args=()):
+    aztelemetry.record(
+        tmpdir, "step", step=idx, script=step["script"], type=step.get("type", "jumpbox_script"),
+        tag=step.get("tag", None), args=extra_args, start=starttime, end=time.time(), status=status
+    )
+
+def _run_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, extra_args=(), force=False):
+    script = step["script"]
+    scripttype = step.get("type", "jumpbox_script")
+    instcmd = [ f"{tmpdir}/install/{idx:02}_{script}" ]
+    if extra_args:
+        log.info(f"Step {idx:02} : {script} ({scripttype}) {' '.join(extra_args)}")
+    else:
+        log.info(f"Step {idx:02} : {script} ({scripttype})")
+    starttime = time.time()
+
+    if scripttype == "jumpbox_script" and executor == "python" and idx > 0:
+        try:
+            _run_jumpbox_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, force)
+        except SystemExit:
+            _record_step(tmpdir, idx, step, starttime, "failed")
+            raise
+
+    elif scripttype == "jumpbox_script":
+        tag = step.get("tag", None)
+        if tag:
+            instcmd.append(tag)
+        instcmd += extra_args
+
+        if force:
+            # run on every host, not just those without the completion marker
+            instcmd.insert(0, "AZHPC_FORCE=1")
+
+        # the step log is followed while the script runs so the output of
+        # the hosts is seen as it happens
+        logfile = f"{tmpdir}/install/{idx:02}_{script[:script.rfind('.')]}.log"
+        remote = (
+            f"touch {logfile}; offset=$(stat -c %s {logfile}); "
+            f"{' '.join(instcmd)} & pid=$!; "
+            f"tail -c +$((offset + 1)) -F --pid=$pid {logfile} 2> /dev/null; "
+            f"wait $pid"
+        )
+        cmd = [ "ssh" ] + azssh.ssh_options(sshprivkey) + [ f"{adminuser}@{fqdn}", remote ]
+        returncode, last = _stream(cmd)
+        if returncode != 0:
+            log.error(f"invalid returncode ({returncode}), the last of the output was:\n" + "\n".join(last))
+            _record_step(tmpdir, idx, step, starttime, "failed")
+            __rsync(sshprivkey, f"{adminuser}@{fqdn}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
+            sys.exit(1)
+
+    elif scripttype == "local_script":
+        res = subprocess.run(instcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if res.returncode != 0:
+            logging.error("invalid returncode"+_make_subprocess_error_string(res))
+            _record_step(tmpdir, idx, step, starttime, "failed")
+            __rsync(sshprivkey, f"{adminuser}@{fqdn}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
+            sys.exit(1)
+    
+    else:
+        log.error(f"unrecognised script type {scripttype}")
+
+    duration = time.time() - starttime
+    _record_step(tmpdir, idx, step, starttime, "succeeded", extra_args)
+    log.info(f"    duration: {duration:0.0f} seconds")
+    return duration
+
+def _step_resources(cfg, step):
+    if step.get("type", "jumpbox_script") == "local_script":
+        return None
+    return set(_tag_resources(cfg, step["tag"]))
+
+def install_dependencies(cfg, install_steps):
+    # Returns the set of earlier steps each step depends on.  A step depends
+    # on every earlier step, so the install list is run in order, unless it
+    # lists the steps it needs with "depends_on" (by "name", or script if
+    # there is no name).  Even then it depends on the earlier local scripts
+    # and, if it copies files from the install node, on the earlier steps
+    # run there.  Local scripts depend on everything before them.  Step 0
+    # sets up the nodes so everything depends on it.
+    jb = cfg.get("install_from", None)
+    names = {}
+    deps = [ set() ]
+    for idx, step in enumerate(install_steps[1:], 1):
+        if "depends_on" not in step or step.get("type", "jumpbox_script") == "local_script":
+            d = set(range(idx))
+        else:
+            d = set([ 0 ])
+            for n in step["depends_on"]:
+                if n not in names:
+                    log.error(f"step {idx} ({step['script']}) depends on unknown or later step ({n})")
+                    sys.exit(1)
+                d.add(names[n])
+            for prev in range(1, idx):
+                prev_resources = _step_resources(cfg, install_steps[prev])
+                if prev_resources is None or (step.get("copy") and jb in prev_resources):
+                    d.add(prev)
+        deps.append(d)
+        names[step.get("name", step["script"])] = idx
+    return deps
+
+def _read_if_exists(fname):
+    if os.path.exists(fname):
+        with open(fname, "rb") as f:
+            return f.read()
+    return b""
+
+def step_hash(tmpdir, idx, step):
+    # covers the generated step script, the scripts it runs, its options
+    # (with the sas key times and signatures masked, as for the markers)
+    # and the hosts it runs on
+    h = hashlib.sha256()
+    h.update(_stable(json.dumps(azconfig.raw_value(step), sort_keys=True)).encode("utf-8"))
+    h.update(_stable(_read_if_exists(f"{tmpdir}/install/{idx:02}_{step['script']}").decode("utf-8")).encode("utf-8"))
+    for script in [ step["script"] ] + step.get("deps", []):
+        h.update(_read_if_exists(f"{tmpdir}/scripts/{script}"))
+    if step.get("tag", None):
+        h.update(_read_if_exists(f"{tmpdir}/hostlists/tags/{step['tag']}"))
+    return h.hexdigest()
+
+def load_journal(tmpdir):
+    fname = f"{tmpdir}/install/journal.json"
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+def _write_journal(tmpdir, journal):
+    with open(f"{tmpdir}/install/journal.json", "w") as f:
+        json.dump(journal, f, indent=4)
+
+def _fetch_journal(sshprivkey, adminuser, fqdn, tmpdir):
+    # the install node keeps a copy in case the local one is lost
+    cmd = [
+        "ssh" ] + azssh.ssh_options(sshprivkey) + [
+            f"{adminuser}@{fqdn}",
+            f"cat {tmpdir}/install/journal.json"
+    ]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        return {}
+    try:
+        return json.loads(res.stdout)
+    except ValueError:
+        return {}
+
+def _skipped_steps(install_steps, deps, hashes, journal):
+    # a step is skipped when it has succeeded before with the same hash and
+    # nothing it depends on is run again (the node setup always runs)
+    skip = set()
+    for idx in range(1, len(install_steps)):
+        entry = journal.get(hashes[idx], {})
+        if entry.get("status") == "succeeded" and (deps[idx] - set([ 0 ])).issubset(skip):
+            skip.add(idx)
+    return skip
+
+def _collect_host_logs(tmpdir, install_steps, skip):
+    # the steps run by the python executor recorded their hosts as they ran
+    if executor == "python":
+        skip = set(skip) | set([
+            idx for idx, step in enumerate(install_steps)
+            if idx > 0 and step.get("type", "jumpbox_script") == "jumpbox_script"
+        ])
+    aztelemetry.collect_pssh_logs(tmpdir, skip)
+
+def run(cfg, tmpdir, adminuser, sshprivkey, sshpubkey, fqdn, concurrency=None, journal=None, force=False):
     jb = cfg.get("install_from", None)
     if jb:
         install_steps = [{ "script": "install_node_setup.sh" }] + cfg.get("install", [])
+        if concurrency is None:
+            concurrency = cfg.get("install_concurrency", 1)
+        deps = install_dependencies(cfg, install_steps)
         
+        if journal is None:
+            journal = _fetch_journal(sshprivkey, adminuser, fqdn, tmpdir)
+        hashes = [ step_hash(tmpdir, idx, step) for idx, step in enumerate(install_steps) ]
+        skip = _skipped_steps(install_steps, deps, hashes, journal)
+        journal_lock = threading.Lock()
+
+        def save_journal(idx=None, replace=False, **fields):
+            # steps finish on different threads so the journal is only
+            # changed and written while holding the lock
+            with journal_lock:
+                if replace:
+                    journal[hashes[idx]] = fields
+                elif idx is not None:
+                    journal[hashes[idx]].update(fields)
+                _write_journal(tmpdir, journal)
+
+        def run_step(idx, step):
+            save_journal(idx, True, step=idx, script=step["script"], status="running", time=time.time())
+            try:
+                duration = _run_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, force=force)
+            except BaseException:
+                save_journal(idx, status="failed")
+                __rsync(sshprivkey, f"{tmpdir}/install/journal.json", f"{adminuser}@{fqdn}:{tmpdir}/install/")
+                raise
+            save_journal(idx, status="succeeded", duration=duration)
+            return duration
+
+        save_journal()
         log.debug("rsyncing install files")
-        __rsync(sshprivkey, tmpdir, f"{adminuser}@{fqdn}:.")
-
-        for idx, step in enumerate(install_steps):
-            script = step["script"]
-            scripttype = step.get("type", "jumpbox_script")
-            instcmd = [ f"{tmpdir}/install/{idx:02}_{script}" ]
-            log.info(f"Step {idx:02} : {script} ({scripttype})")
-            starttime = time.time()
-
-            if scripttype == "jumpbox_script":
-                tag = step.get("tag", None)
-                if tag:
-                    instcmd.append(tag)
-
-                cmd = [
-                    "ssh", 
-                        "-o", "StrictHostKeyChecking=no",
-                        "-o", "UserKnownHostsFile=/dev/null",
-                        "-i", sshprivkey,
-                        f"{adminuser}@{fqdn}"
-                ] + instcmd
-                res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if res.returncode != 0:
-                    logging.error("invalid returncode"+_make_subprocess_error_string(res))
-                    __rsync(sshprivkey, f"{adminuser}@{fqdn}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
-                    sys.exit(1)
-
-            elif scripttype == "local_script":
-                res = subprocess.run(instcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if res.returncode != 0:
-                    logging.error("invalid returncode"+_make_subprocess_error_string(res))
-                    __rsync(sshprivkey, f"{adminuser}@{fqdn}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
-                    sys.exit(1)
-            
-            else:
-                log.error(f"unrecognised script type {scripttype}")
-
-            duration = time.time() - starttime
-            log.info(f"    duration: {duration:0.0f} seconds")
+        push_bundle(sshprivkey, adminuser, fqdn, tmpdir)
+
+        for idx in sorted(skip):
+            log.info(f"Step {idx:02} : {install_steps[idx]['script']} (unchanged since last success, skipping)")
+            _record_step(tmpdir, idx, install_steps[idx], time.time(), "skipped")
+
+        # run every step as soon as its dependencies are done, with a
+        # concurrency of 1 this is the order of the install list
+        starttime = time.time()
+        timings = {}
+        done = set(skip)
+        failed = False
+        running = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while len(done) < len(install_steps):
+                if not failed:
+                    for idx, step in enumerate(install_steps):
+                        if len(running) >= concurrency:
+                            break
+                        if idx in done or idx in running.values() or not deps[idx].issubset(done):
+                            continue
+                        timings[idx] = time.time() - starttime
+                        f = executor.submit(run_step, idx, step)
+                        running[f] = idx
+                if not running:
+                    break
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for f in finished:
+                    idx = running.pop(f)
+                    try:
+                        timings[idx] = (timings[idx], f.result())
+                        done.add(idx)
+                    except BaseException:
+                        log.error(f"step {idx:02} ({install_steps[idx]['script']}) failed")
+                        failed = True
+
+        if failed:
+            _collect_host_logs(tmpdir, install_steps, skip)
+            sys.exit(1)
+
+        log.info("Install step timings:")
+        for idx in sorted(timings.keys()):
+            start, duration = timings[idx]
+            log.info(f"    {idx:02} {install_steps[idx]['script']:30} {install_steps[idx].get('tag', ''):15} start: {start:5.0f}s duration: {duration:5.0f}s")
 
         log.debug("rsyncing log files back")
+        __rsync(sshprivkey, f"{tmpdir}/install/journal.json", f"{adminuser}@{fqdn}:{tmpdir}/install/")
         __rsync(sshprivkey, f"{adminuser}@{fqdn}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
-        
+        _collect_host_logs(tmpdir, install_steps, skip)
+
+def _deployed_names(cfg, rname):
+    # the names of the arm resources that make up a config resource
+    res = cfg["resources"][rname]
+    instances = res.get("instances", 1)
+    if res["type"] == "vm" and instances > 1:
+        return [ f"{rname}{n:04}" for n in range(1, instances+1) ]
+    return [ rname ]
+
+def _storage_names(cfg, sname):
+    names = [ sname ]
+    pools = cfg["storage"][sname].get("pools", {})
+    for pool in pools.keys():
+        names.append(f"{sname}/{pool}")
+        names += [ f"{sname}/{pool}/{v}" for v in pools[pool].get("volumes", {}).keys() ]
+    return names
+
+def ready_resources(cfg, states):
+    # config resources and storage where everything has been deployed
+    ready = set()
+    for rname in cfg.get("resources", {}).keys():
+        if all([ states.get(n, None) == "Succeeded" for n in _deployed_names(cfg, rname) ]):
+            ready.add(rname)
+    for sname in cfg.get("storage", {}).keys():
+        if all([ states.get(n, None) == "Succeeded" for n in _storage_names(cfg, sname) ]):
+            ready.add(sname)
+    return ready
+
+def _tag_resources(cfg, tag):
+    return [
+        r for r in cfg.get("resources", {}).keys()
+        if tag in [ t.split("[")[0] for t in cfg["resources"][r].get("tags", []) ]
+    ]
+
+def run_pipelined(cfg, tmpdir, adminuser, sshprivkey, sshpubkey, watcher, callback=None, deployed=(), journal=None, force=False):
+    # Runs the install while the deployment is still in progress.  The
+    # install node is set up once it and all the storage are deployed, the
+    # remaining resources are set up as they complete and each step starts
+    # once every resource with its tag is set up (local scripts wait for the
+    # whole deployment).  Returns the inventory or None if the deployment
+    # failed or the install node was never ready, in which case the install
+    # should be run afterwards as usual.  deployed is the names of resources (arm or config) that were
+    # unchanged and left out of the deployment.  Steps are recorded in the
+    # journal as in run() and the leading steps that succeeded before are
+    # skipped.
+    jb = cfg["install_from"]
+    storage = set(cfg.get("storage", {}).keys())
+    linux = set([ r for r in cfg.get("resources", {}).keys() if not cfg["resources"][r].get("password", None) ])
+    install_steps = [{ "script": "install_node_setup.sh" }] + cfg.get("install", [])
+    state = { "fqdn": None, "setup": set(), "next": 1, "inventory": None, "journal": journal, "skipped": set() }
+
+    def update_hostlists(ready):
+        vmss = [ r for r in ready if cfg["resources"].get(r, {}).get("type") == "vmss" ]
+        inventory = state["inventory"]
+        if inventory is None or not all([ v in inventory.vmss for v in vmss ]):
+            inventory = state["inventory"] = azinventory.query(cfg["resource_group"])
+        inventory.resources, inventory.tags = generate_hostlists(cfg, tmpdir, inventory, ready)
+        push_bundle(sshprivkey, adminuser, state["fqdn"], tmpdir)
+
+    def advance(ready, final):
+        if state["fqdn"] is None:
+            if jb not in ready or not storage.issubset(ready):
+                return
+            log.info("install node is ready, starting install")
+            state["fqdn"] = azutil.get_fqdn(cfg["resource_group"], jb+"pip")
+            os.makedirs(tmpdir, exist_ok=True)
+            generate_install(cfg, tmpdir, adminuser, sshprivkey, sshpubkey)
+            if state["journal"] is None:
+                state["journal"] = _fetch_journal(sshprivkey, adminuser, state["fqdn"], tmpdir)
+            update_hostlists(ready)
+            _run_step(cfg, tmpdir, adminuser, sshprivkey, state["fqdn"], 0, install_steps[0], force=force)
+            state["setup"] = ready & linux
+        else:
+            new = (ready & linux) - state["setup"]
+            if new:
+                update_hostlists(ready)
+                for r in sorted(new):
+                    _run_step(cfg, tmpdir, adminuser, sshprivkey, state["fqdn"], 0, install_steps[0], [ "--resource", r ], force)
+                state["setup"] |= new
+
+        while state["next"] < len(install_steps):
+            idx = state["next"]
+            step = install_steps[idx]
+            if step.get("type", "jumpbox_script") == "local_script":
+                if not final:
+                    return
+            elif not set(_tag_resources(cfg, step["tag"])).issubset(state["setup"] | (ready - linux)):
+                return
+            run_step(idx, step)
+            state["next"] += 1
+
+    def run_step(idx, step):
+        # the hash is taken once all the hosts for the step are known
+        journal = state["journal"]
+        h = step_hash(tmpdir, idx, step)
+        if not force and len(state["skipped"]) == idx - 1 and journal.get(h, {}).get("status") == "succeeded":
+            log.info(f"Step {idx:02} : {step['script']} (unchanged since last success, skipping)")
+            _record_step(tmpdir, idx, step, time.time(), "skipped")
+            state["skipped"].add(idx)
+            return
+        journal[h] = { "step": idx, "script": step["script"], "status": "running", "time": time.time() }
+        _write_journal(tmpdir, journal)
+        try:
+            duration = _run_step(cfg, tmpdir, adminuser, sshprivkey, state["fqdn"], idx, step, force=force)
+        except BaseException:
+            journal[h]["status"] = "failed"
+            _write_journal(tmpdir, journal)
+            __rsync(sshprivkey, f"{tmpdir}/install/journal.json", f"{adminuser}@{state['fqdn']}:{tmpdir}/install/")
+            raise
+        journal[h].update({ "status": "succeeded", "duration": duration })
+        _write_journal(tmpdir, journal)
+
+    def ready():
+        states = dict.fromkeys(deployed, "Succeeded")
+        states.update(watcher.resource_states())
+        return ready_resources(cfg, states) | (set(deployed) & (storage | set(cfg.get("resources", {}).keys())))
+
+    for change in watcher.watch(callback):
+        if not watcher.success:
+            break
+        if change.new == "Succeeded":
+            advance(ready(), False)
+
+    if not watcher.success:
+        return None
+
+    advance(ready(), True)
+    if state["fqdn"] is None:
+        log.warning(f"{jb} or the storage was never reported ready, installing after the deployment")
+        return None
+
+    log.debug("rsyncing log files back")
+    __rsync(sshprivkey, f"{tmpdir}/install/journal.json", f"{adminuser}@{state['fqdn']}:{tmpdir}/install/")
+    __rsync(sshprivkey, f"{adminuser}@{state['fqdn']}:{tmpdir}/install/*.log", f"{tmpdir}/install/.")
+    _collect_host_logs(tmpdir, install_steps, state["skipped"])
+
+    state["inventory"].fqdn = state["fqdn"]
+    return state["inventory"]
@@ -0,0 +1,78 @@
+import json
+import logging
+import time
+
+import azutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+inventory_threads = 8
+
+# An index of all the VMs and VMSS instances in a resource group.  The
+# hostnames for each config resource and tag, and the fqdn of the install
+# node, are added by build.
+class Inventory:
+    def __init__(self, resource_group, vms=None, vmss=None, timestamp=None, fqdn=None, resources=None, tags=None):
+        self.resource_group = resource_group
+        self.vms = vms or {}
+        self.vmss = vmss or {}
+        self.timestamp = timestamp or time.time()
+        self.fqdn = fqdn
+        self.resources = resources or {}
+        self.tags = tags or {}
+        self.hosts = {}
+        for name, vm in self.vms.items():
+            self.hosts[vm.get("computer_name") or name] = vm
+        for instances in self.vmss.values():
+            for i in instances:
+                self.hosts[i["name"]] = i
+
+    def vmss_instances(self, vmss_name):
+        return [ x["name"] for x in self.vmss.get(vmss_name, []) ]
+
+    def get_host(self, hostname):
+        return self.hosts.get(hostname, None)
+
+    def private_ip(self, hostname):
+        return self.hosts.get(hostname, {}).get("private_ip", None)
+
+    def power_state(self, hostname):
+        return self.hosts.get(hostname, {}).get("power_state", None)
+
+    def not_running(self):
+        return sorted([ h for h, v in self.hosts.items() if v.get("power_state") != "VM running" ])
+
+    def to_dict(self):
+        return {
+            "resource_group": self.resource_group,
+            "timestamp": self.timestamp,
+            "fqdn": self.fqdn,
+            "vms": self.vms,
+            "vmss": self.vmss,
+            "resources": self.resources,
+            "tags": self.tags
+        }
+
+    def save(self, fname):
+        log.debug(f"writing inventory to {fname}")
+        with open(fname, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+def load(fname):
+    log.debug(f"reading inventory from {fname}")
+    with open(fname) as f:
+        return Inventory(**json.load(f))
+
+def query(resource_group):
+    log.debug(f"querying inventory for {resource_group}")
+    vms = { x["name"]: x for x in azutil.list_vms(resource_group) }
+    vmss = {}
+    names = azutil.list_vmss(resource_group)
+    if names:
+        with ThreadPoolExecutor(max_workers=min(inventory_threads, len(names))) as executor:
+            futures = { n: executor.submit(azutil.list_vmss_instances, resource_group, n) for n in names }
+            for n in names:
+                vmss[n] = futures[n].result()
+    return Inventory(resource_group, vms, vmss)
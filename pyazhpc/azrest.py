@@ -0,0 +1,245 @@
+import datetime
+import http.client
+import json
+import logging
+import subprocess
+import sys
+import threading
+import urllib.parse
+
+log = logging.getLogger(__name__)
+
+arm_endpoint = "https://management.azure.com"
+arm_resource = "https://management.azure.com/"
+vault_url = "https://{}.vault.azure.net"
+vault_resource = "https://vault.azure.net"
+
+class RestError(Exception):
+    pass
+
+# Talks to ARM directly over persistent HTTPS connections.  Only the read
+# operations are implemented, azutil uses the az cli for everything else.
+# Tokens are requested once per resource and reused until close to expiry.
+class ArmRestBackend:
+    api_versions = {
+        "Microsoft.Compute": "2019-07-01",
+        "Microsoft.Network": "2019-11-01",
+        "Microsoft.Storage": "2019-06-01",
+        "Microsoft.OperationalInsights": "2020-03-01-preview",
+        "Microsoft.NetApp": "2019-07-01",
+        "Microsoft.ContainerRegistry": "2019-05-01",
+        "Microsoft.Resources": "2019-10-01"
+    }
+
+    def __init__(self, endpoint=arm_endpoint, vault=vault_url, subscription=None, token=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.vault = vault
+        self.subscription = subscription
+        self.tokens = {}
+        if token:
+            # a fixed token (e.g. for a local stub server) never expires
+            never = datetime.datetime.max
+            self.tokens[arm_resource] = (token, never)
+            self.tokens[vault_resource] = (token, never)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if not self.subscription:
+            self.__get_token(arm_resource)
+
+    def __get_token(self, resource):
+        with self.lock:
+            token, expiry = self.tokens.get(resource, (None, None))
+            if token and expiry - datetime.timedelta(minutes=5) > datetime.datetime.now():
+                return token
+            log.debug(f"requesting access token for {resource}")
+            cmd = [
+                "az", "account", "get-access-token",
+                    "--resource", resource,
+                    "--output", "json"
+            ]
+            res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if res.returncode != 0:
+                raise RestError("unable to get access token: " + res.stderr.decode("utf-8"))
+            out = json.loads(res.stdout)
+            expiry = datetime.datetime.strptime(out["expiresOn"], "%Y-%m-%d %H:%M:%S.%f")
+            self.tokens[resource] = (out["accessToken"], expiry)
+            if not self.subscription:
+                self.subscription = out["subscription"]
+            return out["accessToken"]
+
+    def __connection(self, scheme, netloc):
+        conns = getattr(self.local, "connections", None)
+        if conns is None:
+            conns = self.local.connections = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=60)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=60)
+            conns[(scheme, netloc)] = conn
+        return conn
+
+    def request(self, method, url, resource=arm_resource, body=None):
+        token = self.__get_token(resource)
+        u = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(("", "", u.path, u.query, ""))
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+        elif method == "POST":
+            data = b""
+        log.debug(f"{method} {url}")
+        # retry once as the server may have closed an idle connection
+        for attempt in range(2):
+            conn = self.__connection(u.scheme, u.netloc)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                content = resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt == 1:
+                    raise
+        if resp.status >= 300:
+            raise RestError(f"{method} {url} returned {resp.status}: {content.decode('utf-8')}")
+        if not content:
+            return {}
+        return json.loads(content)
+
+    def __arm_url(self, path, provider):
+        api = self.api_versions[provider]
+        return f"{self.endpoint}/subscriptions/{self.subscription}{path}?api-version={api}"
+
+    def __id_url(self, rid, provider):
+        api = self.api_versions[provider]
+        return f"{self.endpoint}{rid}?api-version={api}"
+
+    def __rg_url(self, resource_group, provider, path):
+        return self.__arm_url(f"/resourceGroups/{resource_group}/providers/{provider}/{path}", provider)
+
+    def __list(self, url):
+        items = []
+        while url:
+            res = self.request("GET", url)
+            items += res.get("value", [])
+            url = res.get("nextLink", None)
+        return items
+
+    def __find_in_subscription(self, provider, rtype, name):
+        url = self.__arm_url(f"/providers/{provider}/{rtype}", provider)
+        found = [ x for x in self.__list(url) if x["name"] == name ]
+        if len(found) != 1:
+            raise RestError(f"{provider}/{rtype} {name} not found in subscription")
+        return found[0]
+
+    def __call(self, fn, *args):
+        try:
+            return fn(*args)
+        except (RestError, OSError, http.client.HTTPException) as e:
+            log.error(f"rest request failed: {e}")
+            sys.exit(1)
+
+    def get_vm_private_ip(self, resource_group, vm_name):
+        def f():
+            vm = self.request("GET", self.__rg_url(resource_group, "Microsoft.Compute", f"virtualMachines/{vm_name}"))
+            nicid = vm["properties"]["networkProfile"]["networkInterfaces"][0]["id"]
+            nic = self.request("GET", self.__id_url(nicid, "Microsoft.Network"))
+            return nic["properties"]["ipConfigurations"][0]["properties"]["privateIPAddress"]
+        return self.__call(f)
+
+    def get_fqdn(self, resource_group, public_ip):
+        def f():
+            pip = self.request("GET", self.__rg_url(resource_group, "Microsoft.Network", f"publicIPAddresses/{public_ip}"))
+            return pip["properties"].get("dnsSettings", {}).get("fqdn", "")
+        return self.__call(f)
+
+    def get_vmss_instances(self, resource_group, vmss_name):
+        def f():
+            url = self.__rg_url(resource_group, "Microsoft.Compute", f"virtualMachineScaleSets/{vmss_name}/virtualMachines")
+            return [ x["properties"]["osProfile"]["computerName"] for x in self.__list(url) ]
+        return self.__call(f)
+
+    def list_vmss(self, resource_group):
+        def f():
+            url = self.__rg_url(resource_group, "Microsoft.Compute", "virtualMachineScaleSets")
+            return [ x["name"] for x in self.__list(url) ]
+        return self.__call(f)
+
+    def list_vmss_instances(self, resource_group, vmss_name):
+        def f():
+            url = self.__rg_url(resource_group, "Microsoft.Compute", f"virtualMachineScaleSets/{vmss_name}/virtualMachines") + "&$expand=instanceView"
+            instances = []
+            for x in self.__list(url):
+                statuses = x["properties"].get("instanceView", {}).get("statuses", [])
+                power = [ st["displayStatus"] for st in statuses if st["code"].startswith("PowerState/") ]
+                instances.append({
+                    "instance_id": x["instanceId"],
+                    "name": x["properties"]["osProfile"]["computerName"],
+                    "power_state": power[0] if power else None
+                })
+            # the scale set nics are only available with an older api version
+            url = self.__rg_url(resource_group, "Microsoft.Compute", f"virtualMachineScaleSets/{vmss_name}/networkInterfaces").split("?")[0] + "?api-version=2018-10-01"
+            ips = {}
+            for nic in self.__list(url):
+                vmid = nic["properties"]["virtualMachine"]["id"]
+                ips[vmid.split("/")[-1]] = nic["properties"]["ipConfigurations"][0]["properties"]["privateIPAddress"]
+            for i in instances:
+                i["private_ip"] = ips.get(i["instance_id"], None)
+            return instances
+        return self.__call(f)
+
+    def get_deployment_status(self, resource_group, deployname):
+        def f():
+            url = self.__arm_url(f"/resourcegroups/{resource_group}/deployments/{deployname}/operations", "Microsoft.Resources")
+            return self.__list(url)
+        return self.__call(f)
+
+    def get_keyvault_secret(self, vault, key):
+        def f():
+            url = self.vault.format(vault) + f"/secrets/{key}?api-version=7.0"
+            return self.request("GET", url, resource=vault_resource)["value"]
+        return self.__call(f)
+
+    def get_storage_url(self, account):
+        def f():
+            sa = self.__find_in_subscription("Microsoft.Storage", "storageAccounts", account)
+            return sa["properties"]["primaryEndpoints"]["blob"]
+        return self.__call(f)
+
+    def get_storage_key(self, account):
+        def f():
+            sa = self.__find_in_subscription("Microsoft.Storage", "storageAccounts", account)
+            res = self.request("POST", self.__id_url(sa["id"]+"/listKeys", "Microsoft.Storage"))
+            return res["keys"][0]["value"]
+        return self.__call(f)
+
+    def get_log_analytics_workspace(self, resource_group, name):
+        def f():
+            url = self.__rg_url(resource_group, "Microsoft.OperationalInsights", f"workspaces/{name}")
+            return self.request("GET", url)["properties"]["customerId"]
+        return self.__call(f)
+
+    def get_log_analytics_key(self, resource_group, name):
+        def f():
+            url = self.__rg_url(resource_group, "Microsoft.OperationalInsights", f"workspaces/{name}/sharedKeys")
+            return self.request("POST", url)["primarySharedKey"]
+        return self.__call(f)
+
+    def get_anf_volume_ip(self, resource_group, account, pool, volume):
+        def f():
+            url = self.__rg_url(resource_group, "Microsoft.NetApp", f"netAppAccounts/{account}/capacityPools/{pool}/volumes/{volume}/mountTargets")
+            return self.__list(url)[0]["properties"]["ipAddress"]
+        return self.__call(f)
+
+    def get_acr_key(self, name):
+        def f():
+            acr = self.__find_in_subscription("Microsoft.ContainerRegistry", "registries", name)
+            res = self.request("POST", self.__id_url(acr["id"]+"/listCredentials", "Microsoft.ContainerRegistry"))
+            return res["passwords"][0]["value"]
+        return self.__call(f)
@@ -0,0 +1,204 @@
+import collections
+import hashlib
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+ssh_threads = 50
+
+# When control_dir is set ssh connections are shared through sockets there
+# (one per user and host) and kept open for control_persist seconds after
+# they were last used, so repeated commands skip the connection setup
+control_dir = None
+control_persist = 600
+
+def control_dir_for(name):
+    # a directory for each config, outside the install directory (which
+    # build removes) and short enough for the limit on socket paths
+    h = hashlib.sha256(name.encode("utf-8")).hexdigest()[:8]
+    return os.path.expanduser(f"~/.ssh/azhpc-{h}")
+
+def control_options():
+    if not control_dir:
+        return []
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_dir}/%C",
+        "-o", f"ControlPersist={control_persist}"
+    ]
+
+def ssh_options(sshkey):
+    return [
+        "-o", "StrictHostKeyChecking=no",
+        "-o", "UserKnownHostsFile=/dev/null",
+        "-i", sshkey
+    ] + control_options()
+
+def proxy_command(sshkey, jump):
+    # connects through the install node, sharing its connection
+    return "ProxyCommand=" + " ".join([ "ssh", "-q" ] + [ shlex.quote(x) for x in ssh_options(sshkey) ] + [ "-W", "%h:%p", jump ])
+
+# The outcome of a command on one host, returncode is None if it timed out
+HostResult = collections.namedtuple(
+    "HostResult",
+    [ "host", "returncode", "stdout", "stderr", "duration", "start" ],
+    defaults=[ None ]
+)
+
+# Runs ssh and rsync as subprocesses.  The cluster hosts are reached through
+# the install node (jump) when it is set, a port can be given to use a
+# local sshd instead.
+class SshTransport:
+    def __init__(self, user, sshkey, jump=None, port=None):
+        self.user = user
+        self.sshkey = sshkey
+        self.jump = jump
+        self.port = port
+
+    def ssh_options(self):
+        opts = ssh_options(self.sshkey) + [
+            "-o", "LogLevel=ERROR",
+            "-o", "BatchMode=yes"
+        ]
+        if self.port:
+            opts += [ "-p", str(self.port) ]
+        if self.jump:
+            opts += [ "-o", proxy_command(self.sshkey, self.jump) ]
+        return opts
+
+    def __exec(self, cmd, timeout):
+        try:
+            res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            return None, e.stdout or b"", e.stderr or b""
+        return res.returncode, res.stdout, res.stderr
+
+    def run(self, host, command, timeout=None):
+        cmd = [ "ssh" ] + self.ssh_options() + [ f"{self.user}@{host}", command ]
+        return self.__exec(cmd, timeout)
+
+    def close(self, host):
+        # stops a shared connection, e.g. when the host is rebooting
+        if not control_dir:
+            return 0, b"", b""
+        cmd = [ "ssh" ] + self.ssh_options() + [ "-O", "exit", f"{self.user}@{host}" ]
+        return self.__exec(cmd, 30)
+
+    def push(self, host, src, dst, timeout=None):
+        cmd = [
+            "rsync", "-a", "-e", " ".join([ "ssh" ] + [ shlex.quote(x) for x in self.ssh_options() ]),
+                src, f"{self.user}@{host}:{dst}"
+        ]
+        return self.__exec(cmd, timeout)
+
+# Runs the same command (or file push) on many hosts at once, with a limit
+# on how many are in progress.  Commands get the same PSSH_NODENUM and
+# PSSH_HOST environment as pssh so the install scripts work with either.
+class ParallelSsh:
+    def __init__(self, transport, threads=ssh_threads, timeout=None):
+        self.transport = transport
+        self.threads = threads
+        self.timeout = timeout
+
+    def __each(self, hosts, fn, callback):
+        # callback is given each result as soon as the host finishes
+        def timed(n, host):
+            starttime = time.time()
+            returncode, stdout, stderr = fn(n, host)
+            r = HostResult(host, returncode, stdout.decode("utf-8", "replace"), stderr.decode("utf-8", "replace"), time.time() - starttime, starttime)
+            if callback:
+                callback(r)
+            return r
+
+        results = collections.OrderedDict()
+        if not hosts:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.threads, len(hosts))) as executor:
+            futures = [ executor.submit(timed, n, h) for n, h in enumerate(hosts) ]
+            for f in futures:
+                r = f.result()
+                results[r.host] = r
+        return results
+
+    def run(self, hosts, command, callback=None):
+        log.debug(f"running on {len(hosts)} hosts: {command}")
+        return self.__each(hosts, lambda n, h: self.transport.run(
+            h, f"export PSSH_NODENUM={n} PSSH_HOST={h}; {command}", self.timeout
+        ), callback)
+
+    def close(self, hosts):
+        return self.__each(hosts, lambda n, h: self.transport.close(h), None)
+
+    def push(self, hosts, src, dst, callback=None):
+        log.debug(f"pushing {src} to {len(hosts)} hosts")
+        return self.__each(hosts, lambda n, h: self.transport.push(h, src, dst, self.timeout), callback)
+
+boot_id = "cat /proc/sys/kernel/random/boot_id"
+
+def reboot(pssh, hosts, timeout, min_delay=2, max_delay=30):
+    # Reboots the hosts and probes them all until each answers with a new
+    # boot id.  Every host backs off on its own between probes and gives up
+    # at the deadline.  Returns the seconds each host took and the hosts
+    # that did not come back.  A host whose boot id could not be read first
+    # has to be seen going down before an answer counts.
+    before = { h: r.stdout.strip() for h, r in pssh.run(hosts, boot_id).items() if r.returncode == 0 and r.stdout.strip() }
+    unknown = set(hosts) - set(before.keys())
+    probe = ParallelSsh(pssh.transport, pssh.threads, timeout=30)
+    probe.run(hosts, "sudo reboot")
+    pssh.close(hosts)
+    start = time.time()
+    deadline = start + timeout
+    pending = { h: (start + min_delay, min_delay) for h in hosts }
+    rebooted = {}
+    while pending:
+        now = time.time()
+        if now >= deadline:
+            break
+        due = [ h for h, (t, d) in pending.items() if t <= now ]
+        if not due:
+            time.sleep(min(min([ t for t, d in pending.values() ]), deadline) - now)
+            continue
+        for h, r in probe.run(due, boot_id).items():
+            current = r.stdout.strip()
+            if r.returncode != 0:
+                unknown.discard(h)
+            if r.returncode == 0 and current and h not in unknown and current != before.get(h, None):
+                rebooted[h] = time.time() - start
+                del pending[h]
+            else:
+                delay = min(pending[h][1] * 2, max_delay)
+                pending[h] = (time.time() + delay, delay)
+        log.debug(f"{len(rebooted)} hosts rebooted, {len(pending)} waiting")
+    return rebooted, sorted(pending.keys())
+
+def failed(results):
+    return [ h for h, r in results.items() if r.returncode != 0 ]
+
+def format_results(results):
+    # the same layout as 'pssh -i'
+    lines = []
+    for n, r in enumerate(results.values()):
+        stamp = time.strftime("%H:%M:%S")
+        if r.returncode == 0:
+            lines.append(f"[{n+1}] {stamp} [SUCCESS] {r.host}")
+        elif r.returncode is None:
+            lines.append(f"[{n+1}] {stamp} [FAILURE] {r.host} Timed out")
+        else:
+            lines.append(f"[{n+1}] {stamp} [FAILURE] {r.host} Exited with error code {r.returncode}")
+        if r.stdout:
+            lines.append(r.stdout.rstrip("\n"))
+        if r.stderr:
+            lines.append("Stderr: " + r.stderr.rstrip("\n"))
+    return "\n".join(lines) + "\n" if lines else ""
+
+def print_results(results, out=sys.stdout):
+    out.write(format_results(results))
+    out.flush()
@@ -0,0 +1,160 @@
+import collections
+import glob
+import json
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+# written at the top of each generated step log so the pssh times (which
+# only have the time of day) can be turned into timestamps
+start_marker = "#azhpc start"
+
+__lock = threading.Lock()
+
+def telemetry_file(tmpdir):
+    return f"{tmpdir}/install/telemetry.jsonl"
+
+def record(tmpdir, event, **fields):
+    entry = dict(event=event, **fields)
+    with __lock:
+        with open(telemetry_file(tmpdir), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+def record_results(tmpdir, step, action, results):
+    # results are the azssh.HostResult for each host
+    for r in results.values():
+        record(
+            tmpdir, "host",
+            step=step, action=action, host=r.host,
+            start=r.start, end=r.start + r.duration,
+            returncode=r.returncode,
+            stdout_bytes=len(r.stdout.encode("utf-8")),
+            stderr_bytes=len(r.stderr.encode("utf-8"))
+        )
+
+def load(tmpdir):
+    fname = telemetry_file(tmpdir)
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return [ json.loads(l) for l in f if l.strip() ]
+
+__header = re.compile(r"^\[\d+\] (\d\d):(\d\d):(\d\d) \[(SUCCESS|FAILURE)\] (\S+)(?: Exited with error code (\d+))?")
+__rebooted = re.compile(r"^\s+(\S+) rebooted \((\d+)s\)$")
+__not_back = re.compile(r"^\s+(\S+) did not come back within (\d+)s$")
+
+def parse_pssh_log(text, runs=1):
+    # Reads the 'pssh -i' output in a step log.  The start of the host's
+    # first action is the start of the step and each later one starts when
+    # the previous one on that host ended.  The logs on the install node are
+    # appended to by each build so only the last runs are read.
+    sections = []
+    hosts = []
+    base = None
+    last_end = {}
+    current = None
+    in_stderr = False
+    for line in text.splitlines():
+        if line.startswith(start_marker):
+            epoch, clock = line[len(start_marker):].split()
+            h, m, s = [ int(x) for x in clock.split(":") ]
+            base = (float(epoch), h*3600 + m*60 + s)
+            hosts = []
+            sections.append(hosts)
+            last_end = {}
+            current = None
+            continue
+        if base is None:
+            continue
+        match = __header.match(line)
+        if match:
+            h, m, s = [ int(x) for x in match.group(1, 2, 3) ]
+            end = base[0] + (h*3600 + m*60 + s - base[1]) % 86400
+            host = match.group(5)
+            if match.group(4) == "SUCCESS":
+                returncode = 0
+            elif match.group(6):
+                returncode = int(match.group(6))
+            else:
+                returncode = None
+            current = {
+                "action": "pssh", "host": host,
+                "start": last_end.get(host, base[0]), "end": end,
+                "returncode": returncode, "stdout_bytes": 0, "stderr_bytes": 0
+            }
+            last_end[host] = end
+            hosts.append(current)
+            in_stderr = False
+            continue
+        match = __rebooted.match(line) or __not_back.match(line)
+        if match:
+            host = match.group(1)
+            start = last_end.get(host, base[0])
+            end = start + int(match.group(2))
+            hosts.append({
+                "action": "reboot", "host": host, "start": start, "end": end,
+                "returncode": 0 if "rebooted" in line else None,
+                "stdout_bytes": 0, "stderr_bytes": 0
+            })
+            last_end[host] = end
+            current = None
+            continue
+        if current is not None:
+            if line.startswith("Stderr: "):
+                in_stderr = True
+                line = line[len("Stderr: "):]
+            current["stderr_bytes" if in_stderr else "stdout_bytes"] += len(line) + 1
+    return [ h for hosts in sections[-runs:] for h in hosts ]
+
+def collect_pssh_logs(tmpdir, skip=()):
+    # adds the host records from the logs of the steps run by pssh on the
+    # install node, which only come back at the end of the install (the
+    # steps in skip were not run and their logs are from an earlier build).
+    # A step can be run more than once in a build, e.g. the node setup for
+    # each resource in a pipelined build.
+    runs = collections.Counter([
+        r["step"] for r in load(tmpdir) if r["event"] == "step" and r["status"] != "skipped"
+    ])
+    for fname in sorted(glob.glob(f"{tmpdir}/install/[0-9][0-9]_*.log")):
+        step = int(os.path.basename(fname)[:2])
+        if step in skip:
+            continue
+        with open(fname, errors="replace") as f:
+            text = f.read()
+        if start_marker not in text:
+            continue
+        for h in parse_pssh_log(text, max(runs[step], 1)):
+            record(tmpdir, "host", step=step, **h)
+
+def report(records, top=10):
+    lines = []
+    steps = [ r for r in records if r["event"] == "step" ]
+    hosts = [ r for r in records if r["event"] == "host" ]
+    scripts = { r["step"]: r["script"] for r in steps }
+
+    lines.append("Slowest steps:")
+    for r in sorted(steps, key=lambda r: r["end"] - r["start"], reverse=True)[:top]:
+        lines.append(f"    {r['step']:02} {r['script']:30} {r.get('tag') or '':15} {r['status']:10} {r['end'] - r['start']:7.0f}s")
+
+    totals = collections.defaultdict(float)
+    slowest = {}
+    for r in hosts:
+        duration = r["end"] - r["start"]
+        totals[r["host"]] += duration
+        if duration > slowest.get(r["host"], (None, -1))[1]:
+            slowest[r["host"]] = (r["step"], duration)
+    lines.append("Slowest hosts (total time in install steps):")
+    for h in sorted(totals.keys(), key=lambda h: totals[h], reverse=True)[:top]:
+        step, duration = slowest[h]
+        lines.append(f"    {h:20} {totals[h]:7.0f}s  slowest: {step:02} {scripts.get(step, ''):30} {duration:7.0f}s")
+
+    failures = [ r for r in hosts if r["returncode"] != 0 ]
+    if failures:
+        lines.append("Failures:")
+        for r in failures:
+            status = "timed out" if r["returncode"] is None else f"exit code {r['returncode']}"
+            lines.append(f"    {r['host']:20} {r['step']:02} {scripts.get(r['step'], ''):30} {r['action']:8} {status}")
+    return "\n".join(lines)
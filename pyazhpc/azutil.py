@@ -1,14 +1,49 @@
+import base64
 import datetime
+import functools
+import hashlib
+import hmac
 import json
 import logging
 import os
 import shlex
 import subprocess
 import sys
+import threading
 import time
+import urllib.parse
 
 log = logging.getLogger(__name__)
 
+# when set, calls are sent to this backend if it implements them
+backend = None
+
+def set_backend(name, **kwargs):
+    global backend
+    if name == "cli":
+        backend = None
+    elif name == "rest":
+        import azrest
+        try:
+            backend = azrest.ArmRestBackend(**kwargs)
+        except azrest.RestError as e:
+            log.warning(f"unable to use rest backend, falling back to az cli ({e})")
+            backend = None
+    elif name == "offline":
+        import azvalidate
+        backend = azvalidate.OfflineBackend()
+    else:
+        log.error(f"unknown backend ({name})")
+        sys.exit(1)
+
+def _pluggable(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if backend is not None and hasattr(backend, f.__name__):
+            return getattr(backend, f.__name__)(*args, **kwargs)
+        return f(*args, **kwargs)
+    return wrapper
+
 def _make_subprocess_error_string(res):
     return "\n    args={}\n    return code={}\n    stdout={}\n    stderr={}".format(res.args, res.returncode, res.stdout.decode("utf-8"), res.stderr.decode("utf-8"))
 
@@ -20,6 +55,7 @@ def get_subscription():
         sys.exit(1)
     return res.stdout
 
+@_pluggable
 def get_vm_private_ip(resource_group, vm_name):
     cmd = [
         "az", "vm", "list-ip-addresses",
@@ -35,6 +71,7 @@ def get_vm_private_ip(resource_group, vm_name):
     out = res.stdout.splitlines()
     return out[0].decode("utf-8")
 
+@_pluggable
 def get_fqdn(resource_group, public_ip):
     cmd = [ 
         "az", "network", "public-ip", "show", 
@@ -50,6 +87,7 @@ def get_fqdn(resource_group, public_ip):
     out = res.stdout.splitlines()
     return out[0].decode("utf-8")
 
+@_pluggable
 def get_vmss_instances(resource_group, vmss_name):
     cmd = [ 
         "az", "vmss", "list-instances",
@@ -65,6 +103,66 @@ def get_vmss_instances(resource_group, vmss_name):
     names = [ x.decode("utf-8") for x in res.stdout.splitlines() ]
     return names
 
+@_pluggable
+def list_vms(resource_group):
+    cmd = [
+        "az", "vm", "list", "--show-details",
+            "--resource-group", resource_group,
+            "--query", "[].{name:name, computer_name:osProfile.computerName, private_ip:privateIps, power_state:powerState}",
+            "--output", "json"
+    ]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        log.error("invalid returncode"+_make_subprocess_error_string(res))
+        sys.exit(1)
+    return json.loads(res.stdout)
+
+@_pluggable
+def list_vmss(resource_group):
+    cmd = [
+        "az", "vmss", "list",
+            "--resource-group", resource_group,
+            "--query", "[].name",
+            "--output", "tsv"
+    ]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        log.error("invalid returncode"+_make_subprocess_error_string(res))
+        sys.exit(1)
+    return [ x.decode("utf-8") for x in res.stdout.splitlines() ]
+
+@_pluggable
+def list_vmss_instances(resource_group, vmss_name):
+    cmd = [
+        "az", "vmss", "list-instances",
+            "--resource-group", resource_group,
+            "--name", vmss_name,
+            "--expand", "instanceView",
+            "--query", "[].{instance_id:instanceId, name:osProfile.computerName, power_state:instanceView.statuses[?starts_with(code, 'PowerState/')].displayStatus | [0]}",
+            "--output", "json"
+    ]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        log.error("invalid returncode"+_make_subprocess_error_string(res))
+        sys.exit(1)
+    instances = json.loads(res.stdout)
+
+    cmd = [
+        "az", "vmss", "nic", "list",
+            "--resource-group", resource_group,
+            "--vmss-name", vmss_name,
+            "--query", "[].{vm:virtualMachine.id, ip:ipConfigurations[0].privateIpAddress}",
+            "--output", "json"
+    ]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        log.error("invalid returncode"+_make_subprocess_error_string(res))
+        sys.exit(1)
+    ips = { x["vm"].split("/")[-1]: x["ip"] for x in json.loads(res.stdout) }
+    for i in instances:
+        i["private_ip"] = ips.get(i["instance_id"], None)
+    return instances
+
 def create_resource_group(resource_group, location, tags=None):
     log.debug("creating resource group")
     if tags is None:
@@ -115,6 +213,7 @@ def deploy(resource_group, arm_template):
 
     return deployname
 
+@_pluggable
 def get_deployment_status(resource_group, deployname):
     cmd = [
         "az", "group", "deployment", "operation", "list",
@@ -128,6 +227,7 @@ def get_deployment_status(resource_group, deployname):
     
     return json.loads(res.stdout)
         
+@_pluggable
 def get_keyvault_secret(vault, key):
     cmd = [
         "az", "keyvault", "secret", "show",
@@ -143,6 +243,7 @@ def get_keyvault_secret(vault, key):
     secret = out[0].decode('utf-8')
     return secret
 
+@_pluggable
 def get_storage_url(account):
     cmd = [
         "az", "storage", "account", "show",
@@ -159,6 +260,7 @@ def get_storage_url(account):
     url = out[0].decode('utf-8')
     return url
 
+@_pluggable
 def get_storage_key(account):
     cmd = [
         "az", "storage", "account", "keys", "list",
@@ -175,28 +277,51 @@ def get_storage_key(account):
     key = out[0].decode('utf-8')
     return key
 
-def get_storage_saskey(account, container, permissions):
+# account keys are only fetched once and then used to sign sas keys locally
+_storage_keys = {}
+_storage_keys_lock = threading.Lock()
+
+sas_version = "2018-11-09"
+
+def _get_cached_storage_key(account):
+    with _storage_keys_lock:
+        if account not in _storage_keys:
+            _storage_keys[account] = get_storage_key(account)
+        return _storage_keys[account]
+
+def generate_storage_saskey(account, key, container, permissions, start, expiry, blob=None):
+    # permissions must be given in this order for the signature to be valid
+    sp = "".join([ p for p in "racwdxyltfmeopi" if p in permissions ])
+    resource = f"/blob/{account}/{container}"
+    sr = "c"
+    if blob:
+        resource += f"/{blob}"
+        sr = "b"
+    string_to_sign = "\n".join([
+        sp, start, expiry, resource,
+        "", "", "", # identifier, ip and protocol
+        sas_version, sr,
+        "", "", "", "", "", "" # snapshot time and response headers
+    ])
+    sig = base64.b64encode(
+        hmac.new(
+            base64.b64decode(key),
+            string_to_sign.encode("utf-8"),
+            hashlib.sha256
+        ).digest()
+    ).decode("utf-8")
+    fields = [ ("st", start), ("se", expiry), ("sp", sp), ("sv", sas_version), ("sr", sr), ("sig", sig) ]
+    return "&".join([ f"{k}={urllib.parse.quote(v, safe='')}" for k, v in fields ])
+
+@_pluggable
+def get_storage_saskey(account, container, permissions, blob=None):
     log.debug(f"creating sas key: container={container}, permissions={permissions}")
     start = (datetime.datetime.utcnow() - datetime.timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%SZ")
     expiry = (datetime.datetime.utcnow() + datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
-    cmd = [
-        "az", "storage", "container", "generate-sas",
-            "--account-name", account,
-            "--name", container,
-            "--permissions", permissions,
-            "--start", start,
-            "--expiry", expiry,
-            "--output", "tsv"
-    ]
-    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if res.returncode != 0:
-        log.error("invalid returncode"+_make_subprocess_error_string(res))
-    out = res.stdout.splitlines()
-    if len(out) != 1:
-        log.error("unexpected output"+_make_subprocess_error_string(res))
-    saskey = out[0].decode('utf-8')
-    return saskey
+    key = _get_cached_storage_key(account)
+    return generate_storage_saskey(account, key, container, permissions, start, expiry, blob)
 
+@_pluggable
 def get_log_analytics_workspace(resource_group, name):
     cmd = [
         "az", "monitor", "log-analytics", "workspace", "list",
@@ -212,6 +337,7 @@ def get_log_analytics_workspace(resource_group, name):
     saskey = out[0].decode('utf-8')
     return saskey
 
+@_pluggable
 def get_log_analytics_key(resource_group, name):
     cmd = [
         "az", "monitor", "log-analytics", "workspace", "get-shared-keys",
@@ -229,6 +355,7 @@ def get_log_analytics_key(resource_group, name):
     saskey = out[0].decode('utf-8')
     return saskey
 
+@_pluggable
 def get_anf_volume_ip(resource_group, account, pool, volume):
     cmd = [ 
         "az", "netappfiles", "list-mount-targets",
@@ -248,6 +375,7 @@ def get_anf_volume_ip(resource_group, account, pool, volume):
     ip = out[0].decode('utf-8')
     return ip
 
+@_pluggable
 def get_acr_key(name):
     cmd = [
         "az", "acr", "credential", "show",
@@ -0,0 +1,68 @@
+import collections
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+# Answers every azutil lookup with a placeholder so a template can be built
+# without going to azure
+class OfflineBackend:
+    def __getattr__(self, name):
+        def placeholder(*args, **kwargs):
+            log.debug(f"offline: {name}{args}")
+            return "<{}:{}>".format(name, ",".join([ str(a) for a in args ]))
+        return placeholder
+
+def check(tpl):
+    # the problems in the template that would fail the deployment
+    errors = []
+    for key in tpl.duplicates():
+        errors.append(f"{key} is in the template more than once")
+    for res, ref in tpl.unresolved():
+        errors.append(f"{res['name']} ({res['type']}) refers to {ref} which is not in the template")
+    for cycle in tpl.cycles():
+        names = [ res["name"] for res in cycle ]
+        errors.append("dependency cycle: " + " -> ".join(names + names[:1]))
+    return errors
+
+# e.g. Standard_HB60rs, Standard_D16s_v3 or Standard_E64-32s_v3
+__size = re.compile(r"^(?:Standard|Basic)_([A-Z]+)(\d+)(?:-\d+)?([a-z]*)(?:_[Vv](\d+))?")
+
+def vm_family(size):
+    # the family (as it is grouped for quota) and cores from the size name,
+    # the cores are None if the name is not understood
+    match = __size.match(size)
+    if not match:
+        return size, None
+    letters, cores, features, version = match.groups()
+    family = letters + ("S" if "s" in features else "") + (f"v{version}" if version else "")
+    return family, int(cores)
+
+def counts(tpl):
+    # the number of VMs and cores for each family and the public ips
+    vms = collections.OrderedDict()
+    for res in tpl.find_type("Microsoft.Compute/virtualMachines"):
+        vms.setdefault(res["properties"]["hardwareProfile"]["vmSize"], []).append(res.get("copy", {}).get("count", 1))
+    for res in tpl.find_type("Microsoft.Compute/virtualMachineScaleSets"):
+        vms.setdefault(res["sku"]["name"], []).append(res["sku"]["capacity"] or 0)
+
+    families = collections.OrderedDict()
+    for size, instances in vms.items():
+        family, cores = vm_family(size)
+        f = families.setdefault(family, { "vms": 0, "cores": 0 })
+        f["vms"] += sum(instances)
+        if cores is None or f["cores"] is None:
+            f["cores"] = None
+        else:
+            f["cores"] += cores * sum(instances)
+
+    public_ips = sum([ res.get("copy", {}).get("count", 1) for res in tpl.find_type("Microsoft.Network/publicIPAddresses") ])
+    return families, public_ips
+
+def report(families, public_ips):
+    lines = [ "Quota needed:" ]
+    for family, f in families.items():
+        cores = "unknown" if f["cores"] is None else f["cores"]
+        lines.append(f"    {family:15} {f['vms']:6} vms {cores:>8} cores")
+    lines.append(f"    {'public ips':15} {public_ips:6}")
+    return "\n".join(lines)
@@ -0,0 +1,55 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+# A minimal stand-in for the ARM/key vault rest endpoints.  Responses are
+# registered per (method, path) and every request is recorded so tests can
+# check what was sent.
+class ArmStub:
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.connections = set()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def __reply(self, method):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                path = urllib.parse.urlsplit(self.path).path
+                stub.requests.append((method, self.path, body))
+                stub.connections.add(self.client_address)
+                status, res = stub.responses.get((method, path), (404, { "error": "not found" }))
+                content = json.dumps(res).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.__reply("GET")
+
+            def do_POST(self):
+                self.__reply("POST")
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def add(self, method, path, res, status=200):
+        self.responses[(method, path)] = (status, res)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,165 @@
+import copy
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+import arm
+
+cfg = {
+    "location": "westeurope",
+    "resource_group": "rg",
+    "install_from": "headnode",
+    "admin_user": "hpcadmin",
+    "vnet": {
+        "name": "hpcvnet",
+        "address_prefix": "10.2.0.0/20",
+        "subnets": { "compute": "10.2.4.0/22" }
+    },
+    "resources": {
+        "headnode": {
+            "type": "vm",
+            "vm_type": "Standard_D2s_v3",
+            "image": "OpenLogic:CentOS:7.6:latest",
+            "subnet": "compute",
+            "public_ip": True
+        },
+        "compute": {
+            "type": "vm",
+            "vm_type": "Standard_HC44rs",
+            "image": "OpenLogic:CentOS:7.6:latest",
+            "subnet": "compute",
+            "instances": 300
+        }
+    }
+}
+
+class TestArmTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        with open("hpcadmin_id_rsa.pub", "w") as f:
+            f.write("ssh-rsa AAAA hpcadmin\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def template(self, copy_loops):
+        tpl = arm.ArmTemplate(copy_loops)
+        with mock.patch("uuid.uuid4", return_value=uuid.UUID(int=0)):
+            tpl.read(cfg)
+        return tpl
+
+    def names(self, tpl, rtype):
+        return [ r["name"] for r in tpl.resources if r["type"] == rtype ]
+
+    def test_unrolled(self):
+        tpl = self.template(False)
+        vms = self.names(tpl, "Microsoft.Compute/virtualMachines")
+        self.assertEqual(len(vms), 301)
+        self.assertEqual(vms[:3], [ "headnode", "compute0001", "compute0002" ])
+
+    def test_copy_loops(self):
+        tpl = self.template(True)
+        vms = [ r for r in tpl.resources if r["type"] == "Microsoft.Compute/virtualMachines" ]
+        # a single instance is written as before
+        self.assertEqual(vms[0]["name"], "headnode")
+        self.assertNotIn("copy", vms[0])
+        self.assertEqual(vms[1]["name"], "[concat('compute', padLeft(copyIndex(1), 4, '0'), '')]")
+        self.assertEqual(vms[1]["copy"], { "name": "compute-vm", "count": 300 })
+        self.assertEqual(vms[1]["properties"]["osProfile"]["computerName"], vms[1]["name"])
+        self.assertEqual(vms[1]["dependsOn"], [
+            "[resourceId('Microsoft.Network/networkInterfaces', concat('compute', padLeft(copyIndex(1), 4, '0'), 'nic'))]"
+        ])
+        self.assertEqual(len(tpl.resources), 1 + 4 + 2)
+        self.assertLess(len(tpl.to_json()), len(self.template(False).to_json()) / 50)
+
+    def test_index(self):
+        tpl = self.template(False)
+        nic = tpl.find("Microsoft.Network/networkInterfaces", "compute0002nic")
+        self.assertIs(nic, tpl.resources[7])
+        self.assertIs(tpl.find("microsoft.network/virtualnetworks", "HPCVNET"), tpl.resources[0])
+        self.assertIsNone(tpl.find("Microsoft.Network/networkInterfaces", "compute0301nic"))
+        self.assertEqual(tpl.find("Microsoft.Network/virtualNetworks/subnets", "hpcvnet/compute")["properties"]["addressPrefix"], "10.2.4.0/22")
+        self.assertEqual(len(tpl.find_type("Microsoft.Compute/virtualMachines")), 301)
+
+        vm = tpl.find("Microsoft.Compute/virtualMachines", "compute0002")
+        self.assertEqual(tpl.dependencies(vm), [ nic ])
+        self.assertEqual(tpl.dependents(nic), [ vm ])
+        self.assertEqual(len(tpl.dependents(tpl.resources[0])), 301)
+
+    def test_shards(self):
+        tpl = self.template(False)
+        shards = tpl.shards(250)
+        self.assertEqual(list(shards.keys()), [ "network", "headnode", "compute-1", "compute-2", "compute-3" ])
+        # whole VMs (nic and vm) in each shard
+        self.assertEqual([ len(shards[s]) for s in shards ], [ 1, 4, 250, 250, 100 ])
+        self.assertEqual(shards["compute-2"][0]["name"], "compute0126nic")
+        # the vnet is in the network deployment
+        self.assertEqual(shards["compute-2"][0]["dependsOn"], [])
+        self.assertEqual(shards["headnode"][3]["dependsOn"], [ "Microsoft.Network/networkInterfaces/headnodenic" ])
+        self.assertEqual(len(tpl.resources[3]["dependsOn"]), 3)
+
+        deployments = json.loads(tpl.to_json(250))["resources"]
+        self.assertEqual(deployments[2]["name"], "[concat(deployment().name, '-compute-1')]")
+        self.assertEqual(deployments[2]["dependsOn"], [
+            "[resourceId('Microsoft.Resources/deployments', concat(deployment().name, '-network'))]"
+        ])
+        self.assertEqual(len(deployments[2]["properties"]["template"]["resources"]), 250)
+
+    def test_shards_routes(self):
+        routed = copy.deepcopy(cfg)
+        routed["vnet"]["routes"] = {
+            "vpnroute": { "address_prefix": "192.168.0.0/16", "next_hop": "headnode", "subnet": "compute" }
+        }
+        tpl = arm.ArmTemplate()
+        tpl.read(routed)
+        shards = tpl.shards(250)
+        # the route table needs the address of the next hop nic
+        self.assertEqual([ r["name"] for r in shards["network"] ], [ "hpcvnet" ])
+        self.assertEqual([ r["name"] for r in shards["headnode"] ], [
+            "headnodepip", "headnodensg", "headnodenic", "headnode", "vpnroute", "vpnroute/vpnroute", "hpcvnet/compute"
+        ])
+        self.assertEqual(shards["headnode"][4]["dependsOn"], [ "Microsoft.Network/networkInterfaces/headnodenic" ])
+
+    def test_shards_skip_network(self):
+        tpl = self.template(False)
+        tpl.skip([ k for k in tpl.resource_hashes().keys() if not k.endswith("/headnode") ])
+        deployments = json.loads(tpl.to_json(250))["resources"]
+        # the network is already deployed so there is nothing to wait for
+        self.assertEqual([ d["name"] for d in deployments ], [ "[concat(deployment().name, '-headnode')]" ])
+        self.assertEqual(deployments[0]["dependsOn"], [])
+
+    def test_shards_copy_loops(self):
+        shards = self.template(True).shards(250)
+        # a copy loop can't be split
+        self.assertEqual([ len(shards[s]) for s in shards ], [ 1, 4, 2 ])
+        self.assertEqual(list(shards.keys())[-1], "compute")
+
+    def test_hashes(self):
+        # the random dns label is not a change
+        first = arm.ArmTemplate()
+        first.read(cfg)
+        second = arm.ArmTemplate()
+        second.read(cfg)
+        hashes = first.resource_hashes()
+        self.assertEqual(hashes, second.resource_hashes())
+        self.assertEqual(list(hashes.keys())[:2], [ "Microsoft.Network/virtualNetworks/hpcvnet", "Microsoft.Network/publicIPAddresses/headnodepip" ])
+
+    def test_skip(self):
+        tpl = self.template(False)
+        unchanged = [ k for k in tpl.resource_hashes().keys() if not k.endswith("/headnode") ]
+        skipped = tpl.skip(unchanged)
+        self.assertEqual([ r["name"] for r in tpl.resources ], [ "headnode" ])
+        self.assertEqual(tpl.resources[0]["dependsOn"], [])
+        self.assertIn("compute", skipped)
+        self.assertIn("headnodepip", skipped)
+        self.assertEqual(list(tpl.shards().keys()), [ "headnode" ])
+
+if __name__ == "__main__":
+    unittest.main()
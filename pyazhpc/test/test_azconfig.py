@@ -1,4 +1,8 @@
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 import azconfig
 
@@ -20,5 +24,136 @@ class TestConfigFile(unittest.TestCase):
     def test_replace_double_curly_braces(self):
         self.assertEqual(self.config.read_value("double_curly_braces"), "simple_variable=42")
 
+class TestVariableGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.config = azconfig.ConfigFile()
+
+    def test_chain_evaluated_once(self):
+        self.config.data = {
+            "a": "variables.foo",
+            "b": [ "{{variables.foo}}-{{variables.bar}}" ] * 3,
+            "variables": {
+                "foo": "variables.bar",
+                "bar": "variables.baz",
+                "baz": "value"
+            }
+        }
+        with self.assertLogs("azconfig", level="DEBUG") as logs:
+            res = self.config.preprocess()
+        self.assertEqual(res["a"], "value")
+        self.assertEqual(res["b"], [ "value-value" ] * 3)
+        # each variable is only evaluated once (plus once when collecting lookups)
+        evaluated = [ l for l in logs.output if l.endswith("process_value (enter): variables.baz") ]
+        self.assertEqual(len(evaluated), 2)
+
+    def test_cycle(self):
+        self.config.data = {
+            "a": "variables.foo",
+            "variables": {
+                "foo": "variables.bar",
+                "bar": "x-{{variables.foo}}"
+            }
+        }
+        with self.assertLogs("azconfig", level="ERROR") as logs:
+            with self.assertRaises(SystemExit):
+                self.config.preprocess()
+        self.assertIn("foo -> bar -> foo", logs.output[0])
+
+    def test_replace_vars_resets(self):
+        self.config.data = { "variables": { "foo": "one" } }
+        self.assertEqual(self.config.read_value("variables.foo"), "one")
+        self.config.replace_vars({ "foo": "two" })
+        self.assertEqual(self.config.read_value("variables.foo"), "two")
+
+class TestLazyConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.config = azconfig.ConfigFile()
+        self.config.data = {
+            "admin_user": "variables.user",
+            "install": [
+                { "script": "setup.sh", "args": [ "secret.vault.key" ] }
+            ],
+            "variables": { "user": "hpcadmin" }
+        }
+
+    @mock.patch("azutil.get_keyvault_secret", return_value="s3cr3t")
+    def test_resolved_on_access(self, get_secret):
+        lazy = self.config.lazy()
+        self.assertEqual(lazy["admin_user"], "hpcadmin")
+        self.assertEqual(lazy.get("missing", "default"), "default")
+        get_secret.assert_not_called()
+        self.assertEqual(lazy["install"][0]["args"], [ "s3cr3t" ])
+        self.assertEqual([ { "script": "node_setup.sh" } ] + lazy["install"], [
+            { "script": "node_setup.sh" },
+            { "script": "setup.sh", "args": [ "s3cr3t" ] }
+        ])
+        get_secret.assert_called_once()
+
+    @mock.patch("azutil.get_keyvault_secret", return_value="s3cr3t")
+    def test_prefetch_keys(self, get_secret):
+        lazy = self.config.lazy()
+        lazy.prefetch("admin_user")
+        get_secret.assert_not_called()
+        lazy.prefetch("install")
+        get_secret.assert_called_once_with("vault", "key")
+
+class TestResolverCache(unittest.TestCase):
+
+    def setUp(self):
+        self.config = azconfig.ConfigFile()
+        self.config.data = {
+            "resource_group": "rg",
+            "a": "secret.vault.key",
+            "b": [ "secret.vault.key", "pw={{secret.vault.key}}" ],
+            "c": "fqdn.headnode"
+        }
+
+    @mock.patch("azutil.get_fqdn", return_value="headnode.example.com")
+    @mock.patch("azutil.get_keyvault_secret", return_value="s3cr3t")
+    def test_lookup_once(self, get_secret, get_fqdn):
+        self.config.preprocess()
+        self.assertEqual(self.config.read_value("a"), "s3cr3t")
+        get_secret.assert_called_once_with("vault", "key")
+
+    @mock.patch("azutil.get_fqdn", return_value="headnode.example.com")
+    @mock.patch("azutil.get_keyvault_secret", side_effect=lambda v, k: k+"-value")
+    def test_prefetch_collects_lookups(self, get_secret, get_fqdn):
+        self.config.data["d"] = "secret.vault.{{variables.other}}"
+        self.config.data["variables"] = { "other": "key2" }
+        self.config.prefetch()
+        self.assertTrue(self.config.cache.has("secret", "vault", "key"))
+        self.assertTrue(self.config.cache.has("secret", "vault", "key2"))
+        self.assertTrue(self.config.cache.has("fqdn", "rg", "headnodepip"))
+        self.assertEqual(get_secret.call_count, 2)
+        self.assertEqual(self.config.preprocess()["d"], "key2-value")
+        self.assertEqual(get_secret.call_count, 2)
+
+    @mock.patch("azutil.get_fqdn", return_value="headnode.example.com")
+    @mock.patch("azutil.get_keyvault_secret", side_effect=lambda v, k: k+"-value")
+    def test_nested_lookup(self, get_secret, get_fqdn):
+        # the inner secret names the outer one
+        self.config.data["d"] = "secret.vault.{{secret.vault.key}}"
+        self.config.prefetch()
+        self.assertEqual(sorted([ c.args for c in get_secret.call_args_list ]), [ ("vault", "key") ])
+        self.assertEqual(self.config.preprocess()["d"], "key-value-value")
+        self.assertEqual(get_secret.call_count, 2)
+
+    @mock.patch("azutil.get_fqdn", return_value="headnode.example.com")
+    def test_persist_non_secret(self, get_fqdn):
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, "cache.json")
+            with mock.patch("azutil.get_keyvault_secret", return_value="s3cr3t"):
+                self.config.cache = azconfig.ResolverCache(fname, 60)
+                self.config.preprocess()
+            with open(fname) as f:
+                stored = json.load(f)
+            self.assertEqual(list(stored.keys()), [ "fqdn.rg.headnodepip" ])
+
+            cache = azconfig.ResolverCache(fname, 60)
+            self.assertEqual(cache.get("fqdn", "rg", "headnodepip"), "headnode.example.com")
+            get_fqdn.assert_called_once()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import azdeploy
+
+def op(opid, name, state, status_code="OK"):
+    return {
+        "operationId": opid,
+        "properties": {
+            "provisioningState": state,
+            "statusCode": status_code,
+            "targetResource": {
+                "id": f"/subscriptions/sub/resourceGroups/rg/{name}",
+                "resourceName": name,
+                "resourceType": "Microsoft.Compute/virtualMachines"
+            }
+        }
+    }
+
+done = { "operationId": "X", "properties": { "provisioningState": "Succeeded", "statusCode": "OK" } }
+
+class TestDeploymentWatcher(unittest.TestCase):
+
+    @mock.patch("time.sleep")
+    def test_only_changes_reported(self, sleep):
+        polls = [
+            [ op("A", "headnode", "Running", "Accepted") ],
+            [ op("A", "headnode", "Running", "Accepted") ],
+            [ op("A", "headnode", "Running", "Accepted"), op("B", "compute", "Running", "Accepted") ],
+            [ op("A", "headnode", "Succeeded"), op("B", "compute", "Succeeded"), done ]
+        ]
+        with mock.patch("azutil.get_deployment_status", side_effect=polls):
+            watcher = azdeploy.DeploymentWatcher("rg", "deploy", min_interval=2, max_interval=30)
+            changes = [ (c.resource_name, c.old, c.new) for c in watcher.watch() ]
+        self.assertEqual(changes, [
+            ("headnode", None, "Running"),
+            ("compute", None, "Running"),
+            ("headnode", "Running", "Succeeded"),
+            ("compute", "Running", "Succeeded")
+        ])
+        self.assertTrue(watcher.success)
+        # backs off when nothing changed then resets
+        self.assertEqual([ c.args[0] for c in sleep.call_args_list ], [ 2, 2, 3, 2 ])
+
+    @mock.patch("time.sleep")
+    def test_failure(self, sleep):
+        failed = op("A", "headnode", "Failed", "Conflict")
+        failed["properties"]["statusMessage"] = { "error": { "code": "SkuNotAvailable", "message": "not available" } }
+        failedrun = { "operationId": "X", "properties": { "provisioningState": "Failed", "statusCode": "Conflict" } }
+        with mock.patch("azutil.get_deployment_status", return_value=[ failed, failedrun ]):
+            watcher = azdeploy.DeploymentWatcher("rg", "deploy")
+            list(watcher.watch())
+        self.assertFalse(watcher.success)
+        self.assertEqual(watcher.errors()[0]["code"], "SkuNotAvailable")
+
+    @mock.patch("time.sleep")
+    def test_nested(self, sleep):
+        nested = op("N", "deploy-compute", "Running", "Accepted")
+        nested["properties"]["targetResource"]["resourceType"] = "Microsoft.Resources/deployments"
+        status = {
+            "deploy": [
+                [ nested ],
+                [ nested, done ]
+            ],
+            "deploy-compute": [
+                [ op("A", "compute0001", "Running", "Accepted") ],
+                [ op("A", "compute0001", "Failed", "Conflict"), done ]
+            ]
+        }
+        with mock.patch("azutil.get_deployment_status", side_effect=lambda rg, name: status[name].pop(0)):
+            watcher = azdeploy.DeploymentWatcher("rg", "deploy", nested=[ "deploy-compute" ])
+            changes = [ (c.resource_name, c.new) for c in watcher.watch() ]
+        self.assertEqual(changes, [
+            ("deploy-compute", "Running"),
+            ("compute0001", "Running"),
+            ("compute0001", "Failed")
+        ])
+        self.assertFalse(watcher.success)
+        self.assertEqual(watcher.resource_states()["compute0001"], "Failed")
+
+class TestPlan(unittest.TestCase):
+
+    def test_plan(self):
+        deployed = { "vnet": "a", "headnode": "b", "compute0001": "c", "old": "d" }
+        hashes = { "vnet": "a", "headnode": "x", "compute0001": "c", "compute0002": "c" }
+        p = azdeploy.plan(deployed, hashes)
+        self.assertEqual(p, azdeploy.Plan([ "compute0002" ], [ "headnode" ], [ "vnet", "compute0001" ], [ "old" ]))
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertIsNone(azdeploy.load_deployed(tmpdir))
+            azdeploy.save_deployed(f"{tmpdir}/install", "rg", { "vnet": "a" })
+            self.assertEqual(azdeploy.load_deployed(f"{tmpdir}/install"), { "resource_group": "rg", "resources": { "vnet": "a" } })
+
+if __name__ == "__main__":
+    unittest.main()
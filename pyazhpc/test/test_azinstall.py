@@ -0,0 +1,421 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import azconfig
+import azdeploy
+import azinstall
+import azinventory
+
+cfg = {
+    "resource_group": "rg",
+    "install_from": "headnode",
+    "vnet": { "name": "hpcvnet" },
+    "resources": {
+        "headnode": { "type": "vm", "tags": [ "nfsserver" ] },
+        "compute": { "type": "vmss", "instances": 2, "tags": [ "nfsclient", "pbs[0]" ] }
+    },
+    "install": [
+        { "script": "nfsserver.sh", "tag": "nfsserver" },
+        { "script": "nfsclient.sh", "tag": "nfsclient" },
+        { "script": "local.sh", "type": "local_script" }
+    ]
+}
+
+class TestInstallDependencies(unittest.TestCase):
+
+    def test_list_order(self):
+        steps = [{ "script": "install_node_setup.sh" }] + cfg["install"]
+        self.assertEqual(azinstall.install_dependencies(cfg, steps), [
+            set(), { 0 }, { 0, 1 }, { 0, 1, 2 }
+        ])
+
+    def test_depends_on(self):
+        steps = [{ "script": "install_node_setup.sh" }] + cfg["install"]
+        steps[2] = dict(steps[2], depends_on=[ "nfsserver.sh" ])
+        self.assertEqual(azinstall.install_dependencies(cfg, steps)[2], { 0, 1 })
+
+    def test_depends_on_keeps_local_and_copy(self):
+        steps = [{ "script": "install_node_setup.sh" }] + cfg["install"] + [
+            { "script": "download.sh", "tag": "nfsserver" },
+            { "script": "pbs.sh", "tag": "pbs", "depends_on": [ "nfsclient.sh" ] },
+            { "script": "app.sh", "tag": "pbs", "depends_on": [ "nfsclient.sh" ], "copy": [ "app.tgz" ] }
+        ]
+        deps = azinstall.install_dependencies(cfg, steps)
+        # local.sh (3) always, download.sh (4) runs on the install node
+        self.assertEqual(deps[5], { 0, 2, 3 })
+        self.assertEqual(deps[6], { 0, 1, 2, 3, 4 })
+
+    @mock.patch("azinstall.push_bundle")
+    @mock.patch("azinstall.__rsync")
+    def test_concurrent_run(self, rsync, push_bundle):
+        steps = cfg["install"][:2] + [ { "script": "pbs.sh", "tag": "pbs", "depends_on": [ "nfsserver.sh" ] } ] + cfg["install"][2:]
+        order = []
+        def run_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, extra_args=(), force=False):
+            order.append(idx)
+            return 0
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            with mock.patch("azinstall._run_step", side_effect=run_step):
+                azinstall.run(dict(cfg, install=steps), tmpdir, "hpcadmin", "key", "key.pub", "fqdn", 4, {})
+        self.assertEqual(order[:2], [ 0, 1 ])
+        self.assertEqual(set(order[2:4]), { 2, 3 })
+        self.assertEqual(order[-1], 4)
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tmpdir = self.tmp.name
+        os.makedirs(f"{self.tmpdir}/install")
+        os.makedirs(f"{self.tmpdir}/scripts")
+        for step in cfg["install"]:
+            with open(f"{self.tmpdir}/scripts/{step['script']}", "w") as f:
+                f.write("#!/bin/bash\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_install(self, journal, fail=None):
+        order = []
+        def run_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, extra_args=(), force=False):
+            order.append(idx)
+            if idx == fail:
+                raise SystemExit(1)
+            return 0
+        with mock.patch("azinstall._run_step", side_effect=run_step):
+            try:
+                azinstall.run(cfg, self.tmpdir, "hpcadmin", "key", "key.pub", "fqdn", 1, journal)
+            except SystemExit:
+                pass
+        return order
+
+    @mock.patch("azinstall.push_bundle")
+    @mock.patch("azinstall.__rsync")
+    def test_resume_after_failure(self, rsync, push_bundle):
+        self.assertEqual(self.run_install({}, fail=2), [ 0, 1, 2 ])
+        journal = azinstall.load_journal(self.tmpdir)
+        self.assertEqual(sorted([ e["status"] for e in journal.values() ]), [ "failed", "succeeded", "succeeded" ])
+        # steps 1 succeeded before so only the failed step onwards are run
+        self.assertEqual(self.run_install(journal), [ 0, 2, 3 ])
+        # a changed script is run again along with what depends on it
+        with open(f"{self.tmpdir}/scripts/nfsserver.sh", "a") as f:
+            f.write("echo changed\n")
+        self.assertEqual(self.run_install(azinstall.load_journal(self.tmpdir)), [ 0, 1, 2, 3 ])
+
+class TestHostMarkers(unittest.TestCase):
+
+    def test_marker_changes_with_script(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/scripts")
+            with open(f"{tmpdir}/scripts/nfsclient.sh", "w") as f:
+                f.write("#!/bin/bash\n")
+            step = cfg["install"][1]
+            before = azinstall._marker_name(tmpdir, 2, step)
+            self.assertEqual(before, azinstall._marker_name(tmpdir, 2, step))
+            self.assertTrue(before.startswith("02_nfsclient.sh."))
+            with open(f"{tmpdir}/scripts/nfsclient.sh", "a") as f:
+                f.write("echo changed\n")
+            self.assertNotEqual(before, azinstall._marker_name(tmpdir, 2, step))
+
+    def test_lazy_config(self):
+        # build passes the install steps from a lazy config
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/scripts")
+            with open(f"{tmpdir}/config.json", "w") as f:
+                json.dump(cfg, f)
+            c = azconfig.ConfigFile()
+            c.open(f"{tmpdir}/config.json")
+            step = c.lazy()["install"][1]
+            self.assertEqual(azinstall._marker_name(tmpdir, 2, step), azinstall._marker_name(tmpdir, 2, cfg["install"][1]))
+            self.assertEqual(azinstall.step_hash(tmpdir, 2, step), azinstall.step_hash(tmpdir, 2, cfg["install"][1]))
+
+    def test_marker_changes_with_variables(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/scripts")
+            markers = []
+            for version in [ "1.0", "2.0", "2.0" ]:
+                c = azconfig.ConfigFile()
+                c.data = dict(cfg, variables={ "version": version })
+                c.data["install"] = [ dict(cfg["install"][1], args=[ "variables.version" ]) ]
+                markers.append(azinstall._marker_name(tmpdir, 2, c.lazy()["install"][0]))
+            self.assertNotEqual(markers[0], markers[1])
+            self.assertEqual(markers[1], markers[2])
+
+    def test_marker_ignores_sas_key_times(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/scripts")
+            markers = []
+            for st, sig in [ ("2020-01-01T00%3A00%3A00Z", "abc%3D"), ("2020-01-02T00%3A00%3A00Z", "def%3D") ]:
+                url = f"https://sa.blob.core.windows.net/c/f?st={st}&se={st}&sp=r&sv=2019-02-02&sr=c&sig={sig}"
+                markers.append(azinstall._marker_name(tmpdir, 2, dict(cfg["install"][1], args=[ url ])))
+            self.assertEqual(markers[0], markers[1])
+
+    def test_step_hash_ignores_sas_key_times(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            os.makedirs(f"{tmpdir}/scripts")
+            hashes = []
+            for st, sig in [ ("2020-01-01T00%3A00%3A00Z", "abc%3D"), ("2020-01-02T00%3A00%3A00Z", "def%3D") ]:
+                url = f"https://sa.blob.core.windows.net/c/f?st={st}&se={st}&sp=r&sv=2019-02-02&sr=c&sig={sig}"
+                step = dict(cfg["install"][1], args=[ url ])
+                azinstall.create_jumpbox_script(step, tmpdir, 2)
+                hashes.append(azinstall.step_hash(tmpdir, 2, step))
+            self.assertEqual(hashes[0], hashes[1])
+            step = dict(cfg["install"][1], args=[ url.replace("/f?", "/g?") ])
+            azinstall.create_jumpbox_script(step, tmpdir, 2)
+            self.assertNotEqual(hashes[0], azinstall.step_hash(tmpdir, 2, step))
+
+    def test_only_pending_hosts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            os.makedirs(f"{tmpdir}/scripts")
+            azinstall.create_jumpbox_script(cfg["install"][1], tmpdir, 2)
+            with open(f"{tmpdir}/install/02_nfsclient.sh") as f:
+                content = f.read()
+            self.assertIn("hosts=hostlists/pending/02_$tag", content)
+            self.assertIn("-h $hosts", content)
+            self.assertIn("touch ~/.azhpc/02_nfsclient.sh.", content)
+            self.assertNotIn("-i -h hostlists/tags/$tag", content)
+
+    def test_reboot_probes_hosts_concurrently(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            os.makedirs(f"{tmpdir}/scripts")
+            azinstall.create_jumpbox_script(dict(cfg["install"][1], reboot=True, reboot_timeout=300), tmpdir, 2)
+            with open(f"{tmpdir}/install/02_nfsclient.sh") as f:
+                content = f.read()
+            self.assertIn("reboot_host $h >> install/02_nfsclient.log 2>&1 &", content)
+            self.assertIn("-lt 300 ]", content)
+            self.assertNotIn("nc -z", content)
+
+class TestTreeCopy(unittest.TestCase):
+
+    def test_waves(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            os.makedirs(f"{tmpdir}/bin")
+            azinstall.create_tree_copy_script(tmpdir)
+            hosts = [ f"compute{n:04}" for n in range(1, 11) ]
+            with open(f"{tmpdir}/hosts", "w") as f:
+                f.write("\n".join(hosts) + "\n")
+            # record which host each copy came from
+            with open(f"{tmpdir}/bin/rsync", "w") as f:
+                f.write("#!/bin/bash\necho \"${RELAY:-jumpbox} ${@: -1}\" >> copies\n")
+            with open(f"{tmpdir}/bin/ssh", "w") as f:
+                f.write("#!/bin/bash\nRELAY=$1 bash -c \"$2\"\n")
+            os.chmod(f"{tmpdir}/bin/rsync", 0o755)
+            os.chmod(f"{tmpdir}/bin/ssh", 0o755)
+            res = subprocess.run(
+                [ "bash", "-c", "source install/tree_copy.sh; tree_copy hosts 2 /home/hpcadmin /home/hpcadmin/payload" ],
+                cwd=tmpdir, stdout=subprocess.PIPE, env=dict(os.environ, PATH=f"{tmpdir}/bin:" + os.environ["PATH"])
+            )
+            self.assertEqual(res.returncode, 0)
+            self.assertEqual(res.stdout.decode("utf-8").splitlines(), [
+                "copied to 2 of 10 hosts", "copied to 8 of 10 hosts", "copied to 10 of 10 hosts"
+            ])
+            with open(f"{tmpdir}/copies") as f:
+                copies = [ l.split() for l in f.read().splitlines() ]
+        self.assertEqual(sorted([ c[1] for c in copies ]), [ f"{h}:/home/hpcadmin" for h in hosts ])
+        self.assertEqual(len([ c for c in copies if c[0] == "jumpbox" ]), 6)
+
+class TestBundle(unittest.TestCase):
+
+    def test_only_new_content_is_sent(self):
+        with tempfile.TemporaryDirectory() as base:
+            tmpdir = f"{base}/local/azhpc_install_config"
+            remote = f"{base}/remote"
+            os.makedirs(f"{tmpdir}/scripts")
+            os.makedirs(f"{tmpdir}/install")
+            os.makedirs(f"{base}/bin")
+            os.makedirs(remote)
+            # runs the command in the remote directory instead of over ssh
+            with open(f"{base}/bin/ssh", "w") as f:
+                f.write(f"#!/bin/bash\ncd {remote} && bash -c \"${{@: -1}}\"\n")
+            os.chmod(f"{base}/bin/ssh", 0o755)
+            for name, content in [ ("scripts/a.sh", "a"), ("scripts/b.sh", "a"), ("scripts/c.sh", "c"), ("install/01_a.log", "log") ]:
+                with open(f"{tmpdir}/{name}", "w") as f:
+                    f.write(content)
+            os.chmod(f"{tmpdir}/scripts/c.sh", 0o755)
+
+            with mock.patch.dict(os.environ, PATH=f"{base}/bin:" + os.environ["PATH"]):
+                # a.sh and b.sh are the same so are sent once
+                self.assertEqual(azinstall.push_bundle("key", "hpcadmin", "fqdn", tmpdir), 2)
+                self.assertEqual(azinstall.push_bundle("key", "hpcadmin", "fqdn", tmpdir), 0)
+                with open(f"{tmpdir}/scripts/b.sh", "w") as f:
+                    f.write("b")
+                self.assertEqual(azinstall.push_bundle("key", "hpcadmin", "fqdn", tmpdir), 1)
+
+            with open(f"{remote}/azhpc_install_config/scripts/b.sh") as f:
+                self.assertEqual(f.read(), "b")
+            # the objects no longer used are removed (a, b and c are left)
+            objects = os.listdir(f"{remote}/.azhpc/objects")
+            self.assertEqual(sorted([ o for o in objects if not o.startswith("manifest.") ]), sorted(set([ i for i, p in azinstall.bundle_manifest(tmpdir).values() ])))
+            self.assertEqual(os.stat(f"{remote}/azhpc_install_config/scripts/c.sh").st_mode & 0o777, 0o755)
+            self.assertFalse(os.path.exists(f"{remote}/azhpc_install_config/install/01_a.log"))
+
+    def test_failed_push(self):
+        with tempfile.TemporaryDirectory() as base:
+            tmpdir = f"{base}/local/azhpc_install_config"
+            os.makedirs(f"{tmpdir}/scripts")
+            os.makedirs(f"{base}/bin")
+            with open(f"{tmpdir}/scripts/a.sh", "wb") as f:
+                f.write(os.urandom(1024*1024))
+            # lists an empty store then fails without reading the archive
+            with open(f"{base}/bin/ssh", "w") as f:
+                f.write("#!/bin/bash\ncase \"${@: -1}\" in mkdir*) exit 0;; esac\necho 'disk full' >&2\nexit 1\n")
+            os.chmod(f"{base}/bin/ssh", 0o755)
+            with mock.patch.dict(os.environ, PATH=f"{base}/bin:" + os.environ["PATH"]):
+                with self.assertLogs("azinstall", level="ERROR") as logs, self.assertRaises(SystemExit):
+                    azinstall.push_bundle("key", "hpcadmin", "fqdn", tmpdir)
+            self.assertIn("disk full", logs.output[0])
+
+class TestStream(unittest.TestCase):
+
+    def test_host_status_lines(self):
+        output = [
+            "#azhpc start 1600000000 10:00:00",
+            "    Running on 2 of 3 hosts",
+            "[1] 10:00:05 [SUCCESS] compute0001",
+            "installed lustre",
+            "[2] 10:00:09 [FAILURE] compute0002 Exited with error code 1",
+            "        compute0001 rebooted (40s)"
+        ] + [ f"line {n}" for n in range(60) ]
+        cmd = [ "bash", "-c", "printf '%s\\n' \"$@\"; exit 3", "stream" ] + output
+        with self.assertLogs("azinstall", level="DEBUG") as logs:
+            returncode, last = azinstall._stream(cmd)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(len(last), azinstall.stream_lines)
+        self.assertEqual(last[-1], "line 59")
+        info = [ l.split(":", 2)[2] for l in logs.output if l.startswith("INFO") ]
+        self.assertEqual(info, [
+            "    Running on 2 of 3 hosts",
+            "    compute0001: success",
+            "    compute0002: failure Exited with error code 1",
+            "        compute0001 rebooted (40s)"
+        ])
+        self.assertIn("DEBUG:azinstall:    compute0001: installed lustre", logs.output)
+
+class TestPythonExecutor(unittest.TestCase):
+
+    def test_step_on_pending_hosts(self):
+        commands = []
+        def run(host, command, timeout=None):
+            commands.append((host, command.split("; ", 1)[1]))
+            if command.endswith("test -f ~/.azhpc/" + marker):
+                return (0 if host == "compute0001" else 1), b"", b""
+            return 0, b"done\n", b""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            os.makedirs(f"{tmpdir}/hostlists/tags")
+            with open(f"{tmpdir}/hostlists/tags/nfsclient", "w") as f:
+                f.write("compute0001\ncompute0002\n")
+            step = dict(cfg["install"][1], sudo=True)
+            marker = azinstall._marker_name(tmpdir, 2, step)
+            with mock.patch("azssh.SshTransport.run", side_effect=run), mock.patch("azinstall._append_remote") as append:
+                azinstall._run_jumpbox_step(cfg, tmpdir, "hpcadmin", "key", "fqdn", 2, step)
+            with open(f"{tmpdir}/install/02_nfsclient.log") as f:
+                content = f.read()
+            self.assertIn("[SUCCESS] compute0002\ndone", content)
+            # the install node has the same log
+            self.assertEqual("".join([ c[0][4] for c in append.call_args_list ]), content)
+        self.assertEqual(commands[2:], [
+            ("compute0002", f"cd {tmpdir}; sudo scripts/nfsclient.sh && mkdir -p ~/.azhpc && touch ~/.azhpc/{marker}")
+        ])
+
+    def test_logs_not_counted_twice(self):
+        steps = [{ "script": "install_node_setup.sh" }] + cfg["install"]
+        with mock.patch("aztelemetry.collect_pssh_logs") as collect:
+            azinstall._collect_host_logs("tmp", steps, { 1 })
+            with mock.patch("azinstall.executor", "python"):
+                azinstall._collect_host_logs("tmp", steps, set())
+        self.assertEqual(collect.call_args_list[0][0][1], { 1 })
+        self.assertEqual(collect.call_args_list[1][0][1], { 1, 2 })
+
+class FakeWatcher:
+    def __init__(self, steps):
+        self.steps = steps
+        self.states = {}
+        self.success = True
+
+    def watch(self, callback=None):
+        for name, state in self.steps:
+            self.states[name] = state
+            yield azdeploy.StatusChange(name, "type", None, state, "OK")
+
+    def resource_states(self):
+        return self.states
+
+class TestPipeline(unittest.TestCase):
+
+    def test_ready_resources(self):
+        states = { "headnode": "Succeeded", "compute": "Running" }
+        self.assertEqual(azinstall.ready_resources(cfg, states), { "headnode" })
+
+    def run_pipelined(self, journal, force=False):
+        order = []
+        def run_step(cfg, tmpdir, adminuser, sshprivkey, fqdn, idx, step, extra_args=(), force=False):
+            order.append((idx, tuple(extra_args), force))
+        watcher = FakeWatcher([
+            ("headnode", "Succeeded"),
+            ("compute", "Running"),
+            ("compute", "Succeeded")
+        ])
+        with mock.patch("azinstall._run_step", side_effect=run_step):
+            azinstall.run_pipelined(cfg, self.tmpdir, "hpcadmin", "key", "key.pub", watcher, journal=journal, force=force)
+        return order
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tmpdir = self.tmp.name
+        patches = [
+            mock.patch("azinstall.__rsync"),
+            mock.patch("azinstall.push_bundle"),
+            mock.patch("azinstall.generate_hostlists", return_value=({}, {})),
+            mock.patch("azinstall.generate_install", side_effect=lambda cfg, tmpdir, *args: os.makedirs(f"{tmpdir}/install")),
+            mock.patch("azutil.get_fqdn", return_value="headnode.example.com"),
+            mock.patch("azinventory.query", return_value=azinventory.Inventory("rg"))
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_steps_start_when_tag_ready(self):
+        self.assertEqual(self.run_pipelined({}), [
+            (0, (), False),
+            (1, (), False),
+            (0, ("--resource", "compute"), False),
+            (2, (), False),
+            (3, (), False)
+        ])
+
+    def test_journal(self):
+        journal = {}
+        self.run_pipelined(journal)
+        with open(f"{self.tmpdir}/install/journal.json") as f:
+            self.assertEqual(json.load(f), journal)
+        self.assertEqual(sorted([ e["step"] for e in journal.values() if e["status"] == "succeeded" ]), [ 1, 2, 3 ])
+        shutil.rmtree(f"{self.tmpdir}/install")
+        # only the node setup runs again unless forced
+        self.assertEqual([ o[0] for o in self.run_pipelined(journal) ], [ 0, 0 ])
+        shutil.rmtree(f"{self.tmpdir}/install")
+        self.assertEqual(self.run_pipelined(journal, True)[-1], (3, (), True))
+
+    def test_install_node_never_ready(self):
+        # e.g. the headnode was left out of the deployment but its state is
+        # not known, the install is left for after the deployment
+        watcher = FakeWatcher([ ("compute", "Succeeded") ])
+        with mock.patch("azinstall._run_step") as run_step:
+            self.assertIsNone(azinstall.run_pipelined(cfg, self.tmpdir, "hpcadmin", "key", "key.pub", watcher))
+        run_step.assert_not_called()
+        getattr(azinstall, "__rsync").assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
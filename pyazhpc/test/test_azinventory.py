@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import azinventory
+
+vms = [
+    { "name": "headnode", "computer_name": "headnode", "private_ip": "10.2.1.4", "power_state": "VM running" }
+]
+vmss = {
+    "compute": [
+        { "instance_id": "0", "name": "compute000000", "private_ip": "10.2.4.4", "power_state": "VM running" },
+        { "instance_id": "1", "name": "compute000001", "private_ip": "10.2.4.5", "power_state": "VM deallocated" }
+    ],
+    "viz": []
+}
+
+class TestInventory(unittest.TestCase):
+
+    @mock.patch("azutil.list_vmss_instances", side_effect=lambda rg, n: vmss[n])
+    @mock.patch("azutil.list_vmss", return_value=[ "compute", "viz" ])
+    @mock.patch("azutil.list_vms", return_value=vms)
+    def test_query(self, list_vms, list_vmss, list_vmss_instances):
+        inventory = azinventory.query("rg")
+        self.assertEqual(inventory.vmss_instances("compute"), [ "compute000000", "compute000001" ])
+        self.assertEqual(inventory.vmss_instances("viz"), [])
+        self.assertEqual(inventory.private_ip("headnode"), "10.2.1.4")
+        self.assertEqual(inventory.private_ip("compute000001"), "10.2.4.5")
+        self.assertEqual(inventory.not_running(), [ "compute000001" ])
+        list_vms.assert_called_once_with("rg")
+        self.assertEqual(list_vmss_instances.call_count, 2)
+
+    def test_save_and_load(self):
+        inventory = azinventory.Inventory(
+            "rg", { x["name"]: x for x in vms }, vmss,
+            fqdn="headnode.westeurope.cloudapp.azure.com",
+            resources={ "headnode": [ "headnode" ] },
+            tags={ "pbs": [ "compute000000", "compute000001" ] }
+        )
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, "inventory.json")
+            inventory.save(fname)
+            loaded = azinventory.load(fname)
+        self.assertEqual(loaded.to_dict(), inventory.to_dict())
+        self.assertEqual(loaded.vmss_instances("compute"), [ "compute000000", "compute000001" ])
+
+if __name__ == "__main__":
+    unittest.main()
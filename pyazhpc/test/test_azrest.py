@@ -0,0 +1,54 @@
+import unittest
+
+import azrest
+import azutil
+
+from test.armstub import ArmStub
+
+rg_path = "/subscriptions/sub/resourceGroups/rg/providers"
+
+class TestArmRestBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = ArmStub().start()
+        azutil.backend = azrest.ArmRestBackend(
+            endpoint=self.stub.url,
+            vault=self.stub.url+"/vault/{}",
+            subscription="sub",
+            token="token"
+        )
+
+    def tearDown(self):
+        azutil.backend = None
+        self.stub.stop()
+
+    def test_get_fqdn(self):
+        self.stub.add("GET", rg_path+"/Microsoft.Network/publicIPAddresses/headnodepip", {
+            "properties": { "dnsSettings": { "fqdn": "headnode.westeurope.cloudapp.azure.com" } }
+        })
+        self.assertEqual(azutil.get_fqdn("rg", "headnodepip"), "headnode.westeurope.cloudapp.azure.com")
+
+    def test_vmss_instances_paged(self):
+        path = rg_path+"/Microsoft.Compute/virtualMachineScaleSets/compute/virtualMachines"
+        self.stub.add("GET", path, {
+            "value": [ { "properties": { "osProfile": { "computerName": "compute000000" } } } ],
+            "nextLink": self.stub.url+path+"/page2"
+        })
+        self.stub.add("GET", path+"/page2", {
+            "value": [ { "properties": { "osProfile": { "computerName": "compute000001" } } } ]
+        })
+        self.assertEqual(azutil.get_vmss_instances("rg", "compute"), [ "compute000000", "compute000001" ])
+        # both pages are fetched over the same connection
+        self.assertEqual(len(self.stub.connections), 1)
+
+    def test_keyvault_secret(self):
+        self.stub.add("GET", "/vault/myvault/secrets/mykey", { "value": "s3cr3t" })
+        self.assertEqual(azutil.get_keyvault_secret("myvault", "mykey"), "s3cr3t")
+        self.assertIn("api-version=7.0", self.stub.requests[0][1])
+
+    def test_error_exits(self):
+        with self.assertRaises(SystemExit):
+            azutil.get_fqdn("rg", "missingpip")
+
+if __name__ == "__main__":
+    unittest.main()
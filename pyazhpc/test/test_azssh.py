@@ -0,0 +1,163 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import azssh
+
+# stands in for ssh, the command is run by the local shell
+class FakeTransport:
+    def __init__(self, delay=0, fail=()):
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.commands = {}
+
+    def run(self, host, command, timeout=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.commands[host] = command
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if host in self.fail:
+            return 1, b"", f"{host} failed\n".encode("utf-8")
+        res = subprocess.run([ "bash", "-c", command ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return res.returncode, res.stdout, res.stderr
+
+    def push(self, host, src, dst, timeout=None):
+        return 0, b"", b""
+
+class TestParallelSsh(unittest.TestCase):
+
+    def test_per_host_results(self):
+        hosts = [ f"compute{n:04}" for n in range(1, 6) ]
+        pssh = azssh.ParallelSsh(FakeTransport(fail=[ "compute0003" ]))
+        results = pssh.run(hosts, "echo $PSSH_NODENUM $PSSH_HOST")
+        self.assertEqual(list(results.keys()), hosts)
+        self.assertEqual(results["compute0002"].stdout, "1 compute0002\n")
+        self.assertEqual(results["compute0003"].returncode, 1)
+        self.assertEqual(results["compute0003"].stderr, "compute0003 failed\n")
+        self.assertEqual(azssh.failed(results), [ "compute0003" ])
+
+    def test_fanout_limit(self):
+        transport = FakeTransport(delay=0.05)
+        pssh = azssh.ParallelSsh(transport, threads=3)
+        pssh.run([ f"h{n}" for n in range(10) ], "true")
+        self.assertEqual(transport.max_active, 3)
+
+    def test_format_results(self):
+        results = {
+            "a": azssh.HostResult("a", 0, "up\n", "", 0.1),
+            "b": azssh.HostResult("b", None, "", "", 5.0)
+        }
+        out = azssh.format_results(results).splitlines()
+        self.assertRegex(out[0], r"^\[1\] \d\d:\d\d:\d\d \[SUCCESS\] a$")
+        self.assertEqual(out[1], "up")
+        self.assertRegex(out[2], r"^\[2\] .* \[FAILURE\] b Timed out$")
+
+class RebootTransport:
+    # compute0001 comes back on the third probe, compute0002 never does
+    def __init__(self):
+        self.probes = { "compute0001": 0, "compute0002": 0 }
+        self.rebooted = set()
+
+    def run(self, host, command, timeout=None):
+        if command.endswith("sudo reboot"):
+            self.rebooted.add(host)
+            return 255, b"", b""
+        if host not in self.rebooted:
+            return 0, b"old\n", b""
+        self.probes[host] += 1
+        if host == "compute0001" and self.probes[host] >= 3:
+            return 0, b"new\n", b""
+        return 255, b"", b"Connection refused\n"
+
+    def close(self, host):
+        return 0, b"", b""
+
+class SlowRebootTransport(RebootTransport):
+    # the boot id can't be read before the reboot, which takes a while to
+    # start
+    def run(self, host, command, timeout=None):
+        if command.endswith("sudo reboot"):
+            self.rebooted.add(host)
+            return 0, b"", b""
+        if host not in self.rebooted:
+            return 255, b"", b"Connection reset\n"
+        self.probes[host] += 1
+        if self.probes[host] < 3:
+            return 0, b"old\n", b""
+        if self.probes[host] < 5:
+            return 255, b"", b"Connection refused\n"
+        return 0, b"new\n", b""
+
+class TestReboot(unittest.TestCase):
+
+    def test_stragglers(self):
+        transport = RebootTransport()
+        pssh = azssh.ParallelSsh(transport)
+        rebooted, stragglers = azssh.reboot(pssh, [ "compute0001", "compute0002" ], 0.5, 0.01, 0.04)
+        self.assertEqual(list(rebooted.keys()), [ "compute0001" ])
+        self.assertEqual(stragglers, [ "compute0002" ])
+        self.assertEqual(transport.probes["compute0001"], 3)
+        # backed off to the maximum delay rather than probing continuously
+        self.assertLess(transport.probes["compute0002"], 20)
+
+    def test_unknown_boot_id(self):
+        transport = SlowRebootTransport()
+        pssh = azssh.ParallelSsh(transport)
+        rebooted, stragglers = azssh.reboot(pssh, [ "compute0001" ], 5, 0.01, 0.04)
+        self.assertEqual(list(rebooted.keys()), [ "compute0001" ])
+        # the answers before it went down did not count
+        self.assertEqual(transport.probes["compute0001"], 5)
+
+class TestSshTransport(unittest.TestCase):
+
+    def tearDown(self):
+        azssh.control_dir = None
+
+    def test_shared_connections(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            azssh.control_dir = f"{tmpdir}/ssh_control"
+            opts = azssh.SshTransport("hpcadmin", "key", "hpcadmin@jumpbox").ssh_options()
+            self.assertTrue(os.path.isdir(azssh.control_dir))
+        self.assertIn(f"ControlPath={tmpdir}/ssh_control/%C", opts)
+        self.assertIn("ControlPersist=600", opts)
+        # the hop through the install node shares its connection too
+        self.assertIn(f"ControlPath={tmpdir}/ssh_control/%C", opts[-1])
+
+    def test_control_dir_for_config(self):
+        with mock.patch.dict(os.environ, { "HOME": "/home/hpcadmin" }):
+            d = azssh.control_dir_for("/work/project/config.json")
+            self.assertEqual(d, azssh.control_dir_for("/work/project/config.json"))
+            self.assertNotEqual(d, azssh.control_dir_for("/work/other/config.json"))
+        self.assertTrue(d.startswith("/home/hpcadmin/.ssh/azhpc-"))
+        # the sockets are named by a 40 character hash, unix sockets are
+        # limited to 108
+        self.assertLess(len(d) + 41, 108)
+
+    @mock.patch("subprocess.run")
+    def test_through_install_node(self, run):
+        run.return_value = subprocess.CompletedProcess([], 0, b"ok", b"")
+        transport = azssh.SshTransport("hpcadmin", "hpcadmin_id_rsa", "hpcadmin@jumpbox.example.com")
+        self.assertEqual(transport.run("compute0001", "hostname"), (0, b"ok", b""))
+        cmd = run.call_args[0][0]
+        self.assertEqual(cmd[0], "ssh")
+        self.assertEqual(cmd[-2:], [ "hpcadmin@compute0001", "hostname" ])
+        self.assertIn("ProxyCommand=ssh -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i hpcadmin_id_rsa -W %h:%p hpcadmin@jumpbox.example.com", cmd)
+
+    @mock.patch("subprocess.run", side_effect=subprocess.TimeoutExpired([], 1))
+    def test_timeout(self, run):
+        transport = azssh.SshTransport("hpcadmin", "key", port=2222)
+        self.assertEqual(transport.run("localhost", "sleep 10", timeout=1), (None, b"", b""))
+        self.assertIn("2222", run.call_args[0][0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+import azssh
+import aztelemetry
+
+pssh_log = """Loaded plugins: fastestmirror
+#azhpc start 1600000000 23:59:50
+[1] 23:59:58 [SUCCESS] compute0001
+installed
+[2] 00:00:20 [FAILURE] compute0002 Exited with error code 2
+partial
+Stderr: no space left
+on device
+        compute0001 rebooted (45s)
+        compute0002 did not come back within 600s
+"""
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_parse_pssh_log(self):
+        hosts = aztelemetry.parse_pssh_log(pssh_log)
+        self.assertEqual(hosts[0], {
+            "action": "pssh", "host": "compute0001", "start": 1600000000.0, "end": 1600000008.0,
+            "returncode": 0, "stdout_bytes": 10, "stderr_bytes": 0
+        })
+        # the time of day wraps past midnight
+        self.assertEqual(hosts[1]["end"], 1600000030.0)
+        self.assertEqual(hosts[1]["returncode"], 2)
+        self.assertEqual(hosts[1]["stdout_bytes"], 8)
+        self.assertEqual(hosts[1]["stderr_bytes"], 24)
+        self.assertEqual(hosts[2], {
+            "action": "reboot", "host": "compute0001", "start": 1600000008.0, "end": 1600000053.0,
+            "returncode": 0, "stdout_bytes": 0, "stderr_bytes": 0
+        })
+        self.assertEqual(hosts[3]["returncode"], None)
+
+    def test_last_build_only(self):
+        earlier = pssh_log.replace("compute0001", "compute0009")
+        hosts = aztelemetry.parse_pssh_log(earlier + pssh_log)
+        self.assertEqual(hosts, aztelemetry.parse_pssh_log(pssh_log))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            for step in [ "01_nfsserver", "02_nfsclient" ]:
+                with open(f"{tmpdir}/install/{step}.log", "w") as f:
+                    f.write(earlier + pssh_log)
+            # step 1 was skipped by this build
+            aztelemetry.collect_pssh_logs(tmpdir, skip={ 1 })
+            records = aztelemetry.load(tmpdir)
+        self.assertEqual(set([ r["step"] for r in records ]), { 2 })
+        self.assertEqual(len(records), 4)
+
+    def test_runs_in_this_build(self):
+        # the node setup is run again for each resource in a pipelined build
+        earlier = pssh_log.replace("compute0001", "compute0009")
+        later = pssh_log.replace("compute0002", "compute0003")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            with open(f"{tmpdir}/install/00_install_node_setup.log", "w") as f:
+                f.write(earlier + pssh_log + later)
+            for status in [ "succeeded", "succeeded" ]:
+                aztelemetry.record(tmpdir, "step", step=0, script="install_node_setup.sh", tag=None, start=0, end=30, status=status)
+            aztelemetry.collect_pssh_logs(tmpdir)
+            records = aztelemetry.load(tmpdir)
+        hosts = [ r["host"] for r in records if r["event"] == "host" and r["action"] == "pssh" ]
+        self.assertEqual(hosts, [ "compute0001", "compute0002", "compute0001", "compute0003" ])
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f"{tmpdir}/install")
+            with open(f"{tmpdir}/install/02_nfsclient.log", "w") as f:
+                f.write(pssh_log)
+            aztelemetry.record(tmpdir, "step", step=1, script="nfsserver.sh", tag="nfsserver", start=0, end=30, status="succeeded")
+            aztelemetry.record(tmpdir, "step", step=2, script="nfsclient.sh", tag="nfsclient", start=30, end=700, status="failed")
+            aztelemetry.record_results(tmpdir, 1, "run", {
+                "headnode": azssh.HostResult("headnode", 0, "ok\n", "", 25.0, 1.0)
+            })
+            aztelemetry.collect_pssh_logs(tmpdir)
+            records = aztelemetry.load(tmpdir)
+
+        self.assertEqual(len([ r for r in records if r["event"] == "host" ]), 5)
+        lines = aztelemetry.report(records).splitlines()
+        self.assertEqual(lines[0], "Slowest steps:")
+        self.assertTrue(lines[1].startswith("    02 nfsclient.sh"))
+        self.assertTrue(lines[4].startswith("    compute0002"))
+        self.assertIn("Failures:", lines)
+        self.assertEqual(lines[-1].split()[:4], [ "compute0002", "02", "nfsclient.sh", "reboot" ])
+
+if __name__ == "__main__":
+    unittest.main()
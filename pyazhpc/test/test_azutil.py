@@ -0,0 +1,44 @@
+import base64
+import hashlib
+import hmac
+import unittest
+import urllib.parse
+from unittest import mock
+
+import azutil
+
+key = base64.b64encode(b"not-a-real-storage-account-key").decode("utf-8")
+
+class TestStorageSasKey(unittest.TestCase):
+
+    def setUp(self):
+        azutil._storage_keys.clear()
+
+    def test_container_sas(self):
+        sas = azutil.generate_storage_saskey(
+            "myaccount", key, "apps", "lr",
+            "2020-01-01T00:00:00Z", "2020-01-01T03:00:00Z"
+        )
+        fields = urllib.parse.parse_qs(sas)
+        self.assertEqual(fields["sp"], [ "rl" ])
+        self.assertEqual(fields["sr"], [ "c" ])
+        self.assertEqual(fields["st"], [ "2020-01-01T00:00:00Z" ])
+        string_to_sign = "rl\n2020-01-01T00:00:00Z\n2020-01-01T03:00:00Z\n/blob/myaccount/apps\n\n\n\n2018-11-09\nc\n\n\n\n\n\n"
+        sig = base64.b64encode(hmac.new(base64.b64decode(key), string_to_sign.encode("utf-8"), hashlib.sha256).digest()).decode("utf-8")
+        self.assertEqual(fields["sig"], [ sig ])
+
+    def test_blob_sas(self):
+        sas = azutil.generate_storage_saskey(
+            "myaccount", key, "apps", "r",
+            "2020-01-01T00:00:00Z", "2020-01-01T03:00:00Z", "bin/app.tgz"
+        )
+        self.assertEqual(urllib.parse.parse_qs(sas)["sr"], [ "b" ])
+
+    @mock.patch("azutil.get_storage_key", return_value=key)
+    def test_key_fetched_once(self, get_storage_key):
+        azutil.get_storage_saskey("myaccount", "apps", "r")
+        azutil.get_storage_saskey("myaccount", "data", "rw")
+        get_storage_key.assert_called_once_with("myaccount")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import copy
+import os
+import tempfile
+import unittest
+
+import arm
+import azutil
+import azvalidate
+
+cfg = {
+    "location": "westeurope",
+    "resource_group": "rg",
+    "admin_user": "hpcadmin",
+    "proximity_placement_group_name": "ppg",
+    "vnet": {
+        "name": "hpcvnet",
+        "address_prefix": "10.2.0.0/20",
+        "subnets": { "compute": "10.2.4.0/22" }
+    },
+    "resources": {
+        "headnode": {
+            "type": "vm",
+            "vm_type": "Standard_D8s_v3",
+            "image": "OpenLogic:CentOS:7.6:latest",
+            "subnet": "compute",
+            "public_ip": True
+        },
+        "compute": {
+            "type": "vm",
+            "vm_type": "Standard_HB60rs",
+            "image": "OpenLogic:CentOS:7.6:latest",
+            "subnet": "compute",
+            "instances": 4,
+            "proximity_placement_group": True
+        },
+        "hc": {
+            "type": "vmss",
+            "vm_type": "Standard_HC44rs",
+            "image": "OpenLogic:CentOS:7.6:latest",
+            "subnet": "compute",
+            "instances": 10
+        }
+    }
+}
+
+class TestValidate(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        with open("hpcadmin_id_rsa.pub", "w") as f:
+            f.write("ssh-rsa AAAA hpcadmin\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def template(self, config, copy_loops=False):
+        tpl = arm.ArmTemplate(copy_loops)
+        tpl.read(config)
+        return tpl
+
+    def test_valid(self):
+        tpl = self.template(cfg)
+        self.assertEqual(azvalidate.check(tpl), [])
+        families, public_ips = azvalidate.counts(tpl)
+        self.assertEqual(families, {
+            "DSv3": { "vms": 1, "cores": 8 },
+            "HBS": { "vms": 4, "cores": 240 },
+            "HCS": { "vms": 10, "cores": 440 }
+        })
+        self.assertEqual(public_ips, 1)
+        # the same with copy loops
+        self.assertEqual(azvalidate.counts(self.template(cfg, True)), (families, public_ips))
+
+    def test_errors(self):
+        bad = copy.deepcopy(cfg)
+        del bad["proximity_placement_group_name"]
+        bad["resources"]["hc"]["subnet"] = "storage"
+        # collides with the names of the compute instances
+        bad["resources"]["compute0002"] = dict(bad["resources"]["headnode"], public_ip=False)
+        errors = azvalidate.check(self.template(bad))
+        self.assertEqual(errors, [
+            "Microsoft.Network/networkInterfaces/compute0002nic is in the template more than once",
+            "Microsoft.Compute/virtualMachines/compute0002 is in the template more than once",
+            "compute0001 (Microsoft.Compute/virtualMachines) refers to Microsoft.Compute/proximityPlacementGroups/None which is not in the template",
+            "compute0002 (Microsoft.Compute/virtualMachines) refers to Microsoft.Compute/proximityPlacementGroups/None which is not in the template",
+            "compute0003 (Microsoft.Compute/virtualMachines) refers to Microsoft.Compute/proximityPlacementGroups/None which is not in the template",
+            "compute0004 (Microsoft.Compute/virtualMachines) refers to Microsoft.Compute/proximityPlacementGroups/None which is not in the template",
+            "hc (Microsoft.Compute/virtualMachineScaleSets) refers to Microsoft.Network/virtualNetworks/subnets/hpcvnet/storage which is not in the template"
+        ])
+
+    def test_cycle(self):
+        tpl = self.template(cfg)
+        tpl.find("Microsoft.Network/virtualNetworks", "hpcvnet")["dependsOn"] = [ "Microsoft.Compute/virtualMachines/headnode" ]
+        tpl._reindex()
+        self.assertEqual(azvalidate.check(tpl), [
+            "dependency cycle: hpcvnet -> headnode -> headnodenic -> hpcvnet"
+        ])
+
+    def test_without_key_file(self):
+        os.remove("hpcadmin_id_rsa.pub")
+        tpl = arm.ArmTemplate(sshkey="ssh-rsa placeholder")
+        tpl.read(cfg)
+        self.assertEqual(azvalidate.check(tpl), [])
+        self.assertEqual(os.listdir("."), [])
+
+    def test_vm_family(self):
+        self.assertEqual(azvalidate.vm_family("Standard_E64-32s_v3"), ("ESv3", 64))
+        self.assertEqual(azvalidate.vm_family("Standard_NV6"), ("NV", 6))
+        self.assertEqual(azvalidate.vm_family("<NOT-SET>"), ("<NOT-SET>", None))
+
+    def test_offline(self):
+        azutil.set_backend("offline")
+        try:
+            self.assertEqual(azutil.get_fqdn("rg", "headnodepip"), "<get_fqdn:rg,headnodepip>")
+            self.assertTrue(azutil.get_storage_saskey("account", "container", "r").startswith("<get_storage_saskey:"))
+        finally:
+            azutil.set_backend("cli")
+
+if __name__ == "__main__":
+    unittest.main()